@@ -0,0 +1,79 @@
+"""
+Microbenchmark of the per-operation hashing cost of CuckooFilter.
+
+Compares the previous derivation of the bucket pair and fingerprint (builtin
+hash for the bucket, random.seed + random.getrandbits for the fingerprint,
+builtin hash again for the alternate bucket) with the current one, which
+takes all three from a single mmh3 128 bit digest. The add/check timings are
+for the whole filter operation with the current hashing, one item at a time
+and as a NumPy batch, for a CuckooFilter and a ScalableCuckooFilter.
+
+Run from the repository root:
+
+    python -m PDS.benchmark_cuckoo_hashing
+
+A run with CPython 3.11 and NumPy 2.4 on x86-64 Linux, in us/op:
+
+    legacy hashing             8.792
+    single digest hashing      0.856
+    add                        1.868
+    add_many                   0.652
+    check                      1.579
+    check_many                 0.269
+    scalable add               3.655
+    scalable add_many          1.505
+    scalable check             2.647
+    scalable check_many        0.328
+
+Before the batch paths used NumPy, check_many took 0.938 us/op and the
+scalable add_many was a loop over add.
+"""
+import random
+from timeit import timeit
+
+from PDS.cuckoo_filter import CuckooFilter, ScalableCuckooFilter
+
+NUM_ITEMS = 100000
+FALSE_POSITIVE_PROB = 0.2
+
+def legacy_hash(ckf, item):
+    ''' (CuckooFilter, str) -> (int, int, int)
+    The fingerprint and bucket pair of item as they used to be computed.
+    '''
+    random.seed(hash(item))
+    fingerprint = random.getrandbits(ckf.fingerprint_size) or 1
+    i1 = hash(item) % ckf.capacity
+    i2 = (i1 ^ (hash(fingerprint) % ckf.capacity)) % ckf.capacity
+    return fingerprint, i1, i2
+
+def per_op(statement, number):
+    ''' (callable, int) -> float
+    Returns the microseconds spent per call of statement over number calls.
+    '''
+    return timeit(statement, number=1) * 1e6 / number
+
+def main():
+    keys = ['key{}'.format(i) for i in range(NUM_ITEMS)]
+    ckf = CuckooFilter(NUM_ITEMS, FALSE_POSITIVE_PROB)
+    batch_ckf = CuckooFilter(NUM_ITEMS, FALSE_POSITIVE_PROB)
+    # Scalable filters start small, so both grow a chain while adding
+    sckf = ScalableCuckooFilter(NUM_ITEMS // 8, FALSE_POSITIVE_PROB)
+    batch_sckf = ScalableCuckooFilter(NUM_ITEMS // 8, FALSE_POSITIVE_PROB)
+
+    results = [
+        ('legacy hashing', per_op(lambda: [legacy_hash(ckf, key) for key in keys], NUM_ITEMS)),
+        ('single digest hashing', per_op(lambda: [ckf._hash(key) for key in keys], NUM_ITEMS)),
+        ('add', per_op(lambda: [ckf.add(key) for key in keys], NUM_ITEMS)),
+        ('add_many', per_op(lambda: batch_ckf.add_many(keys), NUM_ITEMS)),
+        ('check', per_op(lambda: [ckf.check(key) for key in keys], NUM_ITEMS)),
+        ('check_many', per_op(lambda: ckf.check_many(keys), NUM_ITEMS)),
+        ('scalable add', per_op(lambda: [sckf.add(key) for key in keys], NUM_ITEMS)),
+        ('scalable add_many', per_op(lambda: batch_sckf.add_many(keys), NUM_ITEMS)),
+        ('scalable check', per_op(lambda: [sckf.check(key) for key in keys], NUM_ITEMS)),
+        ('scalable check_many', per_op(lambda: sckf.check_many(keys), NUM_ITEMS)),
+        ]
+    for name, cost in results:
+        print('{:<24}{:>8.3f} us/op'.format(name, cost))
+
+if __name__ == '__main__':
+    main()
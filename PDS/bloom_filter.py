@@ -1,31 +1,166 @@
 from math import log
-from mmh3 import hash
-  
+from mmh3 import hash128
+
+import numpy as np
+
+from PDS.cuckoo_filter import _digests
+
+# Bits of a cache line, the block size of BlockedBloomFilter
+BLOCK_BITS = 512
+UINT64_MASK = (1 << 64) - 1
+
 class BloomFilter:
 
-    def __init__(self, num_items, false_positive_prob): 
-        self.false_positive_prob = false_positive_prob 
-        self.bit_array_size = self.bit_array_size(num_items, false_positive_prob) 
-        self.num_hash_fns = self.get_hash_count(self.bit_array_size, num_items) 
-        self.bit_array = [0 for i in range(self.bit_array_size)] 
-
-    def add(self, item): 
-        for seed in range(self.num_hash_fns):
-            # each seed creates a different digest.
-            digest = hash(item, seed) % self.bit_array_size 
-            self.bit_array[digest] = 1
-
-    def check(self, item): 
-        for seed in range(self.num_hash_fns): 
-            digest = hash(item, seed) % self.bit_array_size 
-            if self.bit_array[digest] == 0: 
+    def __init__(self, num_items, false_positive_prob):
+        self.false_positive_prob = false_positive_prob
+        self.bit_array_size = self.bit_array_size(num_items, false_positive_prob)
+        self.num_hash_fns = self.get_hash_count(self.bit_array_size, num_items)
+        # One bit per position, packed eight to a byte
+        self.bit_array = bytearray((self.bit_array_size + 7) // 8)
+
+    def add(self, item):
+        bit_array = self.bit_array
+        for digest in self._positions(item):
+            bit_array[digest >> 3] |= 1 << (digest & 7)
+
+    def check(self, item):
+        bit_array = self.bit_array
+        for digest in self._positions(item):
+            if not bit_array[digest >> 3] & (1 << (digest & 7)):
                 # if any bit is false, the item is not definitely present
                 return False
         return True
-  
+
+    def add_many(self, items):
+        ''' (self, iterable) -> None
+        Adds every item of items, hashing them and setting their bits in batch.
+        '''
+        positions = self._positions_many(items).ravel()
+        bit_array = np.frombuffer(self.bit_array, dtype=np.uint8)
+        np.bitwise_or.at(bit_array, positions >> 3, np.left_shift(1, positions & 7).astype(np.uint8))
+
+    def check_many(self, items):
+        ''' (self, iterable) -> [bool]
+        Returns whether check would report each item of items, hashing them and
+        testing their bits in batch.
+        '''
+        positions = self._positions_many(items)
+        bit_array = np.frombuffer(self.bit_array, dtype=np.uint8)
+        return ((bit_array[positions >> 3] >> (positions & 7)) & 1).all(axis=1).tolist()
+
+    def _positions(self, item):
+        ''' (self, str) -> [int]
+        Returns the bit positions of item. They come from a single 128 bit digest
+        split in two hashes h1 and h2, the i-th position being h1 + i*h2
+        (Kirsch-Mitzenmacher double hashing).
+        '''
+        digest = hash128(item, signed=False)
+        h1, h2 = digest & UINT64_MASK, digest >> 64
+        return [(h1 + i * h2) % self.bit_array_size for i in range(self.num_hash_fns)]
+
+    def _positions_many(self, items):
+        ''' (self, iterable) -> numpy.ndarray
+        Returns the bit positions _positions gives, one row per item of items.
+        The hashes are reduced modulo the array size first, so the positions are
+        computed step by step without overflowing 64 bits.
+        '''
+        digests = _digests(items)
+        size = np.uint64(self.bit_array_size)
+        step = digests[:, 1] % size
+        positions = np.empty((len(digests), self.num_hash_fns), dtype=np.uint64)
+        position = digests[:, 0] % size
+        for i in range(self.num_hash_fns):
+            positions[:, i] = position
+            position = (position + step) % size
+        return positions
+
     def bit_array_size(self, num_items, probability):
         m = -(num_items * log(probability)) / (log(2)**2)
         return int(m)
 
-    def get_hash_count(self, bit_arr_size, num_items): 
-        return int((bit_arr_size/num_items) * log(2))
\ No newline at end of file
+    def get_hash_count(self, bit_arr_size, num_items):
+        return int((bit_arr_size/num_items) * log(2))
+
+class BlockedBloomFilter(BloomFilter):
+    '''
+    Bloom filter whose bits are split in 64 byte blocks, one cache line each. The
+    first hash picks the block of an item and all of its positions fall inside
+    it, so a lookup touches a single cache line. The price is a slightly higher
+    false positive rate than a plain BloomFilter of the same size.
+    '''
+    def __init__(self, num_items, false_positive_prob):
+        super().__init__(num_items, false_positive_prob)
+        self.num_blocks = max((self.bit_array_size + BLOCK_BITS - 1) // BLOCK_BITS, 1)
+        self.bit_array_size = self.num_blocks * BLOCK_BITS
+        self.bit_array = bytearray(self.bit_array_size // 8)
+
+    def _positions(self, item):
+        ''' (self, str) -> [int]
+        Returns the bit positions of item, all inside the block chosen by the
+        low half of its digest. The high half is split again for the double
+        hashing within the block.
+        '''
+        digest = hash128(item, signed=False)
+        base = (digest & UINT64_MASK) % self.num_blocks * BLOCK_BITS
+        # An odd step visits distinct bits of the block
+        h1, h2 = (digest >> 64) & 0xFFFFFFFF, (digest >> 96) | 1
+        return [base + (h1 + i * h2) % BLOCK_BITS for i in range(self.num_hash_fns)]
+
+    def _positions_many(self, items):
+        digests = _digests(items)
+        base = digests[:, 0] % np.uint64(self.num_blocks) * np.uint64(BLOCK_BITS)
+        h1, h2 = digests[:, 1] & np.uint64(0xFFFFFFFF), (digests[:, 1] >> np.uint64(32)) | np.uint64(1)
+        steps = np.arange(self.num_hash_fns, dtype=np.uint64)
+        return base[:, None] + (h1[:, None] + steps * h2[:, None]) % np.uint64(BLOCK_BITS)
+
+class PrefixBloomFilter(BloomFilter):
+    '''
+    Bloom filter over key prefixes, answering range and prefix queries. Every
+    key adds its prefix of each length in prefix_lengths, a key shorter than a
+    length adding itself. A query probes the prefixes a matching key would have
+    added, so a segment holding no key of a short range is ruled out without
+    being read, save for false positives.
+    '''
+    def __init__(self, num_items, false_positive_prob, prefix_lengths=(4, 8), max_probes=16):
+        prefix_lengths = sorted(set(prefix_lengths))
+        super().__init__(max(num_items * len(prefix_lengths), 1), false_positive_prob)
+        self.prefix_lengths = prefix_lengths
+        self.max_probes = max_probes
+
+    def add(self, key):
+        super().add_many(key[:length] for length in self.prefix_lengths)
+
+    def add_many(self, keys):
+        super().add_many(key[:length] for key in keys for length in self.prefix_lengths)
+
+    def check_prefix(self, prefix):
+        ''' (self, str) -> bool
+        Returns False if no key starting with prefix was added. Prefixes shorter
+        than every prefix length can't be ruled out.
+        '''
+        lengths = [length for length in self.prefix_lengths if length <= len(prefix)]
+        if not lengths:
+            return True
+        return self.check(prefix[:lengths[-1]])
+
+    def check_range(self, start, end):
+        ''' (self, str, str) -> bool
+        Returns False if no key with start <= key < end was added. The prefixes
+        of such keys lie between start's and end's, which are enumerated when
+        they only differ in their last character, by at most max_probes
+        characters. The longest prefix length allowing it is used, and ranges
+        no length allows can't be ruled out.
+        '''
+        if end is None:
+            return True
+        for length in reversed(self.prefix_lengths):
+            low, high = start[:length], end[:length]
+            if len(low) < length or len(high) < length or low[:-1] != high[:-1]:
+                continue
+            # Indexing bytes keys already gives the byte values
+            first, last = (low[-1], high[-1]) if isinstance(low, bytes) else (ord(low[-1]), ord(high[-1]))
+            if last - first >= self.max_probes:
+                continue
+            successor = (lambda char: bytes((char,))) if isinstance(low, bytes) else chr
+            return any(self.check(low[:-1] + successor(char)) for char in range(first, last + 1))
+        return True
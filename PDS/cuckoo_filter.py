@@ -1,105 +1,727 @@
-import random 
+import copy
+import random
 import math
+from array import array
+from mmh3 import hash128, hash_bytes
+
+import numpy as np
+
+# Multiplier spreading a fingerprint over the bucket index bits (MurmurHash2's)
+FINGERPRINT_MIX = 0x5bd1e995
+
+class FilterFullError(Exception):
+    '''
+    Raised when a fingerprint finds no room after max_kicks relocations. The
+    fingerprint left without a cell, which may belong to another item than the
+    one being added, is kept with one of its buckets so it can be stored
+    elsewhere.
+    '''
+    def __init__(self, fingerprint, index):
+        super().__init__('Filter is full')
+        self.fingerprint = fingerprint
+        self.index = index
+
+def _digests(items):
+    ''' (iterable) -> numpy.ndarray
+    Returns the 128 bit digests of items, one row of their low and high halves
+    per item, the digest hash128 gives.
+    '''
+    return np.frombuffer(b''.join([hash_bytes(item) for item in items]), dtype='<u8').reshape(-1, 2)
 
 class CuckooFilter:
     def __init__(self, item_num, fpp, max_kicks=500):
 
-        if fpp >= 0.002:
-            self.bucket_size = 2
-            self.capacity = int((item_num/0.84))
-        else:
-            self.bucket_size = 4
-            self.capacity = int((item_num/0.95))   
-
-        self.fingerprint_size = int(math.log((1/fpp), 2) + math.log((2*self.bucket_size), 2)+1)  #fingerprint_size
+        self.bucket_size, self.max_load, self.capacity, self.fingerprint_size = self.layout(item_num, fpp)
         self.max_kicks = max_kicks
-        self.buckets = [[] for _ in range(self.capacity)]
+        # The capacity is a power of two, so bucket indexes are masked hashes and the
+        # alternate bucket i ^ (mix(fingerprint) & mask) maps back to i
+        self._index_mask = self.capacity - 1
+        self._fingerprint_mask = (1 << self.fingerprint_size) - 1
+        self._random = random.Random()
+        # Flat table of capacity * bucket_size fixed width cells, bucket i holds the
+        # cells [i*bucket_size, (i+1)*bucket_size). A zero cell is empty.
+        typecode = self._typecode(self.fingerprint_size)
+        self.table = array(typecode, bytes(array(typecode).itemsize * self.capacity * self.bucket_size))
         self.size = 0
 
+    @classmethod
+    def layout(cls, item_num, fpp):
+        ''' (int, float) -> (int, float, int, int)
+        Returns the bucket size, target load, number of buckets and fingerprint
+        size of a filter for item_num items with false positive probability fpp.
+        '''
+        bucket_size, max_load = (2, 0.84) if fpp >= 0.002 else (4, 0.95)
+        capacity = cls._next_power_of_two(item_num/max_load)
+        fingerprint_size = int(math.log((1/fpp), 2) + math.log((2*bucket_size), 2)+1)
+        return bucket_size, max_load, capacity, fingerprint_size
+
+    @classmethod
+    def memory_bits(cls, item_num, fpp):
+        ''' (int, float) -> int
+        Returns the bits of the table of a filter for item_num items with false
+        positive probability fpp: every cell of every bucket takes the width of
+        the narrowest array type holding a fingerprint.
+        '''
+        bucket_size, _, capacity, fingerprint_size = cls.layout(item_num, fpp)
+        return capacity * bucket_size * array(cls._typecode(fingerprint_size)).itemsize * 8
+
     def add(self, item):
         self.size = self.size + 1
-        fingerprint = self._fingerprint(item)
-        i1, i2 = self._index_pair(item, fingerprint)
-        
-        if fingerprint in self.buckets[i1] or fingerprint in self.buckets[i2]:
-            return True
+        fingerprint, i1, i2 = self._hash(item)
 
-        if len(self.buckets[i1]) < self.bucket_size:
-            self.buckets[i1].append(fingerprint)
-            return True
-        
-        if len(self.buckets[i2]) < self.bucket_size:
-            self.buckets[i2].append(fingerprint)
+        # A fingerprint already in the buckets is stored again: it may belong to
+        # another item, which a delete of this one would otherwise remove
+        if self._insert(i1, fingerprint) or self._insert(i2, fingerprint):
             return True
-        
-        random_index = random.choice((i1, i2))
+
+        return self._kick(fingerprint, i1, i2)
+
+    def add_many(self, items):
+        ''' (self, iterable) -> None
+        Adds every item of items. The fingerprints and bucket pairs of the whole
+        batch are computed at once, then the fingerprints go to free cells of
+        their buckets with array operations. Only the ones finding both buckets
+        full go through the kick loop, once the rest of the batch is in.
+        '''
+        for fingerprint, i1, i2 in self._place_many(*self._locate_many(_digests(items))):
+            self._kick(fingerprint, i1, i2)
+
+    def _place_many(self, fingerprints, i1, i2):
+        ''' (self, ndarray, ndarray, ndarray) -> [(int, int, int)]
+        Stores every fingerprint in a free cell of its first bucket, or else of
+        its second, and returns the (fingerprint, i1, i2) of those finding both
+        full. A round stores at most one fingerprint per bucket, so fingerprints
+        of the batch sharing a bucket never take the same cell.
+        '''
+        self.size = self.size + len(fingerprints)
+        cells = np.asarray(self.table)
+        buckets = cells.reshape(-1, self.bucket_size)
+        stored = fingerprints.astype(cells.dtype)
+        pending = np.arange(len(fingerprints))
+        for targets in (i1, i2):
+            while len(pending):
+                free = buckets[targets[pending]] == 0
+                rows = np.flatnonzero(free.any(axis=1))
+                if not len(rows):
+                    break
+                # The first fingerprint of a bucket in the batch is stored, the others wait
+                _, first = np.unique(targets[pending[rows]], return_index=True)
+                rows = rows[first]
+                placed = pending[rows]
+                cells[targets[placed].astype(np.int64) * self.bucket_size + free[rows].argmax(axis=1)] = stored[placed]
+                pending = np.delete(pending, rows)
+        return list(zip(fingerprints[pending].tolist(), i1[pending].tolist(), i2[pending].tolist()))
+
+    def _kick(self, fingerprint, i1, i2):
+        ''' (self, int, int, int) -> bool
+        Makes room for fingerprint, whose buckets i1 and i2 are full, by
+        relocating the fingerprints in its way.
+        '''
+        random_index = self._random.choice((i1, i2))
         for _ in range(self.max_kicks):
-            fingerprint = self.swap(fingerprint, self.buckets[random_index])
-            random_index = (random_index ^ self._hash(fingerprint)) % self.capacity
-            
-            if len(self.buckets[random_index]) < self.bucket_size:
-                self.buckets[random_index].append(fingerprint)
+            fingerprint = self.swap(fingerprint, random_index)
+            random_index = self._alt_index(random_index, fingerprint)
+
+            if self._insert(random_index, fingerprint):
                 return True
         self.size = self.size - 1
-        raise Exception('Filter is full')
-        
-    def add_by_fp(self, fp, bucket_index):
+        raise FilterFullError(fingerprint, random_index)
+
+    def add_by_fp(self, fp, bucket_index, capacity=None):
+        ''' (self, int, int, int) -> bool
+        Stores fingerprint fp found in bucket bucket_index of a filter with the
+        given capacity, by default this filter's. A filter with a smaller power
+        of two capacity folds the bucket onto its own index bits, which keeps the
+        alternate bucket consistent, so fingerprints can move to smaller filters
+        but not to larger ones.
+        '''
+        if capacity is not None and capacity < self.capacity:
+            raise ValueError('Fingerprints of a smaller filter can\'t be placed in a larger one')
         self.size = self.size + 1
         fingerprint = fp
-        index = bucket_index
+        index = bucket_index & self._index_mask
 
-        if fingerprint in self.buckets[index]:
-            return True
-
-        if len(self.buckets[index]) < self.bucket_size:
-            self.buckets[index].append(fingerprint)
+        if self._insert(index, fingerprint):
             return True
 
         for _ in range(self.max_kicks):
-            fingerprint = self.swap(fingerprint, self.buckets[index])
-            index = (index ^ hash(fingerprint)) % self.capacity
+            fingerprint = self.swap(fingerprint, index)
+            index = self._alt_index(index, fingerprint)
 
-            if len(self.buckets[index]) < self.bucket_size:
-                self.buckets[index].append(fingerprint)
+            if self._insert(index, fingerprint):
                 return True
         self.size = self.size - 1
-        raise Exception('Filter is full')
+        raise FilterFullError(fingerprint, index)
 
     def check(self, item):
-        fingerprint = self._fingerprint(item)
-        i1, i2 = self._index_pair(item, fingerprint)
-        return (fingerprint in self.buckets[i1]) or (fingerprint in self.buckets[i2])
-    
+        fingerprint, i1, i2 = self._hash(item)
+        return self._find(i1, fingerprint) >= 0 or self._find(i2, fingerprint) >= 0
+
+    def check_many(self, items):
+        ''' (self, iterable) -> [bool]
+        Returns, for every item of items, whether it may be in the filter.
+        '''
+        return self._contains_many(*self._locate_many(_digests(items))).tolist()
+
+    def holding_capacity(self, item):
+        ''' (self, str) -> int
+        Returns the capacity of the filter if it may hold item, otherwise 0.
+        '''
+        return self.capacity if self.check(item) else 0
+
     def delete(self, item):
-        fingerprint = self._fingerprint(item)
-        i1, i2 = self._index_pair(item, fingerprint)
-        if (fingerprint in self.buckets[i1]):
-            self.buckets[i1].remove(fingerprint)
-            self.size = self.size - 1
-            return True
-        if (fingerprint in self.buckets[i2]):
-            self.buckets[i2].remove(fingerprint)
-            self.size = self.size - 1
-            return True
+        fingerprint, i1, i2 = self._hash(item)
+        for index in (i1, i2):
+            slot = self._find(index, fingerprint)
+            if slot >= 0:
+                self.table[slot] = 0
+                self.size = self.size - 1
+                return True
         return False
 
-    def swap(self, fingerprint, bucket):
-        item_index = random.choice(range(self.bucket_size))
-        fingerprint, bucket[item_index] = bucket[item_index], fingerprint
+    def merge(self, other):
+        ''' (self, CuckooFilter) -> [(int, int)]
+        Adds every fingerprint of other, a filter with the same bucket and
+        fingerprint sizes and a capacity not smaller than this one. Returns the
+        (fingerprint, bucket index) pairs that found no room, if any.
+
+        With the same capacity the union goes bucket by bucket: a fingerprint
+        of other takes the same cell here if it is free, else a free cell of the
+        same bucket, and only the rest goes through the kick loop. A larger
+        other is folded onto this filter's buckets.
+        '''
+        if not self._can_take(other):
+            raise ValueError('Cannot merge filters of different geometry')
+        homeless = []
+        if other.capacity > self.capacity:
+            pending = list(other.fingerprints())
+        else:
+            table, bucket_size = self.table, self.bucket_size
+            pending = []
+            for slot, fingerprint in enumerate(other.table):
+                if not fingerprint:
+                    continue
+                if not table[slot]:
+                    table[slot] = fingerprint
+                    self.size = self.size + 1
+                    continue
+                start = slot - slot % bucket_size
+                free = self._find(start // bucket_size, 0)
+                if free >= 0:
+                    table[free] = fingerprint
+                    self.size = self.size + 1
+                else:
+                    pending.append((start // bucket_size, fingerprint))
+
+        for index, fingerprint in pending:
+            try:
+                self.add_by_fp(fingerprint, index, other.capacity)
+            except FilterFullError as full:
+                homeless.append((full.fingerprint, full.index))
+        return homeless
+
+    def _can_take(self, other):
+        ''' (self, CuckooFilter) -> bool
+        Returns True if the fingerprints of other can be stored in this filter.
+        '''
+        return (other.fingerprint_size == self.fingerprint_size
+                and other.bucket_size == self.bucket_size
+                and other.capacity >= self.capacity)
+
+    def fold(self, capacity):
+        ''' (self, int) -> CuckooFilter
+        Returns a filter of the given smaller power of two capacity holding the
+        same fingerprints, or None if they don't fit in it.
+        '''
+        folded = self._empty_copy(capacity)
+        try:
+            for index, fingerprint in self.fingerprints():
+                folded.add_by_fp(fingerprint, index)
+        except FilterFullError:
+            return None
+        return folded
+
+    def _empty_copy(self, capacity):
+        ''' (self, int) -> CuckooFilter
+        Returns an empty filter like this one, but of the given power of two capacity.
+        '''
+        ckf = copy.copy(self)
+        ckf.capacity = capacity
+        ckf._index_mask = capacity - 1
+        typecode = self._typecode(self.fingerprint_size)
+        ckf.table = array(typecode, bytes(array(typecode).itemsize * capacity * self.bucket_size))
+        ckf._random = random.Random()
+        ckf.size = 0
+        return ckf
+
+    def fingerprints(self):
+        ''' (self) -> generator
+        Yields the (bucket index, fingerprint) of every stored fingerprint.
+        '''
+        bucket_size = self.bucket_size
+        for slot, fingerprint in enumerate(self.table):
+            if fingerprint:
+                yield slot // bucket_size, fingerprint
+
+    def swap(self, fingerprint, index):
+        slot = index * self.bucket_size + self._random.randrange(self.bucket_size)
+        fingerprint, self.table[slot] = self.table[slot], fingerprint
         return fingerprint
-    
-    def _index_pair(self, item, fingerprint):
-        i1 = self._hash(item)
-        i2 = (i1 ^ self._hash(fingerprint)) % self.capacity
-        return i1, i2
-    
+
+    def _find(self, index, fingerprint):
+        ''' (self, int, int) -> int
+        Returns the cell of bucket index holding fingerprint, or -1.
+        Looking for fingerprint 0 finds an empty cell.
+        '''
+        start = index * self.bucket_size
+        for slot in range(start, start + self.bucket_size):
+            if self.table[slot] == fingerprint:
+                return slot
+        return -1
+
+    def _insert(self, index, fingerprint):
+        ''' (self, int, int) -> bool
+        Stores fingerprint in an empty cell of bucket index, if there is one.
+        '''
+        slot = self._find(index, 0)
+        if slot < 0:
+            return False
+        self.table[slot] = fingerprint
+        return True
+
+    def _alt_index(self, index, fingerprint):
+        ''' (self, int, int) -> int
+        Returns the other bucket of a fingerprint stored in bucket index.
+        '''
+        return index ^ ((fingerprint * FINGERPRINT_MIX) & self._index_mask)
+
+    def _locate_many(self, digests):
+        ''' (self, ndarray) -> (ndarray, ndarray, ndarray)
+        Returns the fingerprints and bucket pairs of the items hashed to the
+        rows of digests, as _locate computes them for one item.
+        '''
+        index_mask = np.uint64(self._index_mask)
+        fingerprints = digests[:, 1] & np.uint64(self._fingerprint_mask)
+        # Zero marks an empty cell, so it is never used as a fingerprint
+        fingerprints[fingerprints == 0] = 1
+        i1 = digests[:, 0] & index_mask
+        return fingerprints, i1, i1 ^ ((fingerprints * np.uint64(FINGERPRINT_MIX)) & index_mask)
+
     def _hash(self, item):
-        index = hash(item) % self.capacity
-        return index
-    
-    def _fingerprint(self, item):
-        random.seed(hash(item))
-        return random.getrandbits(self.fingerprint_size)
-    
+        ''' (self, str) -> (int, int, int)
+        Returns the fingerprint and bucket pair of item, all taken from a single
+        128 bit digest: the low half gives the first bucket, the high half the
+        fingerprint.
+        '''
+        return self._locate(hash128(item, signed=False))
+
+    def _locate(self, digest):
+        ''' (self, int) -> (int, int, int)
+        Returns the fingerprint and bucket pair of the item hashed to digest.
+        '''
+        # Zero marks an empty cell, so it is never used as a fingerprint
+        fingerprint = (digest >> 64) & self._fingerprint_mask or 1
+        i1 = digest & self._index_mask
+        return fingerprint, i1, self._alt_index(i1, fingerprint)
+
+    def _contains(self, fingerprint, i1, i2):
+        return self._find(i1, fingerprint) >= 0 or self._find(i2, fingerprint) >= 0
+
+    def _contains_many(self, fingerprints, i1, i2):
+        ''' (self, ndarray, ndarray, ndarray) -> ndarray
+        Returns, for every fingerprint, whether one of its buckets holds it.
+        '''
+        buckets = np.asarray(self.table).reshape(-1, self.bucket_size)
+        fingerprints = fingerprints.astype(buckets.dtype)[:, None]
+        return (buckets[i1] == fingerprints).any(axis=1) | (buckets[i2] == fingerprints).any(axis=1)
+
+    @staticmethod
+    def _next_power_of_two(num):
+        ''' (float) -> int
+        Returns the smallest power of two not below num.
+        '''
+        return 1 << max(math.ceil(num) - 1, 0).bit_length()
+
+    @staticmethod
+    def _typecode(fingerprint_size):
+        ''' (int) -> str
+        Returns the narrowest array typecode holding fingerprint_size bits.
+        '''
+        for typecode in ('B', 'H', 'I', 'L', 'Q'):
+            if array(typecode).itemsize * 8 >= fingerprint_size:
+                return typecode
+        raise ValueError('Fingerprints of {} bits are not supported'.format(fingerprint_size))
+
     def load_factor(self):
-        return self.size / (self.capacity * self.bucket_size)
\ No newline at end of file
+        return self.size / (self.capacity * self.bucket_size)
+
+class ScalableCuckooFilter:
+    '''
+    Cuckoo filter that grows instead of failing. Items go to the largest of a
+    chain of CuckooFilters, and a new one of twice the capacity is chained once
+    the largest reaches its maximum load. A lookup probes every filter of the
+    chain, which stays short since capacities double.
+
+    Every filter computes its fingerprints from the same digest of an item, so
+    a fingerprint can move to any filter of the same fingerprint size whose
+    capacity is not larger than the one it comes from. This is how a
+    fingerprint evicted out of a full filter is stored, how shrink folds
+    filters left mostly empty by deletes, and how merge unions two chains.
+
+    The chain is kept ordered by capacity, the largest filter last. A delete
+    removes the matching fingerprint of the largest filter holding one: a
+    fingerprint of another item only matches if it also shares the item's
+    bucket index bits, which are more numerous in a larger filter, so a match
+    there is the least likely to belong to another item.
+    '''
+    def __init__(self, item_num, fpp, max_kicks=500, growth=2):
+        self.fpp = fpp
+        self.max_kicks = max_kicks
+        self.growth = growth
+        self.filters = [CuckooFilter(item_num, fpp, max_kicks)]
+
+    @property
+    def size(self):
+        return sum(ckf.size for ckf in self.filters)
+
+    @property
+    def capacity(self):
+        return max(ckf.capacity for ckf in self.filters)
+
+    def add(self, item):
+        digest = hash128(item, signed=False)
+        largest = self.filters[-1]
+        if largest.load_factor() >= largest.max_load:
+            largest = self._grow(largest.capacity * self.growth)
+        fingerprint, i1, i2 = largest._locate(digest)
+        largest.size = largest.size + 1
+        if largest._insert(i1, fingerprint) or largest._insert(i2, fingerprint):
+            return True
+        try:
+            return largest._kick(fingerprint, i1, i2)
+        except FilterFullError as full:
+            return self.add_by_fp(full.fingerprint, full.index, largest)
+
+    def add_many(self, items):
+        ''' (self, iterable) -> None
+        Adds every item of items. The batch is hashed at once and goes to the
+        largest filter as CuckooFilter.add_many does, as much of it at a time as
+        the filter takes before its maximum load, the rest to the next filter
+        chained.
+        '''
+        digests = _digests(items)
+        while len(digests):
+            largest = self.filters[-1]
+            if largest.load_factor() >= largest.max_load:
+                largest = self._grow(largest.capacity * self.growth)
+            room = math.ceil(largest.max_load * largest.capacity * largest.bucket_size) - largest.size
+            batch, digests = digests[:room], digests[room:]
+            for fingerprint, i1, i2 in largest._place_many(*largest._locate_many(batch)):
+                try:
+                    largest._kick(fingerprint, i1, i2)
+                except FilterFullError as full:
+                    self.add_by_fp(full.fingerprint, full.index, largest)
+
+    def add_by_fp(self, fp, bucket_index, source):
+        ''' (self, int, int, CuckooFilter) -> bool
+        Stores fingerprint fp found in bucket bucket_index of the filter source,
+        in the largest filter able to take it, where a delete looks first. If
+        none has room, a filter like source is chained for it.
+        '''
+        for ckf in reversed(self.filters):
+            if not ckf._can_take(source):
+                continue
+            try:
+                return ckf.add_by_fp(fp, bucket_index)
+            except FilterFullError as full:
+                fp, bucket_index, source = full.fingerprint, full.index, ckf
+        return self._grow(source.capacity, source).add_by_fp(fp, bucket_index)
+
+    def merge(self, other):
+        ''' (self, ScalableCuckooFilter) -> None
+        Adds every fingerprint of other, whose filters are taken over, so other
+        must not be used afterwards. Each filter of other is merged into a
+        filter of this chain that can take it without going over its maximum
+        load, and is chained as it is otherwise, in its place by capacity,
+        which needs no rehashing even when the capacities differ.
+        '''
+        for incoming in other.filters:
+            for ckf in reversed(self.filters):
+                if (ckf._can_take(incoming)
+                        and ckf.size + incoming.size <= ckf.max_load * ckf.capacity * ckf.bucket_size):
+                    for fingerprint, index in ckf.merge(incoming):
+                        self.add_by_fp(fingerprint, index, ckf)
+                    break
+            else:
+                self._chain(incoming)
+
+    def check(self, item):
+        return self._contains(hash128(item, signed=False))
+
+    def check_many(self, items):
+        ''' (self, iterable) -> [bool]
+        Returns, for every item of items, whether it may be in the filter.
+        '''
+        digests = _digests(items)
+        found = np.zeros(len(digests), dtype=bool)
+        for ckf in self.filters:
+            found |= ckf._contains_many(*ckf._locate_many(digests))
+        return found.tolist()
+
+    def holding_capacity(self, item):
+        ''' (self, str) -> int
+        Returns the capacity of the largest filter of the chain that may hold
+        item, or 0 if none may.
+        '''
+        digest = hash128(item, signed=False)
+        for ckf in reversed(self.filters):
+            if ckf._contains(*ckf._locate(digest)):
+                return ckf.capacity
+        return 0
+
+    def delete(self, item):
+        ''' (self, str) -> bool
+        Removes a fingerprint of item, looking from the largest filter of the
+        chain down, and returns whether one was found.
+        '''
+        digest = hash128(item, signed=False)
+        for ckf in reversed(self.filters):
+            fingerprint, i1, i2 = ckf._locate(digest)
+            for index in (i1, i2):
+                slot = ckf._find(index, fingerprint)
+                if slot >= 0:
+                    ckf.table[slot] = 0
+                    ckf.size = ckf.size - 1
+                    return True
+        return False
+
+    def shrink(self):
+        ''' (self) -> None
+        Gives back the memory of deleted items: empty filters leave the chain
+        and every filter is folded to the smallest power of two capacity that
+        keeps it at half its maximum load.
+        '''
+        self.filters = [ckf for ckf in self.filters if ckf.size] or self.filters[:1]
+        for position, ckf in enumerate(self.filters):
+            capacity = ckf._next_power_of_two(2 * ckf.size / (ckf.max_load * ckf.bucket_size))
+            while capacity < ckf.capacity:
+                folded = ckf.fold(capacity)
+                if folded is not None:
+                    self.filters[position] = folded
+                    break
+                capacity *= 2
+        self.filters.sort(key=lambda ckf: ckf.capacity)
+
+    def fingerprints(self):
+        ''' (self) -> generator
+        Yields the (bucket index, fingerprint, capacity) of every stored
+        fingerprint, capacity being the one of the filter holding it.
+        '''
+        for ckf in self.filters:
+            for index, fingerprint in ckf.fingerprints():
+                yield index, fingerprint, ckf.capacity
+
+    def load_factor(self):
+        return self.size / sum(ckf.capacity * ckf.bucket_size for ckf in self.filters)
+
+    def _contains(self, digest):
+        for ckf in self.filters:
+            if ckf._contains(*ckf._locate(digest)):
+                return True
+        return False
+
+    def _grow(self, capacity, template=None):
+        ''' (self, int, CuckooFilter) -> CuckooFilter
+        Chains a new, empty filter of the given capacity, otherwise like
+        template or the largest filter, and returns it.
+        '''
+        ckf = (template or self.filters[-1])._empty_copy(capacity)
+        self._chain(ckf)
+        return ckf
+
+    def _chain(self, ckf):
+        ''' (self, CuckooFilter) -> None
+        Adds ckf to the chain, after every filter not larger than it.
+        '''
+        position = len(self.filters)
+        while position and self.filters[position - 1].capacity > ckf.capacity:
+            position -= 1
+        self.filters.insert(position, ckf)
+
+class AdaptiveCuckooFilter(CuckooFilter):
+    '''
+    Cuckoo filter that stops repeating its false positives (Mitzenmacher et al.,
+    Adaptive Cuckoo Filters). Every cell has a selector choosing which of
+    num_selectors hash functions gave its fingerprint. Once a lookup proves a
+    hit false, adapt moves the colliding cell to the next selector, so the same
+    item no longer matches it.
+
+    Every cell also keeps the tag of the item it was stored for, the top bits
+    of its digest, from which the fingerprints of selectors other than 0 are
+    derived. A cell is thus adapted without looking up its owner among the
+    keys the filter was built from.
+
+    Tags are as wide as the table cells and selectors take 2 bits, so a cell
+    costs twice its width plus 2 bits: 18 bits for fingerprints of up to 8
+    bits. The price of such short tags is that a false positive sharing the
+    tag of the item it collides with, one in 2**width of them, can't be
+    adapted away.
+
+    The alternate bucket of a fingerprint is derived from its selector 0 value,
+    so cells holding an adapted fingerprint are never kicked out. These filters
+    are meant to be built once from a segment's keys, not grown or merged.
+    '''
+    def __init__(self, item_num, fpp, max_kicks=500, num_selectors=4):
+        if not 2 <= num_selectors <= 4:
+            raise ValueError('Selectors are stored in 2 bits, so 2 to 4 of them are supported')
+        super().__init__(item_num, fpp, max_kicks)
+        self.num_selectors = num_selectors
+        self.selectors = bytearray(self._selector_bytes(self.capacity * self.bucket_size))
+        typecode = self._typecode(self.fingerprint_size)
+        self.owners = array(typecode, bytes(array(typecode).itemsize * self.capacity * self.bucket_size))
+
+    @classmethod
+    def memory_bits(cls, item_num, fpp):
+        # An owner tag as wide as a cell and 2 bits of selector per cell on top of the table
+        bucket_size, _, capacity, _ = cls.layout(item_num, fpp)
+        return 2 * super().memory_bits(item_num, fpp) + cls._selector_bytes(capacity * bucket_size) * 8
+
+    @staticmethod
+    def _selector_bytes(cells):
+        ''' (int) -> int
+        Returns the bytes holding the 2 bit selectors of cells cells.
+        '''
+        return (cells + 3) // 4
+
+    def add(self, item):
+        self.size = self.size + 1
+        digest = hash128(item, signed=False)
+        fingerprint, i1, i2 = self._locate(digest)
+        tag = self._tag(digest)
+        if self._place(i1, fingerprint, tag) or self._place(i2, fingerprint, tag):
+            return True
+        return self._kick(fingerprint, i1, i2, tag)
+
+    def add_many(self, items):
+        ''' (self, iterable) -> None
+        Adds every item of items.
+        '''
+        for item in items:
+            self.add(item)
+
+    def check(self, item):
+        digest = hash128(item, signed=False)
+        return next(self._matching_slots(digest), -1) >= 0
+
+    def check_many(self, items):
+        ''' (self, iterable) -> [bool]
+        Returns, for every item of items, whether it may be in the filter.
+        '''
+        return [self.check(item) for item in items]
+
+    def delete(self, item):
+        digest = hash128(item, signed=False)
+        slots = list(self._matching_slots(digest))
+        if not slots:
+            return False
+        # The cell stored for item goes rather than one of another item it matches
+        tag = self._tag(digest)
+        slot = next((slot for slot in slots if self.owners[slot] == tag), slots[0])
+        self.table[slot] = 0
+        self._set_selector(slot, 0)
+        self.size = self.size - 1
+        return True
+
+    def adapt(self, item):
+        ''' (self, str) -> int
+        Removes the false positive item: every cell matching it switches to the
+        next selector, its fingerprint recomputed from the tag of its owner.
+        Returns the number of cells that were adapted.
+        '''
+        slots = list(self._matching_slots(hash128(item, signed=False)))
+        for slot in slots:
+            # Selector 0 comes from bits the tag doesn't hold, so it is never returned to
+            selector = self._selector(slot) % (self.num_selectors - 1) + 1
+            self._set_selector(slot, selector)
+            self.table[slot] = self._tag_fingerprint(self.owners[slot], selector)
+        return len(slots)
+
+    def _matching_slots(self, digest):
+        ''' (self, int) -> generator
+        Yields the cells of the buckets of the item hashed to digest whose
+        fingerprint, under their own selector, is the item's.
+        '''
+        fingerprint, i1, i2 = self._locate(digest)
+        table, bucket_size, tag = self.table, self.bucket_size, self._tag(digest)
+        for index in (i1, i2):
+            for slot in range(index * bucket_size, (index + 1) * bucket_size):
+                stored = table[slot]
+                if not stored:
+                    continue
+                selector = self._selector(slot)
+                if stored == (self._tag_fingerprint(tag, selector) if selector else fingerprint):
+                    yield slot
+
+    def _tag(self, digest):
+        ''' (self, int) -> int
+        Returns the owner tag of the item hashed to digest, the top bits of the
+        digest, as many as a table cell holds.
+        '''
+        return digest >> (128 - self.table.itemsize * 8)
+
+    def _tag_fingerprint(self, tag, selector):
+        ''' (self, int, int) -> int
+        Returns the fingerprint under selector, other than 0, of the item with
+        the owner tag tag. Selector 0 is the fingerprint of CuckooFilter.
+        '''
+        mixed = ((tag ^ (selector * 0x9e3779b97f4a7c15)) * 0xff51afd7ed558ccd) & 0xffffffffffffffff
+        # Zero marks an empty cell, so it is never used as a fingerprint
+        return (mixed >> (64 - self.fingerprint_size)) & self._fingerprint_mask or 1
+
+    def _selector(self, slot):
+        return (self.selectors[slot >> 2] >> ((slot & 3) << 1)) & 3
+
+    def _set_selector(self, slot, selector):
+        shift = (slot & 3) << 1
+        self.selectors[slot >> 2] = (self.selectors[slot >> 2] & ~(3 << shift)) | (selector << shift)
+
+    def _place(self, index, fingerprint, tag):
+        ''' (self, int, int, int) -> bool
+        Stores fingerprint, of the item tagged tag, in an empty cell of bucket
+        index, if there is one.
+        '''
+        slot = self._find(index, 0)
+        if slot < 0:
+            return False
+        self.table[slot] = fingerprint
+        self.owners[slot] = tag
+        return True
+
+    def _kick(self, fingerprint, i1, i2, tag=0):
+        ''' (self, int, int, int, int) -> bool
+        Like CuckooFilter._kick, relocating only fingerprints under selector 0,
+        along with their owner tag.
+        '''
+        bucket_size = self.bucket_size
+        index = self._random.choice((i1, i2))
+        for _ in range(self.max_kicks):
+            movable = [slot for slot in range(index * bucket_size, (index + 1) * bucket_size)
+                       if not self._selector(slot)]
+            if not movable:
+                break
+            slot = self._random.choice(movable)
+            fingerprint, self.table[slot] = self.table[slot], fingerprint
+            tag, self.owners[slot] = self.owners[slot], tag
+            index = self._alt_index(index, fingerprint)
+
+            if self._place(index, fingerprint, tag):
+                return True
+        self.size = self.size - 1
+        raise FilterFullError(fingerprint, index)
+
+    def _empty_copy(self, capacity):
+        ckf = super()._empty_copy(capacity)
+        ckf.selectors = bytearray(self._selector_bytes(capacity * self.bucket_size))
+        typecode = self._typecode(self.fingerprint_size)
+        ckf.owners = array(typecode, bytes(array(typecode).itemsize * capacity * self.bucket_size))
+        return ckf
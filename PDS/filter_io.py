@@ -0,0 +1,208 @@
+"""
+Binary file format of the filters, replacing their pickles.
+
+A file starts with a header: the magic bytes, the format version and the kind
+of filter. The parameters of the filter follow, and then its raw table, padded
+to 8 bytes so it can be cast in place. A ScalableCuckooFilter stores the
+parameters and table of each of its CuckooFilters one after the other, an
+AdaptiveCuckooFilter its packed selectors and owner tags after its table, and a
+PrefixBloomFilter its prefix lengths before its bits.
+
+load_filter maps the file copy-on-write and casts the tables into the mapping
+instead of reading them, so loading costs the same whatever the size of the
+filter, pages being read on first probe. Changes to a loaded filter stay in
+memory until it is saved again.
+"""
+import mmap
+import os
+import random
+import struct
+from array import array
+
+from PDS.bloom_filter import BloomFilter, BlockedBloomFilter, PrefixBloomFilter
+from PDS.cuckoo_filter import CuckooFilter, ScalableCuckooFilter, AdaptiveCuckooFilter
+from PDS.xor_filter import XorFilter
+
+MAGIC = b'LSMF'
+VERSION = 3
+ALIGNMENT = 8
+
+# Filter kinds
+CUCKOO = 1
+SCALABLE_CUCKOO = 2
+XOR = 3
+BLOOM = 4
+BLOCKED_BLOOM = 5
+ADAPTIVE_CUCKOO = 6
+PREFIX_BLOOM = 7
+
+HEADER = struct.Struct('<4sHB')
+CUCKOO_PARAMS = struct.Struct('<BBIdQQ')        # bucket size, fingerprint size, max kicks, max load, capacity, size
+SCALABLE_PARAMS = struct.Struct('<dIII')        # fpp, max kicks, growth, number of filters
+ADAPTIVE_PARAMS = struct.Struct('<B')          # number of selectors
+XOR_PARAMS = struct.Struct('<BIQQ')             # fingerprint size, seed, block length, size
+BLOOM_PARAMS = struct.Struct('<dQIQ')           # false positive prob, bit array size, hash functions, blocks
+PREFIX_PARAMS = struct.Struct('<IB')            # max probes, number of prefix lengths, followed by the lengths
+
+class FilterFormatError(Exception):
+    pass
+
+def write_filter(flt, stream):
+    ''' (object, file) -> None
+    Writes flt, a cuckoo, scalable cuckoo, xor, bloom or prefix bloom filter,
+    to the binary stream.
+    '''
+    writer = _Writer(stream)
+    if isinstance(flt, ScalableCuckooFilter):
+        writer.write(HEADER.pack(MAGIC, VERSION, SCALABLE_CUCKOO))
+        writer.write(SCALABLE_PARAMS.pack(flt.fpp, flt.max_kicks, flt.growth, len(flt.filters)))
+        for ckf in flt.filters:
+            _write_cuckoo(writer, ckf)
+    elif isinstance(flt, AdaptiveCuckooFilter):
+        writer.write(HEADER.pack(MAGIC, VERSION, ADAPTIVE_CUCKOO))
+        _write_cuckoo(writer, flt)
+        writer.write(ADAPTIVE_PARAMS.pack(flt.num_selectors))
+        writer.write_table(flt.selectors)
+        writer.write_table(flt.owners)
+    elif isinstance(flt, CuckooFilter):
+        writer.write(HEADER.pack(MAGIC, VERSION, CUCKOO))
+        _write_cuckoo(writer, flt)
+    elif isinstance(flt, XorFilter):
+        writer.write(HEADER.pack(MAGIC, VERSION, XOR))
+        writer.write(XOR_PARAMS.pack(flt.fingerprint_size, flt.seed, flt.block_length, flt.size))
+        writer.write_table(flt.table)
+    elif isinstance(flt, PrefixBloomFilter):
+        writer.write(HEADER.pack(MAGIC, VERSION, PREFIX_BLOOM))
+        writer.write(BLOOM_PARAMS.pack(flt.false_positive_prob, flt.bit_array_size, flt.num_hash_fns, 0))
+        writer.write(PREFIX_PARAMS.pack(flt.max_probes, len(flt.prefix_lengths)))
+        writer.write(struct.pack('<{}I'.format(len(flt.prefix_lengths)), *flt.prefix_lengths))
+        writer.write_table(flt.bit_array)
+    elif isinstance(flt, BloomFilter):
+        blocked = isinstance(flt, BlockedBloomFilter)
+        writer.write(HEADER.pack(MAGIC, VERSION, BLOCKED_BLOOM if blocked else BLOOM))
+        writer.write(BLOOM_PARAMS.pack(flt.false_positive_prob, flt.bit_array_size, flt.num_hash_fns,
+                                       flt.num_blocks if blocked else 0))
+        writer.write_table(flt.bit_array)
+    else:
+        raise TypeError('Cannot write a filter of type {}'.format(type(flt).__name__))
+
+def save_filter(flt, path):
+    ''' (object, str) -> None
+    Writes flt to the file at path. The file is written aside and renamed over
+    path, so a mapping of the previous file is never truncated under a reader.
+    '''
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as stream:
+        write_filter(flt, stream)
+    os.replace(temp_path, path)
+
+def load_filter(path):
+    ''' (str) -> object
+    Returns the filter stored in the file at path, its tables backed by a
+    copy-on-write mapping of the file.
+    '''
+    with open(path, 'rb') as stream:
+        if os.fstat(stream.fileno()).st_size == 0:
+            raise FilterFormatError('{} is empty'.format(path))
+        buffer = memoryview(mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_COPY))
+
+    reader = _Reader(buffer)
+    magic, version, kind = reader.read(HEADER)
+    if magic != MAGIC:
+        raise FilterFormatError('{} is not a filter file'.format(path))
+    if version != VERSION:
+        raise FilterFormatError('{} has format version {}, not {}'.format(path, version, VERSION))
+
+    if kind == CUCKOO:
+        return _read_cuckoo(reader)
+    if kind == ADAPTIVE_CUCKOO:
+        flt = _read_cuckoo(reader, AdaptiveCuckooFilter)
+        flt.num_selectors, = reader.read(ADAPTIVE_PARAMS)
+        flt.selectors = reader.read_table('B', flt._selector_bytes(flt.capacity * flt.bucket_size))
+        flt.owners = reader.read_table(flt._typecode(flt.fingerprint_size), flt.capacity * flt.bucket_size)
+        return flt
+    if kind == SCALABLE_CUCKOO:
+        flt = ScalableCuckooFilter.__new__(ScalableCuckooFilter)
+        flt.fpp, flt.max_kicks, flt.growth, count = reader.read(SCALABLE_PARAMS)
+        flt.filters = [_read_cuckoo(reader) for _ in range(count)]
+        return flt
+    if kind == XOR:
+        flt = XorFilter.__new__(XorFilter)
+        flt.fingerprint_size, flt.seed, flt.block_length, flt.size = reader.read(XOR_PARAMS)
+        flt._fingerprint_mask = (1 << flt.fingerprint_size) - 1
+        flt.capacity = 3 * flt.block_length
+        flt.table = reader.read_table(flt._typecode(flt.fingerprint_size), flt.capacity)
+        return flt
+    if kind == PREFIX_BLOOM:
+        flt = PrefixBloomFilter.__new__(PrefixBloomFilter)
+        flt.false_positive_prob, flt.bit_array_size, flt.num_hash_fns, _ = reader.read(BLOOM_PARAMS)
+        flt.max_probes, count = reader.read(PREFIX_PARAMS)
+        flt.prefix_lengths = list(reader.read(struct.Struct('<{}I'.format(count))))
+        flt.bit_array = reader.read_table('B', (flt.bit_array_size + 7) // 8)
+        return flt
+    if kind in (BLOOM, BLOCKED_BLOOM):
+        cls = BlockedBloomFilter if kind == BLOCKED_BLOOM else BloomFilter
+        flt = cls.__new__(cls)
+        flt.false_positive_prob, flt.bit_array_size, flt.num_hash_fns, num_blocks = reader.read(BLOOM_PARAMS)
+        if kind == BLOCKED_BLOOM:
+            flt.num_blocks = num_blocks
+        flt.bit_array = reader.read_table('B', (flt.bit_array_size + 7) // 8)
+        return flt
+    raise FilterFormatError('{} holds an unknown filter kind {}'.format(path, kind))
+
+def _write_cuckoo(writer, ckf):
+    writer.write(CUCKOO_PARAMS.pack(ckf.bucket_size, ckf.fingerprint_size, ckf.max_kicks,
+                                    ckf.max_load, ckf.capacity, ckf.size))
+    writer.write_table(ckf.table)
+
+def _read_cuckoo(reader, cls=CuckooFilter):
+    ckf = cls.__new__(cls)
+    (ckf.bucket_size, ckf.fingerprint_size, ckf.max_kicks,
+     ckf.max_load, ckf.capacity, ckf.size) = reader.read(CUCKOO_PARAMS)
+    ckf._index_mask = ckf.capacity - 1
+    ckf._fingerprint_mask = (1 << ckf.fingerprint_size) - 1
+    ckf._random = random.Random()
+    ckf.table = reader.read_table(ckf._typecode(ckf.fingerprint_size), ckf.capacity * ckf.bucket_size)
+    return ckf
+
+class _Writer:
+    def __init__(self, stream):
+        self.stream = stream
+        self.offset = 0
+
+    def write(self, data):
+        self.stream.write(data)
+        self.offset += len(data)
+
+    def write_table(self, table):
+        ''' (self, buffer) -> None
+        Writes the raw bytes of table, preceded by the padding aligning them.
+        '''
+        self.write(bytes(-self.offset % ALIGNMENT))
+        self.write(memoryview(table).cast('B'))
+
+class _Reader:
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.offset = 0
+
+    def read(self, params):
+        ''' (self, struct.Struct) -> tuple
+        Unpacks params at the current offset.
+        '''
+        values = params.unpack_from(self.buffer, self.offset)
+        self.offset += params.size
+        return values
+
+    def read_table(self, typecode, length):
+        ''' (self, str, int) -> memoryview
+        Returns the length items table of the given array typecode at the
+        current offset, cast in place.
+        '''
+        self.offset += -self.offset % ALIGNMENT
+        size = array(typecode).itemsize * length
+        if self.offset + size > len(self.buffer):
+            raise FilterFormatError('The filter file is truncated')
+        table = self.buffer[self.offset:self.offset + size].cast(typecode)
+        self.offset += size
+        return table
@@ -0,0 +1,132 @@
+import math
+from array import array
+from mmh3 import hash128
+
+UINT32_MASK = (1 << 32) - 1
+
+class XorBuildError(Exception):
+    '''
+    Raised when no seed out of max_attempts lets every key of a xor filter be
+    peeled off its table.
+    '''
+    def __init__(self, attempts):
+        super().__init__('Could not build the xor filter in {} attempts'.format(attempts))
+        self.attempts = attempts
+
+class XorFilter:
+    '''
+    Static filter built once from a full key set (Graf and Lemire's xor filter).
+    Every key maps to one cell in each third of the table, and the fingerprint
+    of a key is the xor of its three cells. It takes 1.23 cells per key, a cell
+    being the narrowest of 8, 16, 32 or 64 bits holding a log2(1/fpp) bit
+    fingerprint, so about 9.8 bits per key for any fpp down to 1/256. It can't
+    take new keys nor delete them, which suits segments that are only
+    rewritten by merges.
+    '''
+    def __init__(self, keys, fpp, max_attempts=100):
+        keys = list(dict.fromkeys(keys))
+        self.size = len(keys)
+        self.fingerprint_size = max(math.ceil(math.log((1/fpp), 2)), 1)
+        self._fingerprint_mask = (1 << self.fingerprint_size) - 1
+        self.block_length = (32 + math.ceil(1.23 * self.size)) // 3
+        self.capacity = 3 * self.block_length
+        typecode = self._typecode(self.fingerprint_size)
+
+        for seed in range(max_attempts):
+            self.seed = seed
+            hashes = [self._hash(key) for key in keys]
+            order = self._peel(hashes)
+            if order is not None:
+                break
+        else:
+            raise XorBuildError(max_attempts)
+
+        table = array(typecode, bytes(array(typecode).itemsize * self.capacity))
+        # Keys are assigned in the reverse order they were peeled, so the cell of a
+        # key is still free when it gets the value matching its fingerprint
+        for key_index, cell in reversed(order):
+            fingerprint, h0, h1, h2 = hashes[key_index]
+            table[cell] = fingerprint ^ table[h0] ^ table[h1] ^ table[h2]
+        self.table = table
+
+    @classmethod
+    def memory_bits(cls, item_num, fpp):
+        ''' (int, float) -> int
+        Returns the bits of the table of a filter for item_num keys with false
+        positive probability fpp.
+        '''
+        fingerprint_size = max(math.ceil(math.log((1/fpp), 2)), 1)
+        capacity = 3 * ((32 + math.ceil(1.23 * item_num)) // 3)
+        return capacity * array(cls._typecode(fingerprint_size)).itemsize * 8
+
+    def check(self, item):
+        fingerprint, h0, h1, h2 = self._hash(item)
+        table = self.table
+        return fingerprint == table[h0] ^ table[h1] ^ table[h2]
+
+    def check_many(self, items):
+        ''' (self, iterable) -> [bool]
+        Returns, for every item of items, whether it may be in the filter.
+        '''
+        table = self.table
+        results = []
+        for item in items:
+            fingerprint, h0, h1, h2 = self._hash(item)
+            results.append(fingerprint == table[h0] ^ table[h1] ^ table[h2])
+        return results
+
+    def _peel(self, hashes):
+        ''' (self, list) -> [(int, int)]
+        Repeatedly removes a key owning a cell no other key maps to. Returns the
+        (key index, cell) pairs in removal order, or None if some keys are left,
+        in which case another seed is needed.
+        '''
+        counts = [0] * self.capacity
+        # The xor of the indexes of the keys mapped to each cell, which is the index
+        # of the only key left once a cell's count drops to one
+        owners = [0] * self.capacity
+        for key_index, (_, h0, h1, h2) in enumerate(hashes):
+            for cell in (h0, h1, h2):
+                counts[cell] += 1
+                owners[cell] ^= key_index
+
+        queue = [cell for cell in range(self.capacity) if counts[cell] == 1]
+        order = []
+        while queue:
+            cell = queue.pop()
+            if counts[cell] != 1:
+                continue
+            key_index = owners[cell]
+            order.append((key_index, cell))
+            for other in hashes[key_index][1:]:
+                counts[other] -= 1
+                owners[other] ^= key_index
+                if counts[other] == 1:
+                    queue.append(other)
+
+        return order if len(order) == len(hashes) else None
+
+    def _hash(self, item):
+        ''' (self, str) -> (int, int, int, int)
+        Returns the fingerprint of item and its cell in each third of the table,
+        all taken from a single 128 bit digest.
+        '''
+        digest = hash128(item, self.seed, signed=False)
+        block_length = self.block_length
+        return ((digest >> 96) & self._fingerprint_mask,
+                (digest & UINT32_MASK) % block_length,
+                block_length + ((digest >> 32) & UINT32_MASK) % block_length,
+                2 * block_length + ((digest >> 64) & UINT32_MASK) % block_length)
+
+    @staticmethod
+    def _typecode(fingerprint_size):
+        ''' (int) -> str
+        Returns the narrowest array typecode holding fingerprint_size bits.
+        '''
+        for typecode in ('B', 'H', 'I', 'L', 'Q'):
+            if array(typecode).itemsize * 8 >= fingerprint_size:
+                return typecode
+        raise ValueError('Fingerprints of {} bits are not supported'.format(fingerprint_size))
+
+    def load_factor(self):
+        return self.size / self.capacity
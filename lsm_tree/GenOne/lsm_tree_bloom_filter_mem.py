@@ -1,7 +1,8 @@
 import sys
 from tools.red_black_tree import RedBlackTree
 from tools.write_append_log import AppendLog
-from PDS.bloom_filter import BloomFilter
+from PDS.bloom_filter import BloomFilter, BlockedBloomFilter
+from tools.filter_manager import FilterManager
 
 from pathlib import Path
 from os import remove as remove_file, rename as rename_file
@@ -36,7 +37,9 @@ class LSMTreeBloom():
         self.third_level = []
         self.meta_dict = dict()
         self.bfs = []
-        self.bfs_in_memory = dict()
+        # Filters by name, paged out to filter_dir beyond the resident budget
+        self.bfs_in_memory = FilterManager(filter_dir)
+        self._key_fences = dict()
 
         # Default threshold is 100,000 items
         self._size_threshold = 100000
@@ -53,11 +56,14 @@ class LSMTreeBloom():
         # Bloom Filter
         self._bf_num_items = self._size_threshold
         self._bf_false_pos_prob = 0.2
+        self._bf_blocked = False
         self._bloom_filter = None
 
         # Create the segments directory
         if not (Path(segments_directory).exists() and Path(segments_directory).is_dir):
             Path(segments_directory).mkdir()
+        if not Path(filter_dir).exists():
+            Path(filter_dir).mkdir()
 
         # Attempt to load metadata and a pre-existing memtable
         self.load_metadata()
@@ -134,6 +140,8 @@ class LSMTreeBloom():
             return self._memtable.remove(key)
 
         for segment, bf_tup in reversed(list(self.meta_dict.items())):
+            if not self._within_fences(key, segment):
+                continue
             for bf in bf_tup:
                 if self.bfs_in_memory[bf].check(key):
                     if self._delete_keys_from_segment(set(key.split()), self._segment_path(segment)):
@@ -152,9 +160,10 @@ class LSMTreeBloom():
         # write, since its faster than making sure that every new write is flushed to disk.
         key_offset = 0
 
+        nodes = self._memtable.in_order()
         with open(segment_path, 'w') as s:
-            bloom_filter = BloomFilter(self._bf_num_items, self._bf_false_pos_prob)
-            for node in self._memtable.in_order():
+            bloom_filter = self._new_bf(self._bf_num_items)
+            for node in nodes:
                 log = self._to_log_entry(node.key, node.value)
 
                 # Update sparse index
@@ -163,13 +172,17 @@ class LSMTreeBloom():
                                    offset=key_offset, segment=self.current_segment)
                     sparsity_counter = self._sparsity() + 1
 
-                # Add to bloom filters
-                bloom_filter.add(node.key)
                 s.write(log)
                 key_offset += len(log)
                 sparsity_counter -= 1
+
+            # Add to bloom filters
+            bloom_filter.add_many(node.key for node in nodes)
             self.bfs_in_memory[bf_path.split('/')[-1]] = bloom_filter
 
+        if nodes:
+            self._key_fences[self.current_segment] = (nodes[0].key, nodes[-1].key)
+
     def _to_log_entry(self, key, value):
         '''(str, str) -> str
         Converts a key value pair into a comma seperated newline delimited
@@ -233,13 +246,17 @@ class LSMTreeBloom():
     ## Merging Section
     def _merge_by_time_th(self, segments, dictionary):
         if self._check_seg_time(sorted(segments)[0]):
-            seg1, seg2, new_instance = self._merge(sorted(segments)[0], sorted(segments)[1])
+            seg1, seg2 = sorted(segments)[0], sorted(segments)[1]
+            # A new filter is built from the merge stream once enough filters pile up
+            build_filter = len(dictionary[seg1]+dictionary[seg2]) > 3
+            seg1, seg2, new_instance, keys = self._merge(seg1, seg2, build_filter)
             segments.append(new_instance), segments.remove(seg1), segments.remove(seg2)
             dictionary[new_instance] = (dictionary[seg1]+dictionary[seg2])
 
-            if len(dictionary[new_instance]) > 3:
-                self._create_new_bf(new_instance, dictionary[new_instance], self.meta_dict)
+            if build_filter:
+                self._create_new_bf(new_instance, dictionary[new_instance], self.meta_dict, keys)
             dictionary.pop(seg1), dictionary.pop(seg2)
+            self._key_fences.pop(seg1, None), self._key_fences.pop(seg2, None)
             remove_file(self._segment_path(seg1)), remove_file(self._segment_path(seg2))
         return
 
@@ -252,11 +269,16 @@ class LSMTreeBloom():
             to_seg_set.append(seg), from_seg_set.remove(seg)
 
             
-    def _merge(self, segment1, segment2):
-        ''' (self, str, str) -> str
+    def _merge(self, segment1, segment2, build_filter=False):
+        ''' (self, str, str, bool) -> (str, str, str, list)
         Concatenates the contents of the files represented byt segment1 and
         segment2, erases the second segment file and returns the name of the
         first segment. 
+
+        The sparse index and the key fences of the new segment are updated
+        while the records stream out. If build_filter is set, the written keys
+        are also returned so the new bloom filter can be sized and filled
+        without reading the new segment back.
         '''
         path1 = self._segment_path(segment1)
         path2 = self._segment_path(segment2)
@@ -265,6 +287,25 @@ class LSMTreeBloom():
         new_seg_name = segment1.split('-')[0] +'-'+time_str
         new_path = self.segments_directory + new_seg_name
 
+        keys = []
+        written = {'offset': 0, 'first': None, 'last': None, 'sparsity': self._sparsity()}
+        def write(line, key):
+            s0.write(line)
+
+            # Update sparse index
+            if written['sparsity'] == 1:
+                _, value = line.strip().split(',', 1)
+                self._index.add(key, value, offset=written['offset'], segment=new_seg_name)
+                written['sparsity'] = self._sparsity() + 1
+            written['sparsity'] -= 1
+            written['offset'] += len(line)
+
+            if build_filter:
+                keys.append(key)
+            if written['first'] is None:
+                written['first'] = key
+            written['last'] = key
+
         with open(new_path, 'w') as s0:
             with open(path1, 'r') as s1:
                 with open(path2, 'r') as s2:
@@ -273,16 +314,19 @@ class LSMTreeBloom():
                         # At the end of the file stream we'll get the empty str
                         key1, key2 = line1.split(',')[0], line2.split(',')[0]
                         if key1 == '' or key1 == key2:
-                            s0.write(line2)
+                            write(line2, key2)
                             line1 = s1.readline()
                             line2 = s2.readline()
                         elif key2 == '' or key1 < key2:
-                            s0.write(line1)
+                            write(line1, key1)
                             line1 = s1.readline()
                         else:
-                            s0.write(line2)
+                            write(line2, key2)
                             line2 = s2.readline()
-        return segment1, segment2, new_seg_name
+
+        if written['first'] is not None:
+            self._key_fences[new_seg_name] = (written['first'], written['last'])
+        return segment1, segment2, new_seg_name, keys
 
     # Configuration methods
     def set_size_threshold(self, size_threshold):
@@ -330,6 +374,8 @@ class LSMTreeBloom():
         bloom filters firts.
         '''
         for segment, bf_tup in reversed(list(self.meta_dict.items())):
+            if not self._within_fences(key, segment):
+                continue
             for bf in bf_tup:
                 if self.bfs_in_memory[bf].check(key):
                     value = self._search_segment(key, segment)
@@ -356,6 +402,16 @@ class LSMTreeBloom():
                 else:
                     pairs = pairs[ptr+1:]
 
+    def _within_fences(self, key, segment_name):
+        ''' (self, str, str) -> bool
+        Returns False if key falls outside the smallest and largest keys
+        written to the segment represented by segment_name.
+        '''
+        fences = self._key_fences.get(segment_name)
+        if fences is None:
+            return True
+        return fences[0] <= key <= fences[1]
+
     def _check_seg_time(self, seg_name):
         ''' (self) -> str
         Returns True or False if the time for merging is passed.
@@ -375,18 +431,34 @@ class LSMTreeBloom():
         Sets the desired probability of generating a false positive for the bloom filter.
         '''
         self._bf_false_pos_prob = probability
-        self._bloom_filter = BloomFilter(self._bf_num_items, self._bf_false_pos_prob)
+        self._bloom_filter = self._new_bf(self._bf_num_items)
+
+    def set_bf_blocked(self, blocked):
+        ''' (self, bool) -> None
+        Sets whether new bloom filters are cache line blocked, so that a lookup
+        touches a single 64 byte block at the cost of a slightly higher false
+        positive rate. Existing filters keep their layout.
+        '''
+        self._bf_blocked = blocked
 
-    def _create_new_bf(self, segment_name, bf_tuple, dictionary):
-        numb_list = [numb.split('-')[-2] for numb in bf_tuple]
-        total_filter = sum(int(x) for x in numb_list)
-        bloom_filter = BloomFilter(self._bf_num_items*total_filter, self._bf_false_pos_prob)
+    def _new_bf(self, num_items):
+        ''' (self, int) -> BloomFilter
+        Returns an empty bloom filter for num_items keys, blocked if so configured.
+        '''
+        if self._bf_blocked:
+            return BlockedBloomFilter(num_items, self._bf_false_pos_prob)
+        return BloomFilter(num_items, self._bf_false_pos_prob)
+
+    def _create_new_bf(self, segment_name, bf_tuple, dictionary, keys):
+        ''' (self, str, tuple, dict, list) -> None
+        Replaces the filters in bf_tuple with a single bloom filter holding keys,
+        the keys written to the segment represented by segment_name. The filter is
+        sized from the exact number of keys.
+        '''
+        bloom_filter = self._new_bf(max(len(keys), 1))
         new_bf_name = f'bf-{len(bf_tuple)}'+'-'+segment_name.split('-')[-1]
-        with open(self._segment_path(segment_name), "r") as s:
-            for line in s:
-                key, _ = line.split(',', 1)
-                # Add to bloom filters
-                bloom_filter.add(key)
+        # Add to bloom filters
+        bloom_filter.add_many(keys)
         for bf in bf_tuple:
             self.bfs.remove(bf)
             self.bfs_in_memory.pop(bf)
@@ -395,9 +467,42 @@ class LSMTreeBloom():
         dictionary[segment_name] = (new_bf_name,)
 
     def save_bfs(self):
-        for bf in self.bfs:
-            with open(self.filter_dir + bf, 'wb') as bloom:
-                pickle.dump(self.bfs_in_memory[bf], bloom)
+        ''' (self) -> None
+        Writes every filter not written yet, in the binary filter format.
+        '''
+        self.bfs_in_memory.flush()
+
+    def load_bfs(self):
+        ''' (self) -> None
+        Registers the saved filters of every segment, which are mapped the first
+        time they are probed. The filter of a segment whose file is missing,
+        because it was never saved, is rebuilt from its keys.
+        '''
+        for segment, bf_tuple in self.meta_dict.items():
+            for bf in bf_tuple:
+                if Path(self.filter_dir + bf).exists():
+                    self.bfs_in_memory.register(bf)
+                    continue
+                with open(self._segment_path(segment), 'r') as s:
+                    keys = [line.split(',', 1)[0] for line in s]
+                bloom_filter = self._new_bf(max(len(keys), 1))
+                bloom_filter.add_many(keys)
+                self.bfs_in_memory[bf] = bloom_filter
+
+    def set_resident_filter_budget(self, num_bytes):
+        ''' (self, int) -> None
+        Sets the bytes of filters kept in memory. The least recently probed
+        filters beyond it are paged out to filter_dir and mapped back when next
+        probed. None keeps every filter in memory.
+        '''
+        self.bfs_in_memory.set_budget(num_bytes)
+
+    def filter_stats(self):
+        ''' (self) -> dict
+        Returns the resident and total bytes of the filters, and how often
+        filters were paged in and out.
+        '''
+        return self.bfs_in_memory.stats()
 
     # Index helpers
     def _sparsity(self):
@@ -483,7 +588,9 @@ class LSMTreeBloom():
                 metadata = pickle.load(s)
                 self.first_level = metadata['first_level']
                 self.second_level = metadata['second_level']
+                self.third_level = metadata.get('third_level', [])
                 self.meta_dict = metadata['meta_dict']
+                self.bfs = metadata.get('bfs', [bf for bfs in self.meta_dict.values() for bf in bfs])
                 self._count = metadata['count']
                 self._time_threshold = metadata['time_threshold']
                 self.current_segment = metadata['current_segment']
@@ -491,7 +598,10 @@ class LSMTreeBloom():
                 self._bloom_filter = metadata['bloom_filter']
                 self._bf_num_items = metadata['bf_num_items']
                 self._bf_false_pos_prob = metadata['bf_false_pos']
+                self._bf_blocked = metadata.get('bf_blocked', False)
                 self._index = metadata['index']
+                self._key_fences = metadata.get('key_fences', dict())
+            self.load_bfs()
 
     def save_metadata(self):
         ''' (self) -> None
@@ -500,7 +610,9 @@ class LSMTreeBloom():
         bookkeeping_info = {
             'first_level': self.first_level,
             'second_level': self.second_level,
+            'third_level': self.third_level,
             'meta_dict': self.meta_dict, 
+            'bfs': self.bfs,
             'count': self._count,
             'time_threshold': self._time_threshold,
             'current_segment': self.current_segment,
@@ -508,7 +620,9 @@ class LSMTreeBloom():
             'bloom_filter': self._bloom_filter,
             'bf_num_items': self._bf_num_items,
             'bf_false_pos': self._bf_false_pos_prob,
-            'index': self._index
+            'bf_blocked': self._bf_blocked,
+            'index': self._index,
+            'key_fences': self._key_fences
         }
 
         with open(self._metadata_path(), 'wb') as s:
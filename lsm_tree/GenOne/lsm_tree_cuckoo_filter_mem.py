@@ -1,15 +1,103 @@
 import sys
 from tools.red_black_tree import RedBlackTree
 from tools.write_append_log import AppendLog
-from PDS.cuckoo_filter import CuckooFilter
+from tools.rate_limiter import RateLimiter, ThrottledWriter, IO_HIGH, IO_LOW
+from tools.segment_catalog import SegmentCatalog, SegmentInfo, sample_expiries, merge_expiry_samples
+from tools.filter_tuning import allocate_fpps, cuckoo_bits_per_key, adaptive_cuckoo_bits_per_key, xor_bits_per_key
+from tools.filter_manager import FilterManager
+from tools.negative_cache import NegativeCache
+from tools.sstable import SegmentWriter, SegmentReader, ValuePointer, CODECS, POINTER, encode_record, read_log
+from tools.block_cache import BlockCache
+from tools.scrubber import Scrubber
+from tools.value_log import ValueLog
+from tools.manifest import Manifest
+from PDS.cuckoo_filter import ScalableCuckooFilter, AdaptiveCuckooFilter
+from PDS.xor_filter import XorFilter
+from PDS.bloom_filter import PrefixBloomFilter
+from PDS.filter_io import write_filter
 
 from pathlib import Path
 from os import remove as remove_file, rename as rename_file
+from concurrent.futures import ProcessPoolExecutor
 
-import pickle
 import os
 from datetime import datetime
 
+# Merge workers. They live at module level so that subcompactions can run them
+# in separate processes.
+def _read_key_range(path, lower=None, upper=None, cache=None, verify=True):
+    ''' (str, str, str, BlockCache, bool) -> generator
+    Yields the (key, expiry, value, record) of the records of the segment
+    stored at path with lower <= key < upper, record being the encoded record.
+    Reading starts from the block holding lower, found in the block index.
+    Blocks are checked against their checksum unless verify is False.
+    '''
+    for key, expiry, value, record, _ in SegmentReader(path, cache, verify).records(lower, upper):
+        yield key, expiry, value, record
+
+def _merge_key_range(path1, path2, new_path, lower=None, upper=None, keep_expired=False,
+                     collect_keys=False, sparsity=1, rate_limiter=None, codec=('none', None)):
+    ''' (str, str, str, str, str, bool, bool, int, RateLimiter, (str, int)) -> dict
+    Merges the records with lower <= key < upper of the segments stored at path1
+    and path2 into new_path, whose blocks are compressed with codec, a (codec
+    name, compression level) pair. On equal keys the record of path2 wins.
+
+    Expired records are dropped unless keep_expired, a bool or a function of the
+    key, says otherwise. Returns what the tree needs for its bookkeeping: the
+    sparse index samples as (key, value, offset), the key fences, the dropped
+    keys, the written keys if collect_keys is set, the records and characters
+    written with the block index, the ttl records written with samples of their
+    expiry timestamps and the seconds rate_limiter spent throttling the writes.
+    '''
+    now = datetime.now().timestamp()
+    result = {'samples': [], 'expired': [], 'keys': [], 'first': None, 'last': None, 'offset': 0,
+              'count': 0, 'tombstones': 0, 'expiries': []}
+    rate_limiter = rate_limiter or RateLimiter()
+    throttled_time = rate_limiter.throttled_time[IO_LOW]
+    sparsity_counter = sparsity
+
+    records1 = _read_key_range(path1, lower, upper)
+    records2 = _read_key_range(path2, lower, upper)
+    record1, record2 = next(records1, None), next(records2, None)
+    with open(new_path, 'wb') as segment, ThrottledWriter(segment, rate_limiter) as s0:
+        writer = SegmentWriter(s0, *codec)
+        while not (record1 is None and record2 is None):
+            if record2 is not None and (record1 is None or record2[0] <= record1[0]):
+                if record1 is not None and record1[0] == record2[0]:
+                    record1 = next(records1, None)
+                (key, expiry, value, record), record2 = record2, next(records2, None)
+            else:
+                (key, expiry, value, record), record1 = record1, next(records1, None)
+
+            if expiry is not None and expiry <= now:
+                keep = keep_expired(key) if callable(keep_expired) else keep_expired
+                if not keep:
+                    result['expired'].append(key)
+                    continue
+            elif expiry is not None:
+                result['tombstones'] += 1
+                result['expiries'].append(expiry)
+            offset = writer.add_record(record)
+            result['count'] += 1
+
+            # Sample the sparse index
+            if sparsity_counter == 1:
+                result['samples'].append((key, value, offset))
+                sparsity_counter = sparsity + 1
+            sparsity_counter -= 1
+
+            if collect_keys:
+                result['keys'].append(key)
+            if result['first'] is None:
+                result['first'] = key
+            result['last'] = key
+        writer.finish()
+        result['offset'] = writer.offset
+        result['blocks'] = writer.blocks
+    result['expiries'] = sample_expiries(sorted(result['expiries']))
+    result['throttled_time'] = rate_limiter.throttled_time[IO_LOW] - throttled_time
+    return result
+
 class LSMTreeCuckoo():
     def __init__(self, 
                  segment_basename='LSMTreeCuckoo', 
@@ -36,7 +124,9 @@ class LSMTreeCuckoo():
         self.third_level = []
         self.meta_dict = dict()
         self.ckfs = []
-        self.ckfs_in_memory = dict()
+        # Filters by name, paged out to filter_dir beyond the resident budget
+        self.ckfs_in_memory = FilterManager(filter_dir, save=self._save_ckf)
+        self.catalog = SegmentCatalog()
 
         # Default threshold is 100,000 items
         self._size_threshold = 100000
@@ -50,40 +140,104 @@ class LSMTreeCuckoo():
         self._index = RedBlackTree()
         self._sparsity_factor = 100
 
+        # Compaction triggers, besides the time threshold
+        self._max_level_files = 10
+        self._tombstone_ratio = 0.5
+        self._max_read_amp = 8
+
+        # Background writes (flushes, merges, filter rebuilds) share one rate limiter
+        self.rate_limiter = RateLimiter()
+
+        # Subcompactions, merges above _subcompaction_size megabytes are split by key range
+        self._max_subcompactions = os.cpu_count() or 1
+        self._subcompaction_size = 64
+        self._subcompaction_pool = None
+
         # Cuckoo Filter
         self._ckf_num_items = self._size_threshold
         self._ckf_false_pos_prob = 0.2
         self._cuckoo_filter = None
+        # Whether third level segments get static xor filters instead
+        self._static_filters = False
+        # Whether the other segments get adaptive cuckoo filters
+        self._adaptive_filters = False
+        # Filter memory budget in bytes, split across levels when set
+        self._filter_memory_budget = None
+        self._tuning = None
+        # Prefix lengths of the segments' range filters, None when they get none
+        self._range_prefixes = None
+        self.range_filters = dict()
+        self.range_skips = 0
+        self.range_reads = 0
+
+        # Keys recently confirmed missing, and what point lookups cost on disk
+        self._negative_cache = NegativeCache()
+        self.filter_probes = 0
+        self.segment_reads = 0
+
+        # Block compression, a (codec, compression level) pair per level, and
+        # the decompressed blocks recently read
+        self._codecs = [('none', None)] * 3
+        self.block_cache = BlockCache()
+
+        # Whether lookups and range scans check block checksums, which merges
+        # always do, and the scrubber checking every segment in the background
+        self._verify_checksums = True
+        self.scrubber = Scrubber(self._scrubbed_segments)
+
+        # Values of at least _value_threshold bytes are moved to the value log
+        # when flushed, None keeping every value in the segments
+        self.value_log = None
+        self._value_threshold = None
+        self._vlog_file_size = None
+
+        # Metadata is saved as version edits to the manifest, _manifest_state
+        # being the version last written there
+        self.manifest = Manifest(segments_directory)
+        self._manifest_state = None
+        self._obsolete_segments = []
 
         # Create the segments directory
         if not (Path(segments_directory).exists() and Path(segments_directory).is_dir):
             Path(segments_directory).mkdir()
+        if not Path(filter_dir).exists():
+            Path(filter_dir).mkdir()
 
         # Attempt to load metadata and a pre-existing memtable
         self.load_metadata()
         self.restore_memtable()
 
-    def db_set(self, key, value):
-        ''' (self, str, str) -> None
-        Stores a new key value pair in the DB
+    def db_set(self, key, value, ttl=None):
+        ''' (self, str, str, float) -> None
+        Stores a new key value pair in the DB. If ttl is given, the pair
+        expires ttl seconds from now: reads stop returning it and the next
+        merge that reaches it drops it from disk.
+        '''
+        expiry = None if ttl is None else datetime.now().timestamp() + ttl
+        self._put(key, value, expiry)
+
+    def _put(self, key, value, expiry):
+        ''' (self, str, str, float) -> None
+        Stores key and value, expiring at the expiry timestamp if not None.
         '''
-        log = self._to_log_entry(key, value)
+        log = self._to_log_entry(key, value, expiry)
+        self._negative_cache.discard(key)
 
         # Check if we can save effort by updating the memtable in place
         node = self._memtable.find_node(key)
         if node:
             self._memtable_wal().write(log)
             node.value = value
+            node.expiry = expiry
             return
 
         # Check if new segment needed
-        additional_size = len(key) + len(value)
+        additional_size = self._entry_size(key, value)
         if self._count+1 > self._size_threshold:
             self._flush_memtable_to_disk(self._current_segment_path(), self._current_ckf_path())
 
             # Update bookkeeping metadata
             self._memtable = RedBlackTree()
-            self._memtable_wal().clear()
 
             self.first_level.append(self.current_segment)
             self.ckfs.append(self._current_ckf)
@@ -96,22 +250,31 @@ class LSMTreeCuckoo():
             self.current_segment = new_seg_name
             self._current_ckf = new_ckf_name
             self._count = 0
+            self._tune_filters()
+
+            # The segment is in the manifest before the log holding its records goes
+            self._log_version_edit()
+            self._memtable_wal().clear()
             
         # Execute Merging 
+        levels = [list(level) for level in (self.first_level, self.second_level, self.third_level)]
         if len(self.first_level) > 1:
-            self._merge_by_time_th(self.first_level, self.meta_dict)
+            self._compact_level(self.first_level, self.meta_dict)
             self._move_large_files(self.first_level, self.second_level, self._lvl1_size)
         if len(self.second_level) > 1:
-            self._merge_by_time_th(self.second_level, self.meta_dict)
+            self._compact_level(self.second_level, self.meta_dict)
             self._move_large_files(self.second_level, self.third_level, self._lvl2_size)
         if len(self.third_level) > 4:
-            self._merge_by_time_th(self.third_level, self.meta_dict)
+            self._compact_level(self.third_level, self.meta_dict)
+        refitted = self._fit_filters()
+        if refitted or levels != [self.first_level, self.second_level, self.third_level]:
+            self._log_version_edit()
             
         # Write to memtable write ahead log in case of crash
         self._memtable_wal().write(log)
 
         # Write to memtable
-        self._memtable.add(key, value)
+        self._memtable.add(key, value, expiry=expiry)
         self._count += 1
         self._memtable.total_bytes += additional_size
         
@@ -123,9 +286,106 @@ class LSMTreeCuckoo():
         # Attempt to find the key in the memtable first
         memtable_result = self._memtable.find_node(key)
         if memtable_result:
-            return memtable_result.value
+            if self._is_expired(memtable_result.expiry):
+                return None
+            return self._resolve(memtable_result.value)
+
+        if self._negative_cache.lookup(key):
+            return None
+        probes, reads = self.filter_probes, self.segment_reads
+        value = self._search_all_segments(key)
+        if value is None:
+            self._negative_cache.add(key, self.filter_probes - probes, self.segment_reads - reads)
+        return self._resolve(value)
+
+    def db_get_view(self, key):
+        ''' (self, str) -> memoryview
+        Retrieve the value associated with key in the db as a read-only
+        memoryview of its bytes, UTF-8 encoded for str values, or None.
+
+        A value read from a segment isn't copied out of the block holding it.
+        The view keeps that block alive, so it stays valid after the block
+        leaves the block cache or the segment is merged away.
+        '''
+        memtable_result = self._memtable.find_node(key)
+        if memtable_result:
+            if self._is_expired(memtable_result.expiry):
+                return None
+            return self._view(memtable_result.value)
+
+        if self._negative_cache.lookup(key):
+            return None
+        probes, reads = self.filter_probes, self.segment_reads
+        value = self._search_all_segments(key, view=True)
+        if value is None:
+            self._negative_cache.add(key, self.filter_probes - probes, self.segment_reads - reads)
+        return self._view(value)
+
+    def db_get_many(self, keys):
+        ''' (self, [str]) -> dict
+        Retrieve the values associated with keys in the db, None for the
+        missing ones. Each segment gets its filters probed once for the whole
+        batch and is read once for all the keys they let through.
+        '''
+        results = dict()
+        pending = []
+        for key in keys:
+            memtable_result = self._memtable.find_node(key)
+            if memtable_result:
+                results[key] = None if self._is_expired(memtable_result.expiry) else memtable_result.value
+            else:
+                pending.append(key)
+
+        for segment in self.catalog.newest_first(self.meta_dict):
+            candidates = [key for key in pending if self._within_fences(key, segment)]
+            if not candidates:
+                continue
+            hits = dict()
+            for ckf in self.meta_dict[segment]:
+                checks = self.ckfs_in_memory[ckf].check_many(candidates)
+                hits.update((key, ckf) for key, check in zip(candidates, checks) if check)
+            if not hits:
+                continue
+            found = self._search_segment_many(hits.keys(), segment)
+            for key, (value, expiry) in found.items():
+                results[key] = None if self._is_expired(expiry) else value
+            self._learn_false_positives([(key, ckf) for key, ckf in hits.items() if key not in found])
+            pending = [key for key in pending if key not in results]
+
+        for key in pending:
+            results[key] = None
+        return {key: self._resolve(value) for key, value in results.items()}
 
-        return self._search_all_segments(key)
+    def db_range(self, start, end=None):
+        ''' (self, str, str) -> [(str, str)]
+        Returns the (key, value) pairs with start <= key < end, in key order.
+        Without end, the scan runs to the last key.
+        '''
+        return self._scan(start, end, lambda range_filter: range_filter.check_range(start, end))
+
+    def db_prefix(self, prefix):
+        ''' (self, str) -> [(str, str)]
+        Returns the (key, value) pairs whose key starts with prefix, in key order.
+        '''
+        return self._scan(prefix, self._prefix_end(prefix),
+                          lambda range_filter: range_filter.check_prefix(prefix))
+
+    @staticmethod
+    def _prefix_end(prefix):
+        ''' (str or bytes) -> str or bytes
+        Returns the smallest key above every key starting with prefix, or None
+        if there is none. Trailing bytes 0xff or characters U+10FFFF can't be
+        incremented, so they are dropped and the last one left is incremented,
+        characters skipping the surrogates, which can't be encoded.
+        '''
+        if isinstance(prefix, bytes):
+            prefix = prefix.rstrip(b'\xff')
+            return prefix[:-1] + bytes((prefix[-1] + 1,)) if prefix else None
+        prefix = prefix.rstrip(chr(sys.maxunicode))
+        if not prefix:
+            return None
+        code = ord(prefix[-1]) + 1
+        return prefix[:-1] + chr(0xe000 if 0xd800 <= code <= 0xdfff else code)
 
     def db_del(self, key):
         memtable_result = self._memtable.find_node(key)
@@ -133,49 +393,87 @@ class LSMTreeCuckoo():
         if memtable_result:
             return self._memtable.remove(key)
         
-        for segment, ckf_tup in reversed(list(self.meta_dict.items())):
-            for ckf in ckf_tup:
-                if self.ckfs_in_memory[ckf].delete(key):
-                    if self._delete_keys_from_segment(set(key.split()), self._segment_path(segment)):
-                        return
+        for segment in self.catalog.newest_first(self.meta_dict):
+            if not self._within_fences(key, segment):
+                continue
+            ckf = self._owning_filter(self.meta_dict[segment], key)
+            # The fingerprint only goes once the segment held the key, deleting
+            # a false positive would remove the fingerprint of another key
+            if ckf is not None and self._delete_keys_from_segment({key}, self._segment_path(segment)):
+                self._delete_from_filter(ckf, key)
+                self._log_version_edit()
+                return
+
+    def close(self):
+        ''' (self) -> None
+        Stops the background work of the database: the scrubber thread and the
+        worker processes of subcompactions. The next split merge starts new
+        workers, so the database can still be used.
+        '''
+        self.stop_scrubber()
+        self._shutdown_subcompactions()
 
     # Write helpers
     def _flush_memtable_to_disk(self, segment_path, ckf_path):
         ''' (self, str) -> None
         Writes the contents of the current memtable to disk and wipes the current memtable.
 
-        Updates the index and adds keys to the cuckoo filter.
+        Updates the index, adds keys to the cuckoo filter and records the
+        segment in the catalog.
         '''
         sparsity_counter = self._sparsity()
+        expiries = []
 
-        # We track the offset for each key ourself, instead of checking the file's size as we
-        # write, since its faster than making sure that every new write is flushed to disk.
-        key_offset = 0
-
-        with open(segment_path, 'w') as s:
-            cuckoo_filter = CuckooFilter(self._ckf_num_items, self._ckf_false_pos_prob)
-            for node in self._memtable.in_order():
-                log = self._to_log_entry(node.key, node.value)
+        nodes = self._memtable.in_order()
+        with open(segment_path, 'wb') as segment, ThrottledWriter(segment, self.rate_limiter, IO_HIGH) as s:
+            writer = SegmentWriter(s, *self._codec(self.first_level))
+            # Filters are sized from the memtable, so they take the memory the level
+            # tuning planned for
+            if self._adaptive_filters:
+                cuckoo_filter = AdaptiveCuckooFilter(max(len(nodes), 1), self._level_fpp(self.first_level))
+            else:
+                cuckoo_filter = ScalableCuckooFilter(max(len(nodes), 1), self._level_fpp(self.first_level))
+            for node in nodes:
+                value = node.value
+                if (self._value_threshold is not None and not isinstance(value, ValuePointer)
+                        and len(value) >= self._value_threshold):
+                    value = self.value_log.append(node.key, value)
+                key_offset = writer.add(node.key, value, node.expiry)
 
                 # Update sparse index
                 if sparsity_counter == 1:
-                    self._index.add(node.key, node.value,
+                    self._index.add(node.key, value,
                                    offset=key_offset, segment=self.current_segment)
                     sparsity_counter = self._sparsity() + 1
-
-                # Add to cuckoo filters
-                cuckoo_filter.add(node.key)
-                s.write(log)
-                key_offset += len(log)
                 sparsity_counter -= 1
+
+                if node.expiry is not None:
+                    expiries.append(node.expiry)
+            writer.finish()
+
+            # Add to cuckoo filters
+            cuckoo_filter.add_many(node.key for node in nodes)
             self.ckfs_in_memory[ckf_path.split('/')[-1]] = cuckoo_filter
+            self._add_range_filter(self.current_segment, [node.key for node in nodes])
 
-    def _to_log_entry(self, key, value):
-        '''(str, str) -> str
-        Converts a key value pair into a comma seperated newline delimited
-        log entry.
+        self.catalog.add(self.current_segment, writer.offset, len(nodes),
+                         nodes[0].key if nodes else None, nodes[-1].key if nodes else None,
+                         len(expiries), sample_expiries(sorted(expiries)))
+
+    def _to_log_entry(self, key, value, expiry=None):
+        '''(str, str, float) -> bytes
+        Converts a key value pair into a length prefixed binary record, the
+        format shared by the write ahead log and the segments. Keys and values
+        may be str or bytes. The expiry timestamp is left out for records
+        without a ttl.
         '''
-        return str(key) + ',' + (value) + '\n'
+        return encode_record(key, value, expiry)
+
+    def _is_expired(self, expiry):
+        '''(float) -> bool
+        Returns True if the expiry timestamp of a record has passed.
+        '''
+        return expiry is not None and expiry <= datetime.now().timestamp()
 
     # Files compact and delete operations
     def compact(self): #revise
@@ -216,52 +514,144 @@ class LSMTreeCuckoo():
         temporary one. This strategy is chosen to avoid overloading memory.
         '''
         temp_path = segment_path + '_temp'
+        segment_name = segment_path[len(self.segments_directory):]
         deleted = 0
         
-        with open(segment_path, "r") as input:
-            with open(temp_path, "w") as output:
-                for line in input:
-                    key, _ = line.split(',', 1)
-                    if not key in deletion_keys:
-                        output.write(line)
-                    else:
-                        deleted += 1
+        with open(temp_path, "wb") as temp, ThrottledWriter(temp, self.rate_limiter) as output:
+            writer = SegmentWriter(output, *self._codec(self._level_of(segment_name)))
+            for key, _, _, record, _ in SegmentReader(segment_path).records():
+                if not key in deletion_keys:
+                    writer.add_record(record)
+                else:
+                    deleted += 1
+            writer.finish()
         remove_file(segment_path)
         rename_file(temp_path, segment_path)
+        self.block_cache.discard(segment_path)
+
+        info = self.catalog[segment_name]
+        info.size = writer.offset
+        info.key_count -= deleted
         
         if deleted == 0:
             return False
         return True
     
     # Merging Section
-    def _merge_by_time_th(self, segments, dictionary):
-        if self._check_seg_time(sorted(segments)[0]):
-            seg1, seg2, new_seg = self._merge(sorted(segments)[0], sorted(segments)[1])
+    def _compact_level(self, segments, dictionary):
+        ''' (self, list, dict) -> None
+        Merges the two segments holding the oldest records of the level segments
+        if the catalog says the level needs it.
+        '''
+        picked = self._pick_compaction(segments)
+        if picked:
+            seg1, seg2 = picked
+            # A new filter is built from the merge stream, only small filters get compressed.
+            # Static and adaptive filters can't be merged, so they are always rebuilt, as
+            # are filters under a memory budget, a chain of merged filters taking more
+            # memory than one sized for the merged keys. Only scalable cuckoo filters
+            # can be merged, the inputs may be xor or adaptive filters built before
+            # static or adaptive filters were turned off
+            static = self._static_filters and segments is self.third_level
+            mergeable = all(isinstance(self.ckfs_in_memory[ckf], ScalableCuckooFilter)
+                            for ckf in dictionary[seg1] + dictionary[seg2])
+            build_filter = (static or self._adaptive_filters or self._filter_memory_budget is not None
+                            or not mergeable or len(dictionary[seg1]+dictionary[seg2]) > 3)
+            older_segments = self._segments_below(segments)
+            collect_keys = build_filter or self._range_prefixes is not None
+            seg1, seg2, new_seg, expired_keys, keys = self._merge(seg1, seg2, older_segments, collect_keys,
+                                                                  self._codec(segments))
             segments.append(new_seg), segments.remove(seg1), segments.remove(seg2)
             dictionary[new_seg] = (dictionary[seg1]+dictionary[seg2])
-            
-            if len(dictionary[new_seg]) > 3:
-                self._create_new_ckf(new_seg, dictionary[new_seg], dictionary)
+
+            if build_filter:
+                self._create_new_ckf(new_seg, dictionary[new_seg], dictionary, keys, static,
+                                     self._level_fpp(segments))
             else:
+                # Expired records are gone from disk, so their fingerprints go too
+                for key in expired_keys:
+                    ckf = self._owning_filter(dictionary[new_seg], key)
+                    if ckf is not None:
+                        self._delete_from_filter(ckf, key)
+                for ckf in dictionary[new_seg]:
+                    self.ckfs_in_memory[ckf].shrink()
+                    self.ckfs_in_memory.mark_dirty(ckf)
                 self._ckf_compresser(dictionary[new_seg], new_seg, dictionary, self.ckfs, self.ckfs_in_memory)
 
+            self._add_range_filter(new_seg, keys)
+            self._drop_range_filter(seg1), self._drop_range_filter(seg2)
+
             dictionary.pop(seg1), dictionary.pop(seg2)
-            remove_file(self._segment_path(seg1)), remove_file(self._segment_path(seg2))
+            self.catalog.remove(seg1), self.catalog.remove(seg2)
+            # The merged segments are removed once the manifest no longer has them
+            for seg in (seg1, seg2):
+                self._obsolete_segments.append(self._segment_path(seg))
+                self.block_cache.discard(self._segment_path(seg))
+            self._tune_filters()
         return
+
+    def _pick_compaction(self, segments):
+        ''' (self, list) -> (str, str)
+        Returns the two segments holding the oldest records of the level segments
+        if the catalog shows that the level needs a merge, otherwise None. A level
+        needs a merge when:
+
+        - its oldest segment is older than the time threshold
+        - it holds more than the maximum number of segments per level
+        - enough records of its two oldest segments carry an expired ttl
+        - its estimated read amplification is too high and its two oldest
+          segments overlap, so merging them lowers it
+        '''
+        seg1, seg2 = self.catalog.oldest(segments, 2)
+        if (self._check_seg_time(seg1)
+                or len(segments) > self._max_level_files
+                or self.catalog.tombstone_ratio((seg1, seg2)) > self._tombstone_ratio
+                or (self.catalog[seg1].overlaps(self.catalog[seg2])
+                    and self.catalog.read_amplification(segments) > self._max_read_amp)):
+            return seg1, seg2
+        return None
             
     def _move_large_files(self, from_seg_set, to_seg_set, lvl_size):
         
-        size_measurer = lambda x: os.path.getsize(self._segment_path(x))/1000000
+        size_measurer = lambda x: self.catalog[x].size/1000000
         temp_segment = [seg for seg in from_seg_set if size_measurer(seg) > lvl_size]
         
         for seg in temp_segment:
             to_seg_set.append(seg), from_seg_set.remove(seg)
+            if self._static_filters and to_seg_set is self.third_level:
+                self._create_new_ckf(seg, self.meta_dict[seg], self.meta_dict, self._segment_keys(seg), True,
+                                     self._level_fpp(self.third_level))
+        if temp_segment:
+            self._tune_filters()
 
-    def _merge(self, segment1, segment2):
-        ''' (self, str, str) -> str
+    def _segments_below(self, segments):
+        ''' (self, list) -> list
+        Returns the segments of the levels below the level segments, which
+        hold records older than any record in segments.
+        '''
+        levels = [self.first_level, self.second_level, self.third_level]
+        depth = [lvl is segments for lvl in levels].index(True)
+        return [seg for lvl in levels[depth+1:] for seg in lvl]
+
+    def _merge(self, segment1, segment2, older_segments=(), build_filter=False, codec=('none', None)):
+        ''' (self, str, str, list, bool, (str, int)) -> (str, str, str, set, list)
         Concatenates the contents of the files represented byt segment1 and
         segment2, erases the second segment file and returns the name of the
         first segment. 
+
+        Expired records are dropped unless a segment in older_segments may 
+        still hold the key, in which case the record is kept so that it keeps
+        shadowing the older value. The dropped keys are returned.
+
+        The sparse index and the catalog entry of the new segment are built
+        while the records stream out. If build_filter is set, the written keys
+        are also returned so the new cuckoo filter can be sized and filled
+        without reading the new segment back.
+
+        The blocks of the new segment are compressed with codec, a (codec name,
+        compression level) pair.
+
+        Large merges are split into key ranges merged by separate processes.
         '''
         path1 = self._segment_path(segment1)
         path2 = self._segment_path(segment2)
@@ -270,24 +660,111 @@ class LSMTreeCuckoo():
         new_name = segment1.split('-')[0] +'-'+time_str
         new_path = self.segments_directory + new_name
 
-        with open(new_path, 'w') as s0:
-            with open(path1, 'r') as s1:
-                with open(path2, 'r') as s2:
-                    line1, line2 = s1.readline(), s2.readline()
-                    while not (line1 == '' and line2 == ''):
-                        # At the end of the file stream we'll get the empty str
-                        key1, key2 = line1.split(',')[0], line2.split(',')[0]
-                        if key1 == '' or key1 == key2:
-                            s0.write(line2)
-                            line1 = s1.readline()
-                            line2 = s2.readline()
-                        elif key2 == '' or key1 < key2:
-                            s0.write(line1)
-                            line1 = s1.readline()
-                        else:
-                            s0.write(line2)
-                            line2 = s2.readline()
-        return segment1, segment2, new_name
+        ranges = self._subcompaction_ranges(segment1, segment2)
+        if len(ranges) == 1:
+            keep_expired = lambda key: self._may_exist_in(key, older_segments)
+            parts = [_merge_key_range(path1, path2, new_path, keep_expired=keep_expired,
+                                      collect_keys=build_filter, sparsity=self._sparsity(),
+                                      rate_limiter=self.rate_limiter, codec=codec)]
+        else:
+            # Workers can't probe our filters, so they keep every expired record
+            # as long as there is an older level to shadow
+            parts = self._run_subcompactions(path1, path2, new_path, ranges,
+                                             bool(older_segments), build_filter, codec)
+
+        expired_keys, keys, key_offset = set(), [], 0
+        for part in parts:
+            for key, value, offset in part['samples']:
+                self._index.add(key, value, offset=key_offset+offset, segment=new_name)
+            expired_keys.update(part['expired'])
+            keys.extend(part['keys'])
+            key_offset += part['offset']
+
+        fences = [(part['first'], part['last']) for part in parts if part['first'] is not None]
+        self.catalog.add(new_name, key_offset, sum(part['count'] for part in parts),
+                         fences[0][0] if fences else None, fences[-1][1] if fences else None,
+                         sum(part['tombstones'] for part in parts),
+                         merge_expiry_samples([(part['tombstones'], part['expiries']) for part in parts]),
+                         seq=max(self.catalog[segment1].seq, self.catalog[segment2].seq))
+        return segment1, segment2, new_name, expired_keys, keys
+
+    def _subcompaction_ranges(self, segment1, segment2):
+        ''' (self, str, str) -> [(str, str)]
+        Splits the merge of segment1 and segment2 into disjoint key ranges
+        [lower, upper), one per subcompaction. The boundaries are sampled from the
+        sparse index entries of both segments.
+
+        Merges smaller than the subcompaction size get a single, unbounded range.
+        '''
+        whole = [(None, None)]
+        if self._max_subcompactions < 2:
+            return whole
+        if self.catalog.total_size((segment1, segment2))/1000000 < self._subcompaction_size:
+            return whole
+
+        keys = sorted(set(node.key for node in self._index.in_order()
+                          if node.segment in (segment1, segment2)))
+        count = min(self._max_subcompactions, len(keys))
+        if count < 2:
+            return whole
+        boundaries = sorted(set(keys[i*len(keys)//count] for i in range(1, count)))
+
+        bounds = [None] + boundaries + [None]
+        return list(zip(bounds, bounds[1:]))
+
+    def _run_subcompactions(self, path1, path2, new_path, ranges, keep_expired, build_filter,
+                            codec=('none', None)):
+        ''' (self, str, str, str, list, bool, bool, (str, int)) -> [dict]
+        Merges every key range in ranges in a worker process, then stitches the
+        partial outputs, in key order, into new_path. Every part is compressed
+        with codec, so that its blocks are copied as they are, and the block
+        index of new_path is built from the ones the workers return rather than
+        read back from the parts.
+
+        Each worker gets an even share of the rate limit, and its traffic is
+        added to the metrics of the tree's rate limiter.
+        '''
+        if self._subcompaction_pool is None:
+            self._subcompaction_pool = ProcessPoolExecutor(max_workers=self._max_subcompactions)
+
+        rate = self.rate_limiter.bytes_per_sec
+        worker_rate = None if rate is None else rate / min(len(ranges), self._max_subcompactions)
+        part_paths = [new_path + '_part' + str(i) for i in range(len(ranges))]
+        futures = [self._subcompaction_pool.submit(_merge_key_range, path1, path2, part_path,
+                                                   lower, upper, keep_expired,
+                                                   build_filter, self._sparsity(),
+                                                   RateLimiter(worker_rate), codec)
+                   for part_path, (lower, upper) in zip(part_paths, ranges)]
+        parts = [future.result() for future in futures]
+        for part in parts:
+            self.rate_limiter.record(part['offset'], part['throttled_time'])
+
+        with open(new_path, 'wb') as segment, ThrottledWriter(segment, self.rate_limiter) as s0:
+            writer = SegmentWriter(s0, *codec)
+            for part_path, part in zip(part_paths, parts):
+                with open(part_path, 'rb') as source:
+                    writer.add_blocks(source, part['blocks'])
+                remove_file(part_path)
+            writer.finish()
+        return parts
+
+    def _shutdown_subcompactions(self):
+        ''' (self) -> None
+        Shuts down the worker processes of subcompactions, if any were started.
+        '''
+        if self._subcompaction_pool is not None:
+            self._subcompaction_pool.shutdown()
+            self._subcompaction_pool = None
+
+    def _may_exist_in(self, key, segments):
+        ''' (self, str, list) -> bool
+        Returns True if the cuckoo filters of any of segments report key.
+        '''
+        for segment in segments:
+            for ckf in self.meta_dict[segment]:
+                if self.ckfs_in_memory[ckf].check(key):
+                    return True
+        return False
 
     # Configuration methods
     def set_size_threshold(self, threshold):
@@ -314,6 +791,239 @@ class LSMTreeCuckoo():
         '''
         self._time_threshold = time_threshold
 
+    def set_subcompactions(self, max_subcompactions, min_size=64):
+        ''' (self, int, int) -> None
+        Sets how many worker processes split a merge by key range, and the 
+        combined size of the merged segments, in megabytes, from which merges
+        are split. Set max_subcompactions to 1 to merge in a single process.
+        '''
+        self._max_subcompactions = max_subcompactions
+        self._subcompaction_size = min_size
+        self._shutdown_subcompactions()
+
+    def set_compaction_triggers(self, max_level_files=10, tombstone_ratio=0.5, max_read_amp=8):
+        ''' (self, int, float, int) -> None
+        Sets when a level is merged before its time threshold: once it holds more
+        than max_level_files segments, once more than tombstone_ratio of the records
+        of its oldest segments carry an expired ttl, or once a lookup may have to
+        open more than max_read_amp of its segments.
+        '''
+        self._max_level_files = max_level_files
+        self._tombstone_ratio = tombstone_ratio
+        self._max_read_amp = max_read_amp
+
+    def set_rate_limit(self, bytes_per_sec):
+        ''' (self, int) -> None
+        Sets the rate, in bytes per second, that flushes, merges, segment rewrites
+        and filter saves are throttled to. None lifts the limit.
+        '''
+        self.rate_limiter = RateLimiter(bytes_per_sec)
+
+    def set_resident_filter_budget(self, num_bytes):
+        ''' (self, int) -> None
+        Sets the bytes of filters kept in memory. The least recently probed
+        filters beyond it are paged out to filter_dir and mapped back when next
+        probed. None keeps every filter in memory.
+        '''
+        self.ckfs_in_memory.set_budget(num_bytes)
+
+    def filter_stats(self):
+        ''' (self) -> dict
+        Returns the resident and total bytes of the filters, how often filters
+        were paged in and out, and how many segments range scans skipped
+        thanks to range filters and how many they read.
+        '''
+        stats = self.ckfs_in_memory.stats()
+        stats.update(range_skips=self.range_skips, range_reads=self.range_reads)
+        return stats
+
+    def set_negative_cache(self, capacity):
+        ''' (self, int) -> None
+        Sets how many keys confirmed missing by db_get are remembered, so that
+        looking them up again costs no filter probe nor segment read. Writing
+        a key forgets it. Flushes and merges only move keys that were written,
+        so they never make a cached key present. 0 disables the cache.
+        '''
+        self._negative_cache.set_capacity(capacity)
+
+    def set_compression(self, *codecs):
+        ''' (self, (str, int), ...) -> None
+        Sets the codec, one of 'none', 'zlib', 'bz2' or 'lzma', and compression
+        level the blocks of new segments are compressed with, as (codec, level)
+        pairs. One pair applies to every level; three pairs apply to the first,
+        second and third level, e.g. a fast codec for the first level and a
+        dense one for the third. A level of None uses the codec's default.
+        Segments already written keep their codec until they are rewritten.
+        '''
+        for codec, _ in codecs:
+            if codec not in CODECS:
+                raise ValueError('Unknown codec ' + str(codec))
+        if len(codecs) == 1:
+            codecs = codecs * 3
+        if len(codecs) != 3:
+            raise ValueError('Expected one codec or one per level')
+        self._codecs = [tuple(codec) for codec in codecs]
+
+    def set_block_cache(self, num_bytes):
+        ''' (self, int) -> None
+        Sets the bytes of decompressed blocks kept for lookups and range scans.
+        0 disables the cache.
+        '''
+        self.block_cache.set_capacity(num_bytes)
+
+    def set_verify_checksums(self, enabled):
+        ''' (self, bool) -> None
+        Sets whether point lookups and range scans check the blocks they read
+        from disk against their checksum, raising CorruptSegmentError on a
+        mismatch. Merges always check them, so corruption isn't spread to new
+        segments.
+        '''
+        self._verify_checksums = enabled
+
+    def start_scrubber(self, bytes_per_sec=None, interval=3600):
+        ''' (self, int, float) -> None
+        Starts checking the checksums of every segment of every level in a
+        background thread, reading at most bytes_per_sec bytes per second and
+        starting a pass every interval seconds. The bad segments found are
+        reported by scrub_stats.
+        '''
+        self.scrubber.rate_limiter = RateLimiter(bytes_per_sec)
+        self.scrubber.interval = interval
+        self.scrubber.start()
+
+    def stop_scrubber(self):
+        self.scrubber.stop()
+
+    def scrub(self):
+        ''' (self) -> dict
+        Checks the checksums of every segment once, returning the bad segments
+        with their error.
+        '''
+        return self.scrubber.scrub()
+
+    def scrub_stats(self):
+        ''' (self) -> dict
+        Returns the passes of the scrubber, the segments and bytes it checked
+        and the bad segments it found.
+        '''
+        return self.scrubber.stats()
+
+    def set_value_log(self, threshold=4096, max_file_size=64*1024*1024):
+        ''' (self, int, int) -> None
+        Moves values of at least threshold bytes, or characters for str
+        values, to a value log when they are flushed, leaving a pointer in the
+        segments. Merges then only rewrite keys and pointers. The log starts a
+        new file every max_file_size bytes, and collect_value_log reclaims the
+        space of dead values. A threshold of None stops moving values; the
+        ones moved stay readable.
+        '''
+        self._value_threshold = threshold
+        self._vlog_file_size = max_file_size
+        if self.value_log is None:
+            self.value_log = ValueLog(self.segments_directory, max_file_size=max_file_size)
+        self.value_log.max_file_size = max_file_size
+
+    def collect_value_log(self, max_files=1):
+        ''' (self, int) -> (int, int)
+        Garbage collects up to max_files of the oldest value log files. The
+        values the tree still points to are appended to the log again and
+        written back with their new pointer, the others are dropped with their
+        file. Returns the bytes of values moved and reclaimed.
+        '''
+        if self.value_log is None:
+            return 0, 0
+        moved = reclaimed = 0
+        for number in self.value_log.sealed_files()[:max_files]:
+            live, dead = self.value_log.collect(number, self._relocate_value)
+            moved += live
+            reclaimed += dead
+        return moved, reclaimed
+
+    def value_log_stats(self):
+        ''' (self) -> dict
+        Returns the bytes and files of the value log, the bytes appended to it
+        and the bytes garbage collection moved and reclaimed.
+        '''
+        return {} if self.value_log is None else self.value_log.stats()
+
+    def _relocate_value(self, key, value, pointer):
+        ''' (self, str, str, ValuePointer) -> bool
+        Appends value again to the value log if the newest record of key
+        points to it at pointer, storing the new pointer, and returns whether
+        it did.
+        '''
+        record = self._newest_record(key)
+        if record is None or record[0] != pointer or self._is_expired(record[1]):
+            return False
+        self._put(key, self.value_log.append(key, value), record[1])
+        return True
+
+    def _newest_record(self, key):
+        ''' (self, str) -> (str, float)
+        Returns the value, as stored, and expiry timestamp of the newest
+        record of key, or None.
+        '''
+        node = self._memtable.find_node(key)
+        if node:
+            return node.value, node.expiry
+        for segment in self.catalog.newest_first(self.meta_dict):
+            if not self._within_fences(key, segment):
+                continue
+            if any(self.ckfs_in_memory[ckf].check(key) for ckf in self.meta_dict[segment]):
+                record = self._search_segment(key, segment)
+                if record is not None:
+                    return record
+        return None
+
+    def _resolve(self, value):
+        ''' (self, str) -> str
+        Returns value, read from the value log if it is a pointer.
+        '''
+        if isinstance(value, ValuePointer):
+            return self.value_log.read(value)
+        return value
+
+    def _view(self, value):
+        ''' (self, str) -> memoryview
+        Returns value as a read-only memoryview, read from the value log if it
+        is a pointer. Views and bytes are not copied.
+        '''
+        if value is None or isinstance(value, memoryview):
+            return value
+        if isinstance(value, ValuePointer):
+            return self.value_log.read(value, view=True)
+        return memoryview(value if isinstance(value, bytes) else value.encode())
+
+    @staticmethod
+    def _entry_size(key, value):
+        return len(key) + (POINTER.size if isinstance(value, ValuePointer) else len(value))
+
+    def _scrubbed_segments(self):
+        ''' (self) -> [(str, str)]
+        Returns the name and path of every segment, level by level.
+        '''
+        return [(segment, self._segment_path(segment))
+                for level in (self.first_level, self.second_level, self.third_level)
+                for segment in list(level)]
+
+    def lookup_stats(self):
+        ''' (self) -> dict
+        Returns the filter probes and segment reads of point lookups, along
+        with the hits of the negative cache and the probes and reads they
+        saved, and the bytes, hits and misses of the block cache.
+        '''
+        stats = self._negative_cache.stats()
+        stats.update(filter_probes=self.filter_probes, segment_reads=self.segment_reads)
+        stats.update(('block_' + name, value) for name, value in self.block_cache.stats().items())
+        return stats
+
+    def io_stats(self):
+        ''' (self) -> dict
+        Returns the bytes written by background writers and the seconds they 
+        spent throttled, for flushes (HIGH) and compactions (LOW).
+        '''
+        return self.rate_limiter.stats()
+
     def set_levels_threshold(self, lvl1_size, lvl2_size):
         ''' (self, int) -> None
         Sets the max level size at which a segment is moved in between levels
@@ -329,45 +1039,92 @@ class LSMTreeCuckoo():
         '''
         return AppendLog.instance(self._memtable_wal_path())
 
-    def _search_all_segments(self, key):
-        ''' (self, str) -> str
+    def _search_all_segments(self, key, view=False):
+        ''' (self, str, bool) -> str
         Searches all segments on disk for key by checking
-        cuckoo filters firts.
+        cuckoo filters firts. With view, the value is a memoryview.
         '''
-        for segment, ckf_tup in reversed(list(self.meta_dict.items())):
-            for ckf in ckf_tup:
+        for segment in self.catalog.newest_first(self.meta_dict):
+            if not self._within_fences(key, segment):
+                continue
+            for ckf in self.meta_dict[segment]:
+                self.filter_probes += 1
                 if self.ckfs_in_memory[ckf].check(key):
-                    value = self._search_segment(key, segment)
-                    if value != None:
-                        return value
+                    self.segment_reads += 1
+                    record = self._search_segment(key, segment, view)
+                    if record != None:
+                        value, expiry = record
+                        return None if self._is_expired(expiry) else value
+                    self._learn_false_positives([(key, ckf)])
                     
-    def _search_segment(self, key, segment_name):
-        ''' (self, str) -> str
-        Returns the value associated with key in the segment represented
-        by segment_name, if it exists. Otherwise return None.
+    def _search_segment(self, key, segment_name, view=False):
+        ''' (self, str, str, bool) -> (str, float)
+        Returns the value and expiry timestamp associated with key in the
+        segment represented by segment_name, if it exists. Otherwise return None.
+        With view, the value is a memoryview of the block holding it.
         '''
-        with open(self._segment_path(segment_name), 'r') as s:
-            pairs = [line.strip() for line in s]
+        reader = SegmentReader(self._segment_path(segment_name), self.block_cache, self._verify_checksums)
+        return reader.get_view(key) if view else reader.get(key)
 
-            while len(pairs):
-                ptr = (len(pairs) - 1) // 2
-                k, v = pairs[ptr].split(',', 1)
+    def _scan(self, start, end, may_match):
+        ''' (self, str, str, callable) -> [(str, str)]
+        Returns the live (key, value) pairs with start <= key < end, in key
+        order, the newest record of a key winning. A segment is only read if
+        its fences overlap the range and may_match, called with its range
+        filter, says it may hold a key of the range.
+        '''
+        results = dict()
+        for node in self._memtable.in_order():
+            if start <= node.key and (end is None or node.key < end):
+                results[node.key] = None if self._is_expired(node.expiry) else node.value
 
-                if k == key:
-                    return v
+        for segment in self.catalog.newest_first(self.meta_dict):
+            info = self.catalog[segment]
+            if info.key_count == 0 or info.max_key < start or (end is not None and info.min_key >= end):
+                continue
+            range_filter = self.range_filters.get(segment)
+            if range_filter is not None and not may_match(self.ckfs_in_memory[range_filter]):
+                self.range_skips += 1
+                continue
+            self.range_reads += 1
+            for key, expiry, value, _ in _read_key_range(self._segment_path(segment), start, end,
+                                                           self.block_cache, self._verify_checksums):
+                if key not in results:
+                    results[key] = None if self._is_expired(expiry) else value
 
-                if key < k:
-                    pairs = pairs[0:ptr]
-                else:
-                    pairs = pairs[ptr+1:]
+        results = ((key, self._resolve(value)) for key, value in sorted(results.items()))
+        return [(key, value) for key, value in results if value is not None]
+
+    def _within_fences(self, key, segment_name):
+        ''' (self, str, str) -> bool
+        Returns False if key falls outside the smallest and largest keys
+        written to the segment represented by segment_name.
+        '''
+        info = self.catalog[segment_name]
+        if info.key_count == 0:
+            return False
+        return info.min_key <= key <= info.max_key
+
+    def _segment_keys(self, segment_name):
+        ''' (self, str) -> list
+        Returns the keys of the segment represented by segment_name, in order.
+        '''
+        return SegmentReader(self._segment_path(segment_name)).keys()
+
+    def _search_segment_many(self, keys, segment_name):
+        ''' (self, set, str) -> dict
+        Returns the (value, expiry timestamp) of every key of keys found in the
+        segment represented by segment_name, reading the segment once.
+        '''
+        return SegmentReader(self._segment_path(segment_name), self.block_cache,
+                             self._verify_checksums).get_many(keys)
 
     def _check_seg_time(self, seg_name):
         ''' (self) -> str
         Returns True or False if the time for merging is passed.
         It will merge the two oldest files of the system.
         '''
-        mod_time = os.path.getmtime(self.segments_directory+seg_name)
-        mod_date = datetime.fromtimestamp(mod_time)
+        mod_date = datetime.fromtimestamp(self.catalog[seg_name].created)
         current_time = datetime.now()                
         time_diff = current_time-mod_date                
         if self._time_threshold < time_diff.total_seconds()/(60*60):                
@@ -382,39 +1139,273 @@ class LSMTreeCuckoo():
         Warning - this operation re-initializes the structure.
         '''
         self._ckf_false_pos_prob = probability
-        self._cuckoo_filter = CuckooFilter(self._ckf_num_items, self._ckf_false_pos_prob)
+        self._cuckoo_filter = ScalableCuckooFilter(self._ckf_num_items, self._ckf_false_pos_prob)
         
+    def set_static_filters(self, enabled):
+        ''' (self, bool) -> None
+        Sets whether third level segments get static xor filters, which take
+        1.23 cells per key, each the narrowest of 8, 16, 32 or 64 bits holding a
+        log2(1/fpp) bit fingerprint, instead of cuckoo filters. Keys deleted
+        from those segments keep passing the filter until the segment is merged
+        again. Segments already in the third level keep their filters.
+        '''
+        self._static_filters = enabled
+
+    def set_adaptive_filters(self, enabled):
+        ''' (self, bool) -> None
+        Sets whether segments get adaptive cuckoo filters, which stop letting
+        through a missing key once reading the segment proved it a false
+        positive. Repeated lookups for the same missing keys then stop reading
+        segments. Filters adapt from the owner tags they keep next to their
+        fingerprints, without reading the segment again, which takes about
+        twice the memory of a cuckoo filter. Segments keep their filters until
+        they are merged.
+        '''
+        self._adaptive_filters = enabled
+
+    def set_range_filters(self, prefix_lengths=(4, 8)):
+        ''' (self, tuple) -> None
+        Sets the key prefix lengths of the range filters, prefix bloom filters
+        built for every new segment, which let range scans and prefix queries
+        skip segments holding none of their keys. Pick lengths matching how
+        keys are queried: a prefix query is filtered at the longest length not
+        above the prefix, a range scan at the longest length where both bounds
+        only differ in the last character. None stops building range filters
+        and drops the existing ones.
+        '''
+        self._range_prefixes = None if prefix_lengths is None else tuple(prefix_lengths)
+        if prefix_lengths is None:
+            for segment in list(self.range_filters):
+                self._drop_range_filter(segment)
+
+    def set_filter_memory_budget(self, num_bytes):
+        ''' (self, int) -> None
+        Sets the memory, in bytes, the filters of all segments may take. The
+        budget is split across levels so that a lookup for a missing key reads
+        as few segments as possible: the false positive probability of a
+        level's filters is proportional to their size. New filters are built
+        with their level's probability, existing ones keep theirs until
+        rewritten. None goes back to the same probability everywhere.
+        '''
+        self._filter_memory_budget = num_bytes
+        self._tune_filters()
+        if self._fit_filters():
+            self._log_version_edit()
+
+    def expected_io(self):
+        ''' (self) -> float
+        Returns the number of segments a lookup for a missing key is expected
+        to read because of false positives, with the current level tuning.
+        '''
+        if self._tuning is None:
+            return len(self.meta_dict) * self._ckf_false_pos_prob
+        return self._tuning.expected_io
+
+    def _tune_filters(self):
+        ''' (self) -> None
+        Splits the filter memory budget across the current levels.
+        '''
+        if self._filter_memory_budget is None:
+            self._tuning = None
+            return
+        levels = []
+        for lvl in (self.first_level, self.second_level, self.third_level):
+            keys = sum(self.catalog[seg].key_count for seg in lvl)
+            count = len(lvl)
+            # The memtable being filled is the next segment of the first level
+            if lvl is self.first_level:
+                keys, count = keys + self._size_threshold, count + 1
+            levels.append((count, keys // count if count else 0))
+        self._tuning = allocate_fpps(levels, self._filter_memory_budget * 8, self._filter_models(), max_fpp=0.5)
+
+    def _filter_models(self):
+        ''' (self) -> list
+        Returns the bits per key model of the filters of each level.
+        '''
+        cuckoo = adaptive_cuckoo_bits_per_key if self._adaptive_filters else cuckoo_bits_per_key
+        return [cuckoo, cuckoo, xor_bits_per_key if self._static_filters else cuckoo]
+
+    def _fit_filters(self):
+        ''' (self) -> bool
+        Filters keep the probability they were built with, so after levels were
+        retuned, those built for an earlier tuning may take more memory than the
+        budget leaves. Until the filters and the one of the next flush fit, the
+        filter saving the most memory is rebuilt with the probability of its
+        level. Returns whether any filter was rebuilt.
+        '''
+        if self._tuning is None:
+            return False
+        models, fpps = self._filter_models(), self._tuning.fpps
+        next_flush = models[0](fpps[0], self._size_threshold) * self._size_threshold / 8
+        excess = self.ckfs_in_memory.total_bytes() + next_flush - self._filter_memory_budget
+        if excess <= 0:
+            return False
+
+        savings = []
+        levels = (self.first_level, self.second_level, self.third_level)
+        for number, (lvl, model, fpp) in enumerate(zip(levels, models, fpps)):
+            for seg in lvl:
+                keys = max(self.catalog[seg].key_count, 1)
+                current = sum(self.ckfs_in_memory.nbytes(ckf) for ckf in self.meta_dict[seg])
+                saving = current - model(fpp, keys) * keys / 8
+                if saving > 0:
+                    savings.append((saving, number, seg))
+
+        refitted = False
+        for saving, number, seg in sorted(savings, reverse=True):
+            if excess <= 0:
+                break
+            static = self._static_filters and number == 2
+            self._create_new_ckf(seg, self.meta_dict[seg], self.meta_dict, self._segment_keys(seg), static,
+                                 fpps[number])
+            excess -= saving
+            refitted = True
+        return refitted
+
+    def _level_fpp(self, segments):
+        ''' (self, list) -> float
+        Returns the false positive probability for new filters of the level
+        segments.
+        '''
+        if self._tuning is None:
+            return self._ckf_false_pos_prob
+        return self._tuning.fpps[self._level_number(segments)]
+
+    def _level_number(self, segments):
+        levels = [self.first_level, self.second_level, self.third_level]
+        return [lvl is segments for lvl in levels].index(True)
+
+    def _level_of(self, segment_name):
+        ''' (self, str) -> list
+        Returns the level holding the segment represented by segment_name.
+        '''
+        for level in (self.first_level, self.second_level, self.third_level):
+            if segment_name in level:
+                return level
+        return self.first_level
+
+    def _codec(self, segments):
+        ''' (self, list) -> (str, int)
+        Returns the (codec, compression level) new segments of the level
+        segments are compressed with.
+        '''
+        return self._codecs[self._level_number(segments)]
+
+    def _delete_from_filter(self, ckf_name, key):
+        ''' (self, str, str) -> bool
+        Removes key from the filter named ckf_name, returning whether it may
+        have held it. A static filter can't forget a key, so it is only checked.
+        '''
+        ckf = self.ckfs_in_memory[ckf_name]
+        if isinstance(ckf, XorFilter):
+            return ckf.check(key)
+        if ckf.delete(key):
+            self.ckfs_in_memory.mark_dirty(ckf_name)
+            return True
+        return False
+
+    def _owning_filter(self, ckf_tuple, key):
+        ''' (self, tuple, str) -> str
+        Returns the name of the filter in ckf_tuple that holds the fingerprint of
+        key, or None if none may hold it. The filters of a merged segment come
+        from both inputs, so more than one may match, all but one through a
+        fingerprint of another key. The match in the largest table is picked, a
+        fingerprint there having to share the most bucket index bits with key.
+        '''
+        owner, owner_capacity = None, 0
+        for name in ckf_tuple:
+            ckf = self.ckfs_in_memory[name]
+            if isinstance(ckf, XorFilter):
+                capacity = ckf.capacity if ckf.check(key) else 0
+            else:
+                capacity = ckf.holding_capacity(key)
+            if capacity > owner_capacity:
+                owner, owner_capacity = name, capacity
+        return owner
+
+    def _learn_false_positives(self, misses):
+        ''' (self, [(str, str)]) -> None
+        Adapts the filters of a segment to the (key, filter name) pairs in
+        misses, keys their filter let through but the segment doesn't hold.
+        Filters keep the owner of every cell, so the segment isn't read again.
+        '''
+        for key, ckf in misses:
+            cuckoo_filter = self.ckfs_in_memory[ckf]
+            if isinstance(cuckoo_filter, AdaptiveCuckooFilter) and cuckoo_filter.adapt(key):
+                self.ckfs_in_memory.mark_dirty(ckf)
+
+    def _add_range_filter(self, segment_name, keys):
+        ''' (self, str, list) -> None
+        Builds the range filter of the segment represented by segment_name from
+        its keys, if range filters are enabled.
+        '''
+        if self._range_prefixes is None:
+            return
+        range_filter = PrefixBloomFilter(len(keys), self._ckf_false_pos_prob, self._range_prefixes)
+        range_filter.add_many(keys)
+        name = 'rf-' + segment_name.split('-')[-1]
+        self.ckfs_in_memory[name] = range_filter
+        self.range_filters[segment_name] = name
+
+    def _drop_range_filter(self, segment_name):
+        name = self.range_filters.pop(segment_name, None)
+        if name is not None:
+            self.ckfs_in_memory.pop(name)
+
+    def _build_filter(self, keys, fpp, static=False):
+        ''' (self, list, float, bool) -> object
+        Returns a new filter holding keys, sized from their exact number: a xor
+        filter if static is set, otherwise an adaptive or scalable cuckoo filter.
+        '''
+        if static:
+            return XorFilter(keys, fpp)
+        if self._adaptive_filters:
+            cuckoo_filter = AdaptiveCuckooFilter(max(len(keys), 1), fpp)
+        else:
+            cuckoo_filter = ScalableCuckooFilter(max(len(keys), 1), fpp)
+        cuckoo_filter.add_many(keys)
+        return cuckoo_filter
+
     def _ckf_compresser(self, ckf_tuple, new_seg, dictionary,ckfs, ckfs_in_memory):
 
+        filters = [ckfs_in_memory[ckf] for ckf in ckf_tuple]
+        if not all(isinstance(ckf, ScalableCuckooFilter) for ckf in filters):
+            return
+
         # Check load
-        total_load = ckfs_in_memory[ckf_tuple[0]].load_factor() + ckfs_in_memory[ckf_tuple[1]].load_factor()
+        total_load = sum(ckf.load_factor() for ckf in filters)
         if total_load > 0.50:
             return
         
         # Make new a cuckoo filter name
         numb_list = [numb.split('-')[-2] for numb in ckf_tuple]
         new_ckf_name = f'ckf-{sum(int(x) for x in numb_list)}'+'-'+new_seg.split('-')[-1]
-        # Append fingerprints of the 2nd ckf to the 1st ckf
-        for index, bucket in enumerate(ckfs_in_memory[ckf_tuple[1]].buckets):
-            for fp in bucket:
-                ckfs_in_memory[ckf_tuple[0]].add_by_fp(fp, index)
+        # Union the fingerprints of every ckf into the 1st ckf
+        target = filters[0]
+        for source in filters[1:]:
+            target.merge(source)
         
         #Update Instances
-        ckfs_in_memory[new_ckf_name] = ckfs_in_memory[ckf_tuple[0]]
-        ckfs_in_memory.pop(ckf_tuple[0])
-        ckfs_in_memory.pop(ckf_tuple[1])
-        ckfs.remove(ckf_tuple[0]), ckfs.remove(ckf_tuple[1]), ckfs.append(new_ckf_name)
+        ckfs_in_memory[new_ckf_name] = target
+        for ckf in ckf_tuple:
+            ckfs_in_memory.pop(ckf)
+            ckfs.remove(ckf)
+        ckfs.append(new_ckf_name)
         dictionary[new_seg] = (new_ckf_name,)
             
-    def _create_new_ckf(self, segment_name, ckf_tuple, dictionary):
+    def _create_new_ckf(self, segment_name, ckf_tuple, dictionary, keys, static=False, fpp=None):
+        ''' (self, str, tuple, dict, list, bool, float) -> None
+        Replaces the filters in ckf_tuple with a single cuckoo filter holding keys,
+        the keys written to the segment represented by segment_name. The filter is
+        sized from the exact number of keys, and is an adaptive cuckoo filter if
+        they are enabled. If static is set, a xor filter is built from keys
+        instead. fpp defaults to the tree's false positive probability.
+        '''
+        fpp = self._ckf_false_pos_prob if fpp is None else fpp
         numb_list = [numb.split('-')[-2] for numb in ckf_tuple]
         total_filter = sum(int(x) for x in numb_list)
-        cuckoo_filter = CuckooFilter(self._ckf_num_items*total_filter, self._ckf_false_pos_prob)
         new_ckf_name = f'ckf-{total_filter}'+'-'+segment_name.split('-')[-1]
-        with open(self._segment_path(segment_name), "r") as s:
-            for line in s:
-                key, _ = line.split(',', 1)
-                cuckoo_filter.add(key)
+        cuckoo_filter = self._build_filter(keys, fpp, static)
         for ckf in ckf_tuple:
             self.ckfs.remove(ckf)
             self.ckfs_in_memory.pop(ckf)
@@ -423,9 +1414,45 @@ class LSMTreeCuckoo():
         dictionary[segment_name] = (new_ckf_name,)
     
     def save_ckfs(self):
-        for ck in self.ckfs:
-            with open(self.filter_dir + ck, 'wb') as cuckoo:
-                pickle.dump(self.ckfs_in_memory[ck], cuckoo)
+        ''' (self) -> None
+        Writes every filter changed since it was last written, in the binary
+        filter format.
+        '''
+        self.ckfs_in_memory.flush()
+
+    def _save_ckf(self, ckf, path):
+        ''' (self, object, str) -> None
+        Writes the filter ckf to path. The file is written aside and renamed
+        over the previous one, which may still be mapped.
+        '''
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f, ThrottledWriter(f, self.rate_limiter) as cuckoo:
+            write_filter(ckf, cuckoo)
+        rename_file(temp_path, path)
+
+    def load_ckfs(self):
+        ''' (self) -> None
+        Registers the saved filters of every segment, which are mapped the first
+        time they are probed. The filter of a segment whose file is missing,
+        because it was never saved, is rebuilt from its keys.
+        '''
+        for segment, ckf_tuple in self.meta_dict.items():
+            for ckf in ckf_tuple:
+                if Path(self._ckf_path(ckf)).exists():
+                    self.ckfs_in_memory.register(ckf)
+                    continue
+                keys = self._segment_keys(segment)
+                level = next(lvl for lvl in (self.first_level, self.second_level, self.third_level)
+                             if segment in lvl)
+                static = self._static_filters and level is self.third_level
+                self.ckfs_in_memory[ckf] = self._build_filter(keys, self._level_fpp(level), static)
+
+        for segment, name in list(self.range_filters.items()):
+            if Path(self._ckf_path(name)).exists():
+                self.ckfs_in_memory.register(name)
+            else:
+                self.range_filters.pop(segment)
+                self._add_range_filter(segment, self._segment_keys(segment))
 
     # Index helpers
     def _sparsity(self):
@@ -445,34 +1472,28 @@ class LSMTreeCuckoo():
             path = self._segment_path(segment)
 
             counter = self._sparsity()
-            bytes = 0
-            with open(path, 'r') as s:
-                for line in s:
-                    key, val = line.strip().split(',', 1)
-                    if counter == 1:
-                        self._index.add(key, val, offset=bytes, segment=segment)
-                        counter = self._sparsity() + 1
-
-                    bytes += len(line)
-                    counter -= 1
+            for key, _, val, _, offset in SegmentReader(path).records():
+                if counter == 1:
+                    self._index.add(key, val, offset=offset, segment=segment)
+                    counter = self._sparsity() + 1
+                counter -= 1
 
     def restore_memtable(self):
         ''' (self) -> None
         Re-populates the memtable from the disk backup.
         '''
         if Path(self._memtable_wal_path()).exists():
-            with open(self._memtable_wal_path(), 'r') as s:
-                for line in s:
-                    key, value = line.strip().split(',', 1)
-                    self._memtable.add(key, value)
-                    self._memtable.total_bytes += len(key) + len(value)
+            for key, expiry, value in read_log(self._memtable_wal_path(), repair=True):
+                self._memtable.add(key, value, expiry=expiry)
+                self._memtable.total_bytes += self._entry_size(key, value)
+            self._count = self._memtable.count
 
     # Path generators
     def _current_segment_path(self):
         return self.segments_directory + self.current_segment
     
     def _current_ckf_path(self):
-        return self.segments_directory + self._current_ckf
+        return self._ckf_path(self._current_ckf)
 
     def _memtable_wal_path(self):
         ''' (self) -> str
@@ -488,56 +1509,149 @@ class LSMTreeCuckoo():
     
     def _ckf_path(self, ckf_name):
         ''' (self, str) -> str
-        Returns the path to the given ckf_name.
+        Returns the path of the file the filter ckf_name is saved to.
         '''
-        return self.segments_directory + ckf_name +'.pickle'
-
-    def metadata_path(self):
-        ''' (self) -> str
-        Returns the path to the metadata backup file.
-        '''
-        return self.segments_directory + 'database_metadata'
+        return self.filter_dir + ckf_name
 
     # Metadata and initialization helpers
     def load_metadata(self):
         ''' (self) -> None
         Checks to see if any metadata or memtable logs are present from the previous
         session, and load them into the system.
+
+        Metadata is recovered from the manifest, replaying its version edits
+        over its checkpoint, then checkpointed again in a fresh manifest file.
         '''
-        if Path(self.metadata_path()).exists():
-            with open(self.metadata_path(), 'rb') as s:
-                metadata = pickle.load(s)
-                self.first_level = metadata['first_level']
-                self.second_level = metadata['second_level']
-                self.meta_dict = metadata['meta_dict']
-                self._count = metadata['count']
-                self._time_threshold = metadata['_time_threshold']
-                self.current_segment = metadata['current_segment']
-                self._current_ckf = metadata['current_ckf']
-                self._cuckoo_filter = metadata['cuckoo_filter']
-                self._ckf_num_items = metadata['ckf_num_items']
-                self._ckf_false_pos_prob = metadata['ckf_false_pos']
-                self._index = metadata['index']
+        if self.manifest.exists():
+            snapshot, edits = self.manifest.recover()
+            for edit in edits:
+                self._apply_version_edit(snapshot, edit)
+            self.first_level, self.second_level, self.third_level = snapshot['levels']
+            self.meta_dict = dict()
+            self.range_filters = dict()
+            self.catalog = SegmentCatalog()
+            for segment, (filters, info, range_filter) in snapshot['segments'].items():
+                self.meta_dict[segment] = filters
+                self.catalog.put(SegmentInfo(**info))
+                if range_filter is not None:
+                    self.range_filters[segment] = range_filter
+            for field, attribute in self._METADATA_FIELDS.items():
+                if field in snapshot['fields']:
+                    setattr(self, attribute, snapshot['fields'][field])
+            if self._vlog_file_size is not None:
+                self.set_value_log(self._value_threshold, self._vlog_file_size)
+            self._rebuild_index()
+            self._tune_filters()
+            self.load_ckfs()
+            self._manifest_state = None
+            self._log_version_edit()
+
+    # Metadata fields saved in the manifest, by the attribute holding them
+    _METADATA_FIELDS = {
+        'ckfs': 'ckfs',
+        '_time_threshold': '_time_threshold',
+        'current_segment': 'current_segment',
+        'current_ckf': '_current_ckf',
+        'cuckoo_filter': '_cuckoo_filter',
+        'ckf_num_items': '_ckf_num_items',
+        'ckf_false_pos': '_ckf_false_pos_prob',
+        'static_filters': '_static_filters',
+        'adaptive_filters': '_adaptive_filters',
+        'range_prefixes': '_range_prefixes',
+        'filter_memory_budget': '_filter_memory_budget',
+        'codecs': '_codecs',
+        'value_threshold': '_value_threshold',
+        'vlog_file_size': '_vlog_file_size'
+    }
 
     def save_metadata(self):
         ''' (self) -> None
         Save necessary bookkeeping information.
+
+        Only what changed since the last save is written, as a version edit
+        appended to the manifest. Flushes, merges and deletions rewriting a
+        segment save it as well, so that a crash loses none of the levels.
+        '''
+        self._log_version_edit()
+
+    def _version(self):
+        ''' (self) -> dict
+        Returns the metadata saved in the manifest: the segments of each level,
+        the filters, catalog entry and range filter of every segment, and the
+        fields of _METADATA_FIELDS.
         '''
-        bookkeeping_info = {
-            'first_level': self.first_level,
-            'second_level': self.second_level,
-            'meta_dict': self.meta_dict, 
-            'count': self._count,
-            '_time_threshold': self._time_threshold,
-            'current_segment': self.current_segment,
-            'current_ckf': self._current_ckf,
-            'cuckoo_filter': self._cuckoo_filter,
-            'ckf_num_items': self._ckf_num_items,
-            'ckf_false_pos': self._ckf_false_pos_prob,
-            'index': self._index
+        return {
+            'levels': [list(level) for level in (self.first_level, self.second_level, self.third_level)],
+            'segments': {segment: (filters, dict(vars(self.catalog[segment])), self.range_filters.get(segment))
+                         for segment, filters in self.meta_dict.items()},
+            'fields': {field: self._saved_field(getattr(self, attribute))
+                       for field, attribute in self._METADATA_FIELDS.items()}
+        }
+
+    @staticmethod
+    def _saved_field(value):
+        # Lists are changed in place, so the manifest keeps a copy to compare with
+        return list(value) if isinstance(value, list) else value
+
+    def _log_version_edit(self):
+        ''' (self) -> None
+        Appends to the manifest the segments added, changed or removed, the
+        levels whose segments changed and the fields that changed since the
+        version last written. A checkpoint of the whole version is written
+        instead when the manifest is due for one.
+        '''
+        version = self._version()
+        if self._manifest_state is None or self.manifest.needs_checkpoint():
+            self.manifest.checkpoint(version)
+            self._manifest_state = version
+            self._remove_obsolete_segments()
+            return
+
+        previous = self._manifest_state
+        edit = {
+            'segments': {segment: description for segment, description in version['segments'].items()
+                         if previous['segments'].get(segment) != description},
+            'removed': [segment for segment in previous['segments'] if segment not in version['segments']],
+            'levels': {number: level for number, level in enumerate(version['levels'])
+                       if level != previous['levels'][number]},
+            'fields': {field: value for field, value in version['fields'].items()
+                       if field not in previous['fields'] or previous['fields'][field] != value}
         }
+        if any(edit.values()):
+            self.manifest.log(edit)
+        self._manifest_state = version
+        self._remove_obsolete_segments()
+
+    def _remove_obsolete_segments(self):
+        for path in self._obsolete_segments:
+            self.block_cache.discard(path)
+            if Path(path).exists():
+                remove_file(path)
+        self._obsolete_segments = []
+
+    @staticmethod
+    def _apply_version_edit(version, edit):
+        ''' (dict, dict) -> None
+        Applies edit, read from the manifest, to version.
+        '''
+        version['segments'].update(edit['segments'])
+        for segment in edit['removed']:
+            version['segments'].pop(segment, None)
+        for number, level in edit['levels'].items():
+            version['levels'][number] = level
+        version['fields'].update(edit['fields'])
 
-        with open(self.metadata_path(), 'wb') as s:
-            pickle.dump(bookkeeping_info, s)
+    def _rebuild_index(self):
+        ''' (self) -> None
+        Rebuilds the sparse index from the first key of every block of every
+        segment, which only takes reading the block indexes.
+        '''
+        self._index = RedBlackTree()
+        for segment in self.catalog.newest_first(self.meta_dict)[::-1]:
+            reader = SegmentReader(self._segment_path(segment))
+            as_bytes = isinstance(self.catalog[segment].min_key, bytes)
+            for first_key, offset in zip(reader.first_keys, reader.offsets):
+                key = first_key if as_bytes else first_key.decode()
+                self._index.add(key, offset=offset, segment=segment)
 
     
\ No newline at end of file
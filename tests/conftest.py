@@ -0,0 +1,27 @@
+import pytest
+
+from tools.write_append_log import AppendLog
+from lsm_tree.GenOne.lsm_tree_cuckoo_filter_mem import LSMTreeCuckoo
+
+@pytest.fixture
+def make_tree(tmp_path):
+    ''' Returns a function opening an LSMTreeCuckoo in tmp_path, a fresh one or
+    the one a previous call left on disk. '''
+    directory = str(tmp_path) + '/'
+    (tmp_path / 'filters').mkdir(exist_ok=True)
+    trees = []
+
+    def make():
+        # The write ahead log is a singleton, every tree needs its own
+        if hasattr(AppendLog, '_instance'):
+            AppendLog._instance.stream.close()
+            del AppendLog._instance
+        trees.append(LSMTreeCuckoo('Seg', directory, 'wal', directory + 'filters/'))
+        return trees[-1]
+
+    yield make
+    for tree in trees:
+        tree.close()
+    if hasattr(AppendLog, '_instance'):
+        AppendLog._instance.stream.close()
+        del AppendLog._instance
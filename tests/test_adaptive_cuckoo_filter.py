@@ -0,0 +1,69 @@
+import pytest
+
+from PDS.cuckoo_filter import AdaptiveCuckooFilter
+from PDS.filter_io import FilterFormatError, HEADER, MAGIC, VERSION, save_filter, load_filter
+
+def build(num_keys=2000, fpp=0.05):
+    keys = ['key%d' % i for i in range(num_keys)]
+    flt = AdaptiveCuckooFilter(num_keys, fpp)
+    flt.add_many(keys)
+    return flt, keys
+
+def false_positives(flt, probes):
+    return [item for item in probes if flt.check(item)]
+
+def test_adapt_removes_false_positives_without_false_negatives():
+    flt, keys = build()
+    probes = ['miss%d' % i for i in range(20000)]
+    misses = false_positives(flt, probes)
+    assert misses
+    for item in misses:
+        # Adapting a cell may already have cleared a later item colliding with it
+        assert flt.adapt(item) > 0 or not flt.check(item)
+    assert len(false_positives(flt, misses)) < len(misses) // 4
+    assert all(flt.check_many(keys))
+
+def test_delete_removes_own_cell():
+    flt, keys = build()
+    for item in false_positives(flt, ['miss%d' % i for i in range(20000)]):
+        flt.adapt(item)
+    for key in keys[:500]:
+        assert flt.delete(key)
+    assert all(flt.check_many(keys[500:]))
+
+def test_owner_tags_survive_reload(tmp_path):
+    flt, keys = build()
+    path = str(tmp_path / 'ckf')
+    save_filter(flt, path)
+    loaded = load_filter(path)
+    assert bytes(loaded.owners) == bytes(flt.owners)
+    misses = false_positives(loaded, ['miss%d' % i for i in range(20000)])
+    for item in misses:
+        loaded.adapt(item)
+    assert all(loaded.check_many(keys))
+
+def test_side_structures_are_compact():
+    flt, _ = build()
+    cells = flt.capacity * flt.bucket_size
+    assert flt.table.itemsize == flt.owners.itemsize == 1
+    assert len(flt.selectors) == cells // 4
+    assert AdaptiveCuckooFilter.memory_bits(2000, 0.05) == cells * 18
+    with pytest.raises(ValueError):
+        AdaptiveCuckooFilter(2000, 0.05, num_selectors=5)
+
+def test_packed_selectors_are_independent():
+    flt = AdaptiveCuckooFilter(100, 0.05)
+    for slot in range(8):
+        flt._set_selector(slot, slot % 4)
+    flt._set_selector(2, 1)
+    assert [flt._selector(slot) for slot in range(8)] == [0, 1, 1, 3, 0, 1, 2, 3]
+
+def test_older_format_rejected(tmp_path):
+    flt, _ = build()
+    path = tmp_path / 'ckf'
+    save_filter(flt, str(path))
+    data = bytearray(path.read_bytes())
+    HEADER.pack_into(data, 0, MAGIC, VERSION - 1, HEADER.unpack_from(data)[2])
+    path.write_bytes(bytes(data))
+    with pytest.raises(FilterFormatError):
+        load_filter(str(path))
@@ -0,0 +1,42 @@
+from tools.block_cache import BlockCache
+from tools.sstable import SegmentReader, SegmentWriter
+
+def write_segment(path, records):
+    with open(path, 'wb') as s:
+        writer = SegmentWriter(s, block_size=256)
+        for key, value in records:
+            writer.add(key, value)
+        writer.finish()
+
+def test_index_read_once_per_segment(tmp_path, monkeypatch):
+    path = str(tmp_path / 'seg')
+    write_segment(path, [('key%04d' % i, 'val%d' % i) for i in range(500)])
+    cache = BlockCache()
+    reads = []
+    import tools.sstable
+    original = tools.sstable._read_index
+    monkeypatch.setattr(tools.sstable, '_read_index', lambda *args: reads.append(1) or original(*args))
+    for i in range(0, 500, 50):
+        assert SegmentReader(path, cache).get('key%04d' % i) == ('val%d' % i, None)
+    assert len(reads) == 1
+    assert cache.stats()['cached_indexes'] == 1
+
+def test_discard_drops_index_of_rewritten_segment(tmp_path):
+    path = str(tmp_path / 'seg')
+    write_segment(path, [('key%04d' % i, 'old') for i in range(500)])
+    cache = BlockCache()
+    assert SegmentReader(path, cache).get('key0499') == ('old', None)
+    write_segment(path, [('key%04d' % i, 'new') for i in range(0, 500, 2)])
+    cache.discard(path)
+    assert cache.get_index(path) is None
+    reader = SegmentReader(path, cache)
+    assert reader.get('key0498') == ('new', None)
+    assert reader.get('key0499') is None
+
+def test_index_kept_without_block_capacity(tmp_path):
+    path = str(tmp_path / 'seg')
+    write_segment(path, [('key%04d' % i, 'val') for i in range(100)])
+    cache = BlockCache(0)
+    SegmentReader(path, cache).get('key0001')
+    assert cache.get_index(path) is not None
+    assert cache.stats()['cached_blocks'] == 0
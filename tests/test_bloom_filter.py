@@ -0,0 +1,76 @@
+import pytest
+from mmh3 import hash128
+
+from PDS.bloom_filter import BloomFilter, BlockedBloomFilter, PrefixBloomFilter, BLOCK_BITS
+from PDS.filter_io import save_filter, load_filter
+
+KEYS = ['key%d' % i for i in range(20000)]
+MISSES = ['miss%d' % i for i in range(20000)]
+
+@pytest.mark.parametrize('cls', [BloomFilter, BlockedBloomFilter])
+@pytest.mark.parametrize('fpp', [0.2, 0.001])
+def test_batches_match_single_items(cls, fpp):
+    batch, single = cls(len(KEYS), fpp), cls(len(KEYS), fpp)
+    batch.add_many(KEYS)
+    for key in KEYS:
+        single.add(key)
+    assert batch.bit_array == single.bit_array
+    assert all(batch.check_many(KEYS))
+    assert batch.check_many(MISSES) == [batch.check(item) for item in MISSES]
+
+@pytest.mark.parametrize('cls', [BloomFilter, BlockedBloomFilter])
+def test_batch_positions_match_single_items(cls):
+    bf = cls(len(KEYS), 0.01)
+    positions = bf._positions_many(KEYS[:1000] + [b'\x00bytes'])
+    assert positions.tolist() == [bf._positions(key) for key in KEYS[:1000] + [b'\x00bytes']]
+
+def test_batches_on_loaded_filter(tmp_path):
+    bf = BloomFilter(len(KEYS), 0.01)
+    bf.add_many(KEYS[:10000])
+    save_filter(bf, str(tmp_path / 'bf'))
+    loaded = load_filter(str(tmp_path / 'bf'))
+    loaded.add_many(iter(KEYS[10000:]))
+    assert all(loaded.check_many(KEYS))
+    # The saved filter is left as it was
+    assert not any(load_filter(str(tmp_path / 'bf')).check_many(KEYS[10000:10010]))
+
+def test_prefix_batches():
+    bf = PrefixBloomFilter(1000, 0.01, prefix_lengths=(2, 4))
+    bf.add_many(['abcdef', 'xy'])
+    assert bf.check_prefix('abcd') and bf.check_prefix('xy') and bf.check_prefix('ab')
+    assert bf.check_many(['ab', 'abcd', 'xy']) == [True, True, True]
+
+def test_empty_batches():
+    bf = BloomFilter(10, 0.01)
+    bf.add_many([])
+    assert not any(bf.bit_array)
+    assert bf.check_many([]) == []
+
+def test_bits_packed_eight_to_a_byte():
+    bf = BloomFilter(len(KEYS), 0.01)
+    assert isinstance(bf.bit_array, bytearray)
+    assert len(bf.bit_array) == (bf.bit_array_size + 7) // 8
+    bf.add('key')
+    set_bits = sum(bin(byte).count('1') for byte in bf.bit_array)
+    assert set_bits == len(set(bf._positions('key'))) <= bf.num_hash_fns
+
+def test_double_hashing_from_one_digest():
+    bf = BloomFilter(len(KEYS), 0.01)
+    digest = hash128('key', signed=False)
+    h1, h2 = digest & (2**64 - 1), digest >> 64
+    assert bf._positions('key') == [(h1 + i*h2) % bf.bit_array_size for i in range(bf.num_hash_fns)]
+
+def test_blocked_positions_share_one_cache_line():
+    bf = BlockedBloomFilter(len(KEYS), 0.01)
+    assert bf.bit_array_size % BLOCK_BITS == 0 and len(bf.bit_array) == bf.num_blocks * 64
+    for key in KEYS[:1000]:
+        positions = bf._positions(key)
+        assert len({position // BLOCK_BITS for position in positions}) == 1
+        # The odd step visits distinct bits of the block
+        assert len(set(positions)) == bf.num_hash_fns
+
+@pytest.mark.parametrize('cls, slack', [(BloomFilter, 1.3), (BlockedBloomFilter, 2)])
+def test_false_positive_rate(cls, slack):
+    bf = cls(len(KEYS), 0.01)
+    bf.add_many(KEYS)
+    assert sum(bf.check_many(MISSES)) / len(MISSES) < 0.01 * slack
@@ -0,0 +1,75 @@
+import random
+
+import pytest
+
+from PDS.cuckoo_filter import AdaptiveCuckooFilter
+from tools.sstable import SegmentReader
+
+def fill(lsm, truth, rnd, count):
+    for i in range(count):
+        key = 'key%05d' % rnd.randrange(8000)
+        truth[key] = 'val%d' % rnd.randrange(10**6)
+        lsm.db_set(key, truth[key])
+
+@pytest.mark.parametrize('setting', ['set_adaptive_filters', 'set_static_filters'])
+def test_toggling_filter_kind_between_merges(make_tree, setting):
+    lsm = make_tree()
+    lsm.set_size_threshold(300)
+    lsm.set_time_threshold(0)
+    lsm.set_levels_threshold(0.01, 0.05)
+    rnd, truth = random.Random(7), {}
+    for enabled in (True, False, True, False):
+        getattr(lsm, setting)(enabled)
+        fill(lsm, truth, rnd, 6000)
+    assert lsm.third_level
+    assert all(lsm.db_get(key) == value for key, value in truth.items())
+
+def test_merge_builds_filter_and_index_from_the_stream(make_tree, monkeypatch):
+    lsm = make_tree()
+    lsm.set_size_threshold(300)
+    lsm.set_time_threshold(0)
+    lsm.set_adaptive_filters(True)
+    # Merges must not read the segment they just wrote back
+    def read_back(self):
+        raise AssertionError('merged segment read back')
+    monkeypatch.setattr(SegmentReader, 'keys', read_back)
+    rnd, truth = random.Random(3), {}
+    fill(lsm, truth, rnd, 3000)
+    monkeypatch.undo()
+
+    merged = [seg for seg in lsm.first_level if len(lsm.meta_dict[seg]) == 1
+              and lsm.catalog[seg].key_count > 30]
+    assert merged
+    for seg in merged:
+        keys = lsm._segment_keys(seg)
+        info = lsm.catalog[seg]
+        assert (info.key_count, info.min_key, info.max_key) == (len(keys), keys[0], keys[-1])
+        assert info.size == SegmentReader(lsm._segment_path(seg)).end
+        ckf = lsm.ckfs_in_memory[lsm.meta_dict[seg][0]]
+        # Sized from the exact key count, and holding every key
+        assert ckf.capacity == AdaptiveCuckooFilter(len(keys), lsm._ckf_false_pos_prob).capacity
+        assert all(ckf.check(key) for key in keys)
+    assert all(lsm.db_get(key) == value for key, value in truth.items())
+
+def test_reads_after_split_merges(make_tree):
+    lsm = make_tree()
+    lsm.set_size_threshold(300)
+    lsm.set_time_threshold(0)
+    lsm.set_subcompactions(2, min_size=0)
+    split = []
+    run_subcompactions = lsm._run_subcompactions
+    lsm._run_subcompactions = lambda *args: split.append(args[3]) or run_subcompactions(*args)
+    rnd, truth = random.Random(5), {}
+    fill(lsm, truth, rnd, 1500)
+    # The workers are started again after close
+    lsm.close()
+    fill(lsm, truth, rnd, 500)
+    assert split and all(len(ranges) == 2 for ranges in split)
+
+    assert lsm.scrub() == {}
+    for seg in lsm.first_level:
+        keys = lsm._segment_keys(seg)
+        assert keys == sorted(keys) and lsm.catalog[seg].key_count == len(keys)
+    assert all(lsm.db_get(key) == value for key, value in truth.items())
+    assert lsm.db_range('key02000', 'key03000') == sorted((key, value) for key, value in truth.items()
+                                                          if 'key02000' <= key < 'key03000')
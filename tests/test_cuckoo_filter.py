@@ -0,0 +1,41 @@
+import pytest
+
+from PDS.cuckoo_filter import CuckooFilter, ScalableCuckooFilter
+from PDS.filter_io import save_filter, load_filter
+
+KEYS = ['key%d' % i for i in range(20000)]
+MISSES = ['miss%d' % i for i in range(20000)]
+
+@pytest.mark.parametrize('fpp', [0.2, 0.001, 1e-12])
+def test_batches_match_single_items(fpp):
+    batch, single = CuckooFilter(len(KEYS), fpp), CuckooFilter(len(KEYS), fpp)
+    batch.add_many(KEYS)
+    for key in KEYS:
+        single.add(key)
+    assert batch.size == single.size == len(KEYS)
+    assert all(batch.check_many(KEYS))
+    assert batch.check_many(MISSES) == [batch.check(item) for item in MISSES]
+
+@pytest.mark.parametrize('fpp', [0.2, 0.001])
+def test_scalable_batch_grows_chain(fpp):
+    ckf = ScalableCuckooFilter(1000, fpp)
+    ckf.add_many(iter(KEYS))
+    assert ckf.size == len(KEYS)
+    assert len(ckf.filters) > 1
+    assert all(ckf.check_many(KEYS))
+    assert ckf.check_many(MISSES) == [ckf.check(item) for item in MISSES]
+
+def test_batches_on_loaded_filter(tmp_path):
+    ckf = ScalableCuckooFilter(len(KEYS), 0.01)
+    ckf.add_many(KEYS[:10000])
+    save_filter(ckf, str(tmp_path / 'ckf'))
+    loaded = load_filter(str(tmp_path / 'ckf'))
+    loaded.add_many(KEYS[10000:])
+    assert all(loaded.check_many(KEYS))
+
+def test_empty_batches():
+    ckf = CuckooFilter(10, 0.01)
+    ckf.add_many([])
+    assert ckf.size == 0
+    assert ckf.check_many([]) == []
+    assert ScalableCuckooFilter(10, 0.01).check_many([]) == []
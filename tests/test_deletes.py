@@ -0,0 +1,50 @@
+import random
+
+import pytest
+
+from PDS.cuckoo_filter import ScalableCuckooFilter
+
+@pytest.mark.parametrize('seed', range(5))
+def test_chain_delete_keeps_other_keys(seed):
+    rnd = random.Random(seed)
+    keys = ['key%d-%d' % (seed, i) for i in range(6000)]
+    flt = ScalableCuckooFilter(500, 0.2)
+    flt.add_many(keys)
+    assert len(flt.filters) > 2
+    rnd.shuffle(keys)
+    for key in keys[:3000]:
+        assert flt.delete(key)
+    assert all(flt.check_many(keys[3000:]))
+
+def test_chain_stays_ordered_by_capacity():
+    flt = ScalableCuckooFilter(500, 0.2)
+    flt.add_many('key%d' % i for i in range(3000))
+    # A filter chained for a fingerprint evicted out of a small filter goes before larger ones
+    flt._grow(flt.filters[0].capacity)
+    capacities = [ckf.capacity for ckf in flt.filters]
+    assert capacities == sorted(capacities)
+
+def test_holding_capacity_picks_largest_match():
+    flt = ScalableCuckooFilter(500, 0.2)
+    flt.add_many('key%d' % i for i in range(3000))
+    largest = flt.filters[-1]
+    key = next(key for key in ('key%d' % i for i in range(3000)) if largest.check(key))
+    assert flt.holding_capacity(key) == largest.capacity
+
+def test_tree_deletes_keep_other_keys(make_tree):
+    lsm = make_tree()
+    lsm.set_size_threshold(200)
+    lsm.set_time_threshold(0)
+    lsm.set_levels_threshold(0.01, 0.05)
+    rnd, truth = random.Random(11), {}
+    for i in range(6000):
+        key = 'key%05d' % rnd.randrange(5000)
+        truth[key] = 'val%d' % i
+        lsm.db_set(key, truth[key])
+    # Merged segments keep the filters of both inputs
+    assert any(len(ckfs) > 1 for ckfs in lsm.meta_dict.values())
+    on_disk = [key for key in sorted(truth) if not lsm._memtable.find_node(key)]
+    deleted = set(rnd.sample(on_disk, 300))
+    for key in deleted:
+        lsm.db_del(key)
+    assert all(lsm.db_get(key) == value for key, value in truth.items() if key not in deleted)
@@ -0,0 +1,72 @@
+import struct
+
+import pytest
+
+from PDS.bloom_filter import BloomFilter, BlockedBloomFilter, PrefixBloomFilter
+from PDS.cuckoo_filter import CuckooFilter, ScalableCuckooFilter, AdaptiveCuckooFilter
+from PDS.filter_io import FilterFormatError, HEADER, MAGIC, VERSION, load_filter, save_filter
+from PDS.xor_filter import XorFilter
+
+KEYS = ['key%d' % i for i in range(3000)]
+MISSES = ['miss%d' % i for i in range(3000)]
+
+def build(kind):
+    if kind is XorFilter:
+        return XorFilter(KEYS, 0.01)
+    if kind is PrefixBloomFilter:
+        flt = PrefixBloomFilter(len(KEYS), 0.01, (3, 5))
+    elif kind is ScalableCuckooFilter:
+        # Small, so that the chain grows
+        flt = ScalableCuckooFilter(500, 0.01)
+    else:
+        flt = kind(len(KEYS), 0.01)
+    flt.add_many(KEYS)
+    return flt
+
+@pytest.mark.parametrize('kind', [CuckooFilter, ScalableCuckooFilter, AdaptiveCuckooFilter, XorFilter,
+                                  BloomFilter, BlockedBloomFilter, PrefixBloomFilter])
+def test_round_trip(tmp_path, kind):
+    flt = build(kind)
+    path = str(tmp_path / 'flt')
+    save_filter(flt, path)
+    loaded = load_filter(path)
+    assert type(loaded) is kind
+    assert [loaded.check(item) for item in KEYS + MISSES] == [flt.check(item) for item in KEYS + MISSES]
+    if kind is PrefixBloomFilter:
+        assert loaded.check_prefix('key1') == flt.check_prefix('key1')
+
+def test_loaded_filter_changes_stay_in_memory(tmp_path):
+    path = str(tmp_path / 'flt')
+    save_filter(build(CuckooFilter), path)
+    loaded = load_filter(path)
+    for key in KEYS[:100]:
+        loaded.delete(key)
+    # The mapping is copy-on-write: the file keeps every key until saved again
+    assert all(load_filter(path).check_many(KEYS))
+    save_filter(loaded, path)
+    assert load_filter(path).check_many(KEYS[:100]) == loaded.check_many(KEYS[:100])
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / 'flt'
+    path.write_bytes(b'')
+    with pytest.raises(FilterFormatError):
+        load_filter(str(path))
+    path.write_bytes(b'not a filter file at all')
+    with pytest.raises(FilterFormatError):
+        load_filter(str(path))
+    path.write_bytes(HEADER.pack(MAGIC, VERSION + 1, 1) + bytes(64))
+    with pytest.raises(FilterFormatError):
+        load_filter(str(path))
+    path.write_bytes(HEADER.pack(MAGIC, VERSION, 99) + bytes(64))
+    with pytest.raises(FilterFormatError):
+        load_filter(str(path))
+
+def test_save_replaces_atomically(tmp_path):
+    path = str(tmp_path / 'flt')
+    save_filter(build(CuckooFilter), path)
+    mapped = load_filter(path)
+    save_filter(build(BloomFilter), path)
+    # The filter mapped before still reads the file it was loaded from
+    assert all(mapped.check_many(KEYS))
+    assert type(load_filter(path)) is BloomFilter
+    assert not (tmp_path / 'flt.tmp').exists()
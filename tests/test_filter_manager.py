@@ -0,0 +1,63 @@
+import os
+import random
+
+from PDS.cuckoo_filter import ScalableCuckooFilter
+from tools.filter_manager import FilterManager, filter_nbytes
+
+def make_filter(keys):
+    ckf = ScalableCuckooFilter(len(keys), 0.01)
+    ckf.add_many(keys)
+    return ckf
+
+def test_least_recently_used_filters_paged_out(tmp_path):
+    directory = str(tmp_path) + '/'
+    filters = {name: make_filter(['%s%d' % (name, i) for i in range(1000)]) for name in 'abc'}
+    manager = FilterManager(directory, budget=2 * filter_nbytes(filters['a']))
+    for name, ckf in filters.items():
+        manager[name] = ckf
+    # 'a' went out first, and was saved as it was never written
+    assert manager.stats()['page_outs'] == 1 and os.path.exists(directory + 'a')
+    assert manager.resident_bytes() <= manager.budget and manager.total_bytes() == 3 * manager.nbytes('a')
+
+    assert manager['a'].check('a5') and not manager['a'].check('b5')
+    assert manager.stats()['page_ins'] == 1
+    # Probing 'a' made 'b' the least recently used
+    assert manager.stats()['page_outs'] == 2 and os.path.exists(directory + 'b')
+
+def test_dirty_filters_saved_before_paging_out(tmp_path):
+    directory = str(tmp_path) + '/'
+    manager = FilterManager(directory)
+    manager['a'] = make_filter(['a%d' % i for i in range(1000)])
+    manager.flush()
+    manager['a'].add('late')
+    manager.mark_dirty('a')
+    manager.set_budget(0)
+    manager['b'] = make_filter(['b%d' % i for i in range(1000)])
+    assert manager['a'].check('late')
+
+def test_pop_removes_file(tmp_path):
+    directory = str(tmp_path) + '/'
+    manager = FilterManager(directory, budget=0)
+    manager['a'], manager['b'] = make_filter(['a']), make_filter(['b'])
+    # Paged out filters are dropped without being loaded
+    assert manager.pop('a') is None
+    assert 'a' not in manager and not os.path.exists(directory + 'a')
+    assert manager.pop('a', 'missing') == 'missing'
+
+def test_tree_pages_filters(make_tree):
+    lsm = make_tree()
+    lsm.set_size_threshold(300)
+    lsm.set_time_threshold(10**6)
+    lsm.set_resident_filter_budget(4096)
+    rnd, truth = random.Random(9), {}
+    for i in range(4000):
+        key = 'key%05d' % rnd.randrange(10**5)
+        truth[key] = 'val%d' % i
+        lsm.db_set(key, truth[key])
+    assert all(lsm.db_get(key) == value for key, value in truth.items())
+    stats = lsm.filter_stats()
+    assert stats['page_outs'] > 0 and stats['page_ins'] > 0
+    assert stats['resident_bytes'] < stats['total_bytes']
+    # Paged out filters live under the tree's filter directory
+    assert all(os.path.exists(lsm._ckf_path(name)) for name in lsm.ckfs_in_memory
+               if name not in lsm.ckfs_in_memory._resident)
@@ -0,0 +1,63 @@
+import random
+
+import pytest
+
+from PDS.cuckoo_filter import CuckooFilter, ScalableCuckooFilter
+
+def filled(item_num, keys, fpp=0.2):
+    flt = ScalableCuckooFilter(item_num, fpp)
+    flt.add_many(keys)
+    return flt
+
+@pytest.mark.parametrize('seed', range(5))
+def test_merge_with_smaller_chain_keeps_deletes_exact(seed):
+    rnd = random.Random(seed)
+    keys1 = ['a%d-%d' % (seed, i) for i in range(4000)]
+    keys2 = ['b%d-%d' % (seed, i) for i in range(1000)]
+    merged = filled(4000, keys1)
+    merged.merge(filled(1000, keys2))
+    capacities = [ckf.capacity for ckf in merged.filters]
+    assert capacities == sorted(capacities)
+    assert all(merged.check_many(keys1 + keys2))
+
+    deleted = set(rnd.sample(keys1, 2000))
+    for key in deleted:
+        assert merged.delete(key)
+    assert all(merged.check_many([key for key in keys1 if key not in deleted] + keys2))
+
+def test_merge_same_capacity_goes_bucket_by_bucket():
+    keys1 = ['a%d' % i for i in range(300)]
+    keys2 = ['b%d' % i for i in range(300)]
+    target, source = CuckooFilter(1000, 0.01), CuckooFilter(1000, 0.01)
+    target.add_many(keys1)
+    source.add_many(keys2)
+    assert target.merge(source) == []
+    assert target.size == 600
+    assert all(target.check_many(keys1 + keys2))
+
+def test_merge_folds_larger_filter():
+    keys1 = ['a%d' % i for i in range(100)]
+    keys2 = ['b%d' % i for i in range(100)]
+    target, source = CuckooFilter(500, 0.01), CuckooFilter(4000, 0.01)
+    target.add_many(keys1)
+    source.add_many(keys2)
+    assert target.merge(source) == []
+    assert all(target.check_many(keys1 + keys2))
+    with pytest.raises(ValueError):
+        source.merge(target)
+
+def test_tree_compresses_merged_filters(make_tree):
+    lsm = make_tree()
+    lsm.set_size_threshold(300)
+    lsm.set_time_threshold(0)
+    lsm.set_levels_threshold(0.01, 0.05)
+    rnd, truth = random.Random(2), {}
+    for i in range(4000):
+        key = 'key%05d' % rnd.randrange(20000)
+        truth[key] = 'val%d' % i
+        lsm.db_set(key, truth[key])
+    # Merged filters left under half full were unioned into one
+    merged = [ckfs for segment, ckfs in lsm.meta_dict.items() if segment not in lsm.first_level]
+    assert merged and all(len(ckfs) == 1 for ckfs in merged)
+    assert any(int(ckfs[0].split('-')[1]) > 1 for ckfs in merged)
+    assert all(lsm.db_get(key) == value for key, value in truth.items())
@@ -0,0 +1,49 @@
+import random
+
+import pytest
+
+from PDS.cuckoo_filter import CuckooFilter, AdaptiveCuckooFilter
+from PDS.xor_filter import XorFilter
+from tools.filter_manager import filter_nbytes
+from tools.filter_tuning import allocate_fpps, cuckoo_bits_per_key, xor_bits_per_key
+
+@pytest.mark.parametrize('keys', [1, 300, 1000, 4097])
+@pytest.mark.parametrize('fpp', [0.5, 0.01, 0.002, 1e-4, 1e-12])
+def test_memory_model_matches_filters(keys, fpp):
+    items = ['key%d' % i for i in range(keys)]
+    assert CuckooFilter.memory_bits(keys, fpp) == filter_nbytes(CuckooFilter(keys, fpp)) * 8
+    assert AdaptiveCuckooFilter.memory_bits(keys, fpp) == filter_nbytes(AdaptiveCuckooFilter(keys, fpp)) * 8
+    assert XorFilter.memory_bits(keys, fpp) == filter_nbytes(XorFilter(items, fpp)) * 8
+
+def test_allocation_fits_budget():
+    levels = [(3, 300), (2, 4000), (4, 20000)]
+    for memory_bits in (3e6, 5e6, 1e7):
+        tuning = allocate_fpps(levels, memory_bits, cuckoo_bits_per_key, max_fpp=0.5)
+        assert tuning.memory_bits <= memory_bits
+        assert tuning.fpps[0] <= tuning.fpps[1] <= tuning.fpps[2]
+
+def test_allocation_clamps_fpps():
+    levels = [(1, 300), (1, 3000)]
+    # Enough memory for the tightest filters: every level stops at min_fpp
+    tuning = allocate_fpps(levels, 1e9, xor_bits_per_key, max_fpp=0.5, min_fpp=1e-6)
+    assert tuning.fpps == pytest.approx([1e-6, 1e-6])
+    # Too little memory even for the loosest filters: every level gets max_fpp
+    tuning = allocate_fpps(levels, 10, xor_bits_per_key, max_fpp=0.5)
+    assert tuning.fpps == [0.5, 0.5]
+
+@pytest.mark.parametrize('static', [False, True])
+def test_tree_filters_fit_budget(make_tree, static):
+    budget = 60000
+    lsm = make_tree()
+    lsm.set_size_threshold(300)
+    lsm.set_time_threshold(0)
+    lsm.set_levels_threshold(0.01, 0.05)
+    lsm.set_static_filters(static)
+    lsm.set_filter_memory_budget(budget)
+    rnd = random.Random(5)
+    for i in range(12000):
+        lsm.db_set('key%05d' % rnd.randrange(8000), 'val%d' % i)
+        if i % 500 == 0:
+            assert lsm.filter_stats()['total_bytes'] <= budget
+    assert lsm.filter_stats()['total_bytes'] <= budget
+    assert lsm.third_level
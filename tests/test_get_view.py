@@ -0,0 +1,44 @@
+def small_tree(make_tree):
+    lsm = make_tree()
+    lsm.set_size_threshold(100)
+    lsm.set_time_threshold(10**6)
+    return lsm
+
+def test_views_of_memtable_values(make_tree):
+    lsm = small_tree(make_tree)
+    lsm.db_set('text', 'h\xe9llo')
+    lsm.db_set('raw', b'\x00\xff')
+    lsm.db_set('gone', 'value', ttl=-1)
+    assert bytes(lsm.db_get_view('text')) == 'h\xe9llo'.encode()
+    assert lsm.db_get_view('raw').readonly and bytes(lsm.db_get_view('raw')) == b'\x00\xff'
+    assert lsm.db_get_view('gone') is None and lsm.db_get_view('missing') is None
+
+def test_views_of_segment_values(make_tree):
+    lsm = small_tree(make_tree)
+    lsm.db_set('gone', 'value', ttl=-1)
+    lsm.db_set('raw', b'\x00\xff' * 10)
+    for i in range(500):
+        lsm.db_set('key%05d' % i, 'val%d' % i)
+    assert not lsm._memtable.find_node('key00001')
+    view = lsm.db_get_view('key00001')
+    assert view.readonly and bytes(view) == b'val1'
+    assert bytes(lsm.db_get_view('raw')) == b'\x00\xff' * 10
+    assert lsm.db_get_view('gone') is None and lsm.db_get_view('missing') is None
+
+    # The view outlives the block cache and the merges of its segment
+    lsm.set_block_cache(0)
+    lsm.set_time_threshold(0)
+    for i in range(500, 2000):
+        lsm.db_set('key%05d' % i, 'val%d' % i)
+    assert bytes(view) == b'val1'
+    assert bytes(lsm.db_get_view('key00001')) == b'val1'
+
+def test_views_of_value_log_values(make_tree):
+    lsm = small_tree(make_tree)
+    lsm.set_value_log(threshold=100)
+    lsm.db_set('big', 'x' * 500)
+    assert bytes(lsm.db_get_view('big')) == b'x' * 500
+    for i in range(200):
+        lsm.db_set('key%05d' % i, 'val')
+    assert not lsm._memtable.find_node('big')
+    assert bytes(lsm.db_get_view('big')) == b'x' * 500
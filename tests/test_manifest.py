@@ -0,0 +1,74 @@
+import os
+
+from tools.manifest import Manifest, RECORD
+
+def open_manifest(tmp_path, max_edits=1000):
+    return Manifest(str(tmp_path) + '/', max_edits=max_edits)
+
+def test_recovers_checkpoint_and_edits(tmp_path):
+    manifest = open_manifest(tmp_path)
+    assert not manifest.exists() and manifest.needs_checkpoint()
+    manifest.checkpoint({'segments': ['Seg1']})
+    manifest.log({'added': ['Seg2']})
+    manifest.log({'removed': ['Seg1']})
+
+    reopened = open_manifest(tmp_path)
+    assert reopened.exists()
+    snapshot, edits = reopened.recover()
+    assert snapshot == {'segments': ['Seg1']}
+    assert edits == [{'added': ['Seg2']}, {'removed': ['Seg1']}]
+    assert reopened.edits == 2
+    # Edits after recovery go on in the same file
+    reopened.log({'added': ['Seg3']})
+    assert open_manifest(tmp_path).recover()[1][-1] == {'added': ['Seg3']}
+
+def test_torn_edit_ends_recovery(tmp_path):
+    manifest = open_manifest(tmp_path)
+    manifest.checkpoint({'segments': []})
+    manifest.log({'added': ['Seg1']})
+    manifest.log({'added': ['Seg2']})
+    path = tmp_path / 'MANIFEST-1'
+    os.truncate(path, path.stat().st_size - 3)
+    assert open_manifest(tmp_path).recover() == ({'segments': []}, [{'added': ['Seg1']}])
+    # A crash before the payload leaves a header alone
+    data = path.read_bytes()
+    path.write_bytes(data + RECORD.pack(100, 0))
+    assert open_manifest(tmp_path).recover()[1] == [{'added': ['Seg1']}]
+
+def test_bad_checksum_ends_recovery(tmp_path):
+    manifest = open_manifest(tmp_path)
+    manifest.checkpoint({'segments': []})
+    manifest.log({'added': ['Seg1']})
+    manifest.log({'added': ['Seg2']})
+    path = tmp_path / 'MANIFEST-1'
+    data = bytearray(path.read_bytes())
+    data[-1] ^= 0xff
+    path.write_bytes(bytes(data))
+    assert open_manifest(tmp_path).recover()[1] == [{'added': ['Seg1']}]
+
+def test_checkpoint_rolls_over(tmp_path):
+    manifest = open_manifest(tmp_path, max_edits=2)
+    manifest.checkpoint({'version': 0})
+    manifest.log({'version': 1})
+    manifest.log({'version': 2})
+    assert manifest.needs_checkpoint()
+    manifest.checkpoint({'version': 2})
+    assert (tmp_path / 'CURRENT').read_text() == 'MANIFEST-2\n'
+    assert not (tmp_path / 'MANIFEST-1').exists()
+    assert not (tmp_path / 'CURRENT_temp').exists()
+    assert open_manifest(tmp_path).recover() == ({'version': 2}, [])
+    assert manifest.stats()['checkpoints'] == 2
+
+def test_crash_before_current_is_replaced(tmp_path):
+    manifest = open_manifest(tmp_path)
+    manifest.checkpoint({'version': 0})
+    manifest.log({'version': 1})
+    # The next file was written, but the crash came before CURRENT pointed to it
+    (tmp_path / 'MANIFEST-2').write_bytes(b'partial')
+    (tmp_path / 'CURRENT_temp').write_text('MANIFEST-2\n')
+
+    reopened = open_manifest(tmp_path)
+    assert reopened.recover() == ({'version': 0}, [{'version': 1}])
+    reopened.checkpoint({'version': 1})
+    assert (tmp_path / 'CURRENT').read_text() == 'MANIFEST-2\n'
+    assert open_manifest(tmp_path).recover() == ({'version': 1}, [])
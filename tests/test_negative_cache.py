@@ -0,0 +1,69 @@
+from tools.negative_cache import NegativeCache
+
+def test_hits_count_saved_work():
+    cache = NegativeCache()
+    assert not cache.lookup('a')
+    cache.add('a', probes=3, reads=1)
+    assert cache.lookup('a') and cache.lookup('a')
+    assert cache.stats() == {'cached_keys': 1, 'hits': 2, 'misses': 1, 'saved_probes': 6,
+                             'saved_reads': 2, 'invalidations': 0}
+
+def test_least_recently_used_keys_dropped():
+    cache = NegativeCache(capacity=2)
+    cache.add('a'), cache.add('b')
+    cache.lookup('a')
+    cache.add('c')
+    assert not cache.lookup('b') and cache.lookup('a') and cache.lookup('c')
+    cache.set_capacity(1)
+    assert len(cache) == 1 and cache.lookup('c')
+
+def test_discard_and_disabled_cache():
+    cache = NegativeCache()
+    cache.add('a')
+    cache.discard('a'), cache.discard('b')
+    assert not cache.lookup('a') and cache.stats()['invalidations'] == 1
+    cache = NegativeCache(capacity=0)
+    cache.add('a')
+    assert not cache.lookup('a') and len(cache) == 0
+
+def fill_segments(lsm):
+    lsm.set_size_threshold(100)
+    lsm.set_time_threshold(10**6)
+    for i in range(500):
+        lsm.db_set('key%05d' % i, 'val')
+    assert len(lsm.meta_dict) > 1
+
+def test_tree_skips_known_missing_keys(make_tree):
+    lsm = make_tree()
+    fill_segments(lsm)
+    missing = ['miss%05d' % i for i in range(2000)] + ['key%05d' % i for i in range(500, 1000)]
+    assert not any(lsm.db_get(key) for key in missing)
+    stats = lsm.lookup_stats()
+    assert stats['cached_keys'] == len(missing)
+
+    assert not any(lsm.db_get(key) for key in missing)
+    again = lsm.lookup_stats()
+    # The second round took no filter probe nor segment read
+    assert (again['filter_probes'], again['segment_reads']) == (stats['filter_probes'], stats['segment_reads'])
+    assert again['hits'] == len(missing)
+    assert (again['saved_probes'], again['saved_reads']) == (stats['filter_probes'], stats['segment_reads'])
+
+def test_tree_writes_invalidate(make_tree):
+    lsm = make_tree()
+    fill_segments(lsm)
+    assert lsm.db_get('key00700') is None
+    lsm.db_set('key00700', 'new')
+    assert lsm.db_get('key00700') == 'new'
+    # Flushing the write keeps it readable
+    for i in range(500, 700):
+        lsm.db_set('key%05d' % i, 'val')
+    assert not lsm._memtable.find_node('key00700')
+    assert lsm.db_get('key00700') == 'new'
+    assert lsm.lookup_stats()['invalidations'] == 1
+
+def test_tree_cache_disabled(make_tree):
+    lsm = make_tree()
+    fill_segments(lsm)
+    lsm.set_negative_cache(0)
+    lsm.db_get('miss'), lsm.db_get('miss')
+    assert lsm.lookup_stats()['hits'] == 0 and lsm.lookup_stats()['cached_keys'] == 0
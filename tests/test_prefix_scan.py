@@ -0,0 +1,66 @@
+import random
+
+import pytest
+
+PREFIX_CASES = [
+    (b'a\xff', [b'a\xfe', b'a\xff', b'a\xff\x00', b'a\xff\xff\xff', b'b', b'b\x00']),
+    (b'\xff\xff', [b'\xfe', b'\xff', b'\xff\xff', b'\xff\xff\x01']),
+    ('x' + chr(0x10ffff), ['x', 'x' + chr(0x10fffe), 'x' + chr(0x10ffff), 'x' + chr(0x10ffff) + 'a', 'y']),
+    (chr(0x10ffff), ['z', chr(0x10ffff), chr(0x10ffff) * 2]),
+    (chr(0xd7ff), [chr(0xd7fe), chr(0xd7ff), chr(0xd7ff) + 'a', chr(0xe000), chr(0xe001)]),
+]
+
+@pytest.mark.parametrize('prefix, keys', PREFIX_CASES)
+@pytest.mark.parametrize('flushed', [False, True])
+def test_prefix_with_maximal_last_unit(make_tree, prefix, keys, flushed):
+    lsm = make_tree()
+    lsm.set_size_threshold(2 if flushed else 1000)
+    lsm.set_time_threshold(0)
+    for key in keys:
+        lsm.db_set(key, key)
+    assert bool(lsm.meta_dict) == flushed
+    expected = [(key, key) for key in sorted(keys) if key.startswith(prefix)]
+    assert lsm.db_prefix(prefix) == expected
+
+def fill(lsm, keys):
+    truth = {}
+    for i, key in enumerate(keys):
+        truth[key] = 'val%d' % i
+        lsm.db_set(key, truth[key])
+    return truth
+
+def expected(truth, start, end):
+    return [(key, truth[key]) for key in sorted(truth) if start <= key and (end is None or key < end)]
+
+@pytest.mark.parametrize('range_filters', [False, True])
+def test_ranges_match_sorted_keys(make_tree, range_filters):
+    lsm = make_tree()
+    lsm.set_size_threshold(100)
+    lsm.set_time_threshold(10**6)
+    if range_filters:
+        lsm.set_range_filters((2, 4))
+    rnd = random.Random(11)
+    truth = fill(lsm, ['%c%03d' % (rnd.choice('abcde'), rnd.randrange(1000)) for _ in range(3000)])
+    assert len(lsm.meta_dict) > 1
+    bounds = ['', 'a', 'a5', 'b123', 'b1235', 'c', 'c999', 'e', 'e9999', 'f', 'z']
+    for start in bounds:
+        for end in bounds + [None]:
+            assert lsm.db_range(start, end) == expected(truth, start, end)
+
+def test_range_filters_skip_segments(make_tree):
+    lsm = make_tree()
+    lsm.set_size_threshold(100)
+    lsm.set_time_threshold(10**6)
+    lsm.set_range_filters((4,))
+    # Every segment holds two prefixes with a gap between them
+    truth = {}
+    for low, high in (('aaaa', 'aaae'), ('aaab', 'aaaf')):
+        truth.update(fill(lsm, ['%s%04d' % (prefix, i) for prefix in (low, high) for i in range(50)]))
+    lsm.db_set('b', 'flush')
+    truth['b'] = 'flush'
+    assert len(lsm.meta_dict) == 2
+    assert lsm.db_range('aaac', 'aaad') == []
+    assert lsm.range_skips == 2 and lsm.range_reads == 0
+    # Ranges running past the end of a prefix still find the next prefix's keys
+    for start, end in [('aaaa0040', 'aaac'), ('aaac', 'aaae0010'), ('aaab0049', 'aaaf'), ('aaae0045', None)]:
+        assert lsm.db_range(start, end) == expected(truth, start, end)
@@ -0,0 +1,74 @@
+import io
+import time
+
+from tools.rate_limiter import RateLimiter, ThrottledWriter, IO_HIGH, IO_LOW
+
+def test_unlimited_only_counts():
+    limiter = RateLimiter()
+    started = time.monotonic()
+    limiter.request(10**9)
+    limiter.request(10**9, IO_HIGH)
+    assert time.monotonic() - started < 0.1
+    assert limiter.stats() == {IO_HIGH: {'bytes': 10**9, 'throttled_time': 0.0},
+                               IO_LOW: {'bytes': 10**9, 'throttled_time': 0.0}}
+
+def test_requests_wait_for_tokens():
+    # Bursts of 10000 bytes
+    limiter = RateLimiter(100000, refill_period=0.1)
+    started = time.monotonic()
+    limiter.request(30000)
+    # The bucket is 20000 bytes in debt, and this request needs a burst more
+    limiter.request(10000)
+    assert time.monotonic() - started >= 0.25
+    assert limiter.throttled_time[IO_LOW] >= 0.25
+    assert limiter.throttled_time[IO_HIGH] == 0
+
+def test_high_priority_borrows_a_burst():
+    limiter = RateLimiter(100000, refill_period=0.1)
+    limiter.request(10000)
+    started = time.monotonic()
+    limiter.request(10000, IO_HIGH)
+    assert time.monotonic() - started < 0.05
+    # Low priority requests pay the debt back first
+    limiter.request(10000)
+    assert limiter.throttled_time[IO_LOW] >= 0.15
+    assert limiter.throttled_time[IO_HIGH] == 0
+
+def test_record_adds_outside_traffic():
+    limiter = RateLimiter()
+    limiter.record(500, 0.5)
+    limiter.record(100, 0.25, IO_HIGH)
+    assert limiter.stats() == {IO_HIGH: {'bytes': 100, 'throttled_time': 0.25},
+                               IO_LOW: {'bytes': 500, 'throttled_time': 0.5}}
+
+def test_writer_batches_requests():
+    requests = []
+    class Limiter(RateLimiter):
+        def request(self, num_bytes, priority=IO_LOW):
+            requests.append((num_bytes, priority))
+    stream = io.BytesIO()
+    with ThrottledWriter(stream, Limiter(), IO_HIGH, chunk_size=100) as writer:
+        for _ in range(5):
+            writer.write(b'x' * 40)
+        assert requests == [(120, IO_HIGH)]
+    assert requests == [(120, IO_HIGH), (80, IO_HIGH)]
+    assert stream.getvalue() == b'x' * 200
+
+def test_tree_io_stats(make_tree):
+    lsm = make_tree()
+    lsm.set_size_threshold(300)
+    lsm.set_time_threshold(0)
+    for i in range(2000):
+        lsm.db_set('key%05d' % i, 'val')
+    stats = lsm.io_stats()
+    # Flushes are charged at high priority, merges at low priority
+    assert stats[IO_HIGH]['bytes'] > 0 and stats[IO_LOW]['bytes'] > 0
+
+    lsm.set_rate_limit(20000)
+    started = time.monotonic()
+    for i in range(500):
+        lsm.db_set('key%05d' % i, 'val')
+    stats = lsm.io_stats()
+    throttled = stats[IO_HIGH]['throttled_time'] + stats[IO_LOW]['throttled_time']
+    assert stats[IO_LOW]['throttled_time'] > 0
+    assert time.monotonic() - started >= throttled
@@ -0,0 +1,79 @@
+import time
+
+from tools.scrubber import Scrubber
+from tools.sstable import SegmentReader, SegmentWriter
+
+def write_segment(path, count=500):
+    with open(path, 'wb') as s:
+        writer = SegmentWriter(s, block_size=512)
+        for i in range(count):
+            writer.add('key%05d' % i, 'val%d' % i)
+        writer.finish()
+    return writer.offset
+
+def corrupt(path):
+    with open(path, 'r+b') as s:
+        s.seek(SegmentReader(path).offsets[-1] + 3)
+        s.write(b'\xff\xff')
+
+def test_scrub_reports_bad_segments(tmp_path):
+    segments = {name: str(tmp_path / name) for name in ('a', 'b', 'c')}
+    sizes = {name: write_segment(path) for name, path in segments.items()}
+    corrupt(segments['b'])
+    reported = []
+    scrubber = Scrubber(lambda: list(segments.items()), on_corruption=lambda *args: reported.append(args))
+    found = scrubber.scrub()
+    assert list(found) == ['b'] and [name for name, _ in reported] == ['b']
+    assert scrubber.stats()['bad_segments'] == found
+    assert scrubber.stats()['scrubbed_bytes'] == sizes['a'] + sizes['c']
+    assert scrubber.stats()['passes'] == 1 and scrubber.stats()['scrubbed_segments'] == 3
+
+    # A bad segment merged away is forgotten, and removed files are skipped
+    segments['b'] = str(tmp_path / 'missing')
+    assert scrubber.scrub() == {}
+    assert scrubber.stats()['bad_segments'] == {}
+    del segments['b']
+    assert scrubber.scrub() == {} and scrubber.stats()['passes'] == 3
+
+def test_scrub_throttled(tmp_path):
+    path = str(tmp_path / 'seg')
+    size = write_segment(path, 2000)
+    scrubber = Scrubber(lambda: [('seg', path)], bytes_per_sec=size * 4)
+    started = time.monotonic()
+    scrubber.scrub(), scrubber.scrub()
+    assert time.monotonic() - started >= 0.25
+
+def test_background_passes(tmp_path):
+    path = str(tmp_path / 'seg')
+    write_segment(path)
+    scrubber = Scrubber(lambda: [('seg', path)], interval=0.01)
+    scrubber.start()
+    deadline = time.monotonic() + 5
+    while scrubber.stats()['passes'] < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    scrubber.stop()
+    passes = scrubber.stats()['passes']
+    assert passes >= 3
+    time.sleep(0.05)
+    assert scrubber.stats()['passes'] == passes
+    # Stopping twice is harmless
+    scrubber.stop()
+
+def test_tree_scrub(make_tree):
+    lsm = make_tree()
+    lsm.set_size_threshold(100)
+    lsm.set_time_threshold(10**6)
+    for i in range(500):
+        lsm.db_set('key%05d' % i, 'val')
+    assert lsm.scrub() == {}
+    segment = lsm.first_level[0]
+    corrupt(lsm._segment_path(segment))
+    assert list(lsm.scrub()) == [segment]
+
+    lsm.start_scrubber(interval=0.01)
+    deadline = time.monotonic() + 5
+    while lsm.scrub_stats()['passes'] < 4 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    lsm.close()
+    stats = lsm.scrub_stats()
+    assert stats['passes'] >= 4 and list(stats['bad_segments']) == [segment]
@@ -0,0 +1,91 @@
+import random
+from datetime import datetime
+
+import pytest
+
+from tools.segment_catalog import (EXPIRY_SAMPLES, SegmentCatalog, merge_expiry_samples, sample_expiries)
+
+def test_order_by_recency():
+    catalog = SegmentCatalog()
+    for name in ('a', 'b', 'c'):
+        catalog.add(name, 100, 10, 'k0', 'k9')
+    # A merge output keeps the recency of its newest input
+    catalog.add('ab', 200, 20, 'k0', 'k9', seq=catalog['b'].seq)
+    assert catalog.oldest(['c', 'ab', 'a'], 2) == ['a', 'ab']
+    assert catalog.newest_first(['a', 'ab', 'c']) == ['c', 'ab', 'a']
+    assert catalog.total_size(['a', 'ab']) == 300
+
+def test_read_amplification():
+    catalog = SegmentCatalog()
+    catalog.add('a', 1, 1, 'a', 'f')
+    catalog.add('b', 1, 1, 'c', 'h')
+    catalog.add('c', 1, 1, 'e', 'k')
+    catalog.add('d', 1, 1, 'x', 'z')
+    catalog.add('empty', 1, 0, None, None)
+    assert catalog.read_amplification(['a', 'b', 'c', 'd', 'empty']) == 3
+    assert catalog.read_amplification(['a', 'd']) == 1
+    assert catalog['a'].overlaps(catalog['b']) and not catalog['a'].overlaps(catalog['d'])
+
+def test_tombstone_ratio_counts_expired_records_only():
+    now = datetime.now().timestamp()
+    catalog = SegmentCatalog()
+    # One record already expired, 59 carry a ttl far ahead
+    expiries = [now - 10] + [now + 3600 + i for i in range(59)]
+    catalog.add('a', 1, 100, 'a', 'z', len(expiries), sample_expiries(expiries))
+    catalog.add('b', 1, 100, 'a', 'z')
+    assert catalog.tombstone_ratio(['a', 'b']) < 0.01
+
+    expiries = [now - 100 + i for i in range(60)] + [now + 3600 + i for i in range(20)]
+    catalog.add('c', 1, 100, 'a', 'z', len(expiries), sample_expiries(expiries))
+    assert catalog.tombstone_ratio(['c']) == pytest.approx(0.6, abs=0.05)
+    assert catalog.tombstone_ratio(['c']) <= 0.6
+    assert catalog.tombstone_ratio(['b']) == 0
+
+def test_expiry_samples():
+    rnd = random.Random(1)
+    expiries = sorted(rnd.uniform(0, 1000) for _ in range(5000))
+    samples = sample_expiries(expiries)
+    assert len(samples) == EXPIRY_SAMPLES and samples == sorted(samples)
+    assert sample_expiries(expiries[:10]) == expiries[:10]
+
+    # Samples of parts merge into samples of the whole, still never overstating
+    # the records expired
+    parts = [expiries[:1000], expiries[1000:4000], expiries[4000:]]
+    merged = merge_expiry_samples([(len(part), sample_expiries(part)) for part in parts])
+    catalog = SegmentCatalog()
+    info = catalog.add('a', 1, len(expiries), 'a', 'z', len(expiries), merged)
+    for now in range(0, 1001, 50):
+        expired = sum(expiry <= now for expiry in expiries)
+        assert expired - 2 * len(expiries) / EXPIRY_SAMPLES <= info.expired(now) <= expired
+    assert merge_expiry_samples([(3, [1.0, 2.0, 3.0]), (0, []), (1, [0.5])]) == [0.5, 1.0, 2.0, 3.0]
+
+@pytest.mark.parametrize('trigger', ['files', 'read_amp'])
+def test_tree_merges_on_triggers(make_tree, trigger):
+    lsm = make_tree()
+    lsm.set_size_threshold(50)
+    # Only the catalog triggers can merge
+    lsm.set_time_threshold(10**6)
+    if trigger == 'files':
+        lsm.set_compaction_triggers(max_level_files=3, max_read_amp=100)
+        keys = ['key%05d' % i for i in range(1000)]
+    else:
+        lsm.set_compaction_triggers(max_level_files=100, max_read_amp=2)
+        # Every segment spans the whole key range, so they all overlap
+        keys = ['key%05d' % (i * 37 % 1000) for i in range(1000)]
+    for key in keys:
+        lsm.db_set(key, 'val')
+    level = lsm.first_level
+    if trigger == 'files':
+        assert len(level) <= 4
+    else:
+        assert lsm.catalog.read_amplification(level) <= 3
+    assert all(lsm.db_get(key) == 'val' for key in keys)
+
+def test_tree_keeps_levels_without_triggers(make_tree):
+    lsm = make_tree()
+    lsm.set_size_threshold(50)
+    lsm.set_time_threshold(10**6)
+    lsm.set_compaction_triggers(max_level_files=100, max_read_amp=100)
+    for i in range(1000):
+        lsm.db_set('key%05d' % i, 'val')
+    assert len(lsm.first_level) == 19
@@ -0,0 +1,144 @@
+import os
+
+import pytest
+
+import tools.sstable
+from tools.block_cache import BlockCache
+from tools.sstable import (CODECS, CorruptSegmentError, RecordFormatError, SegmentReader, SegmentWriter,
+                           ValuePointer, encode_record, read_log, verify_segment)
+
+RECORDS = ([('key%05d' % i, 'val%d' % i, None) for i in range(0, 3000, 2)]
+           + [('key%05d' % i, b'\x00\xff' * (i % 7), 1700000000.5 + i) for i in range(1, 3000, 2)])
+RECORDS.sort()
+
+def write_segment(path, records, codec='none'):
+    with open(path, 'wb') as s:
+        writer = SegmentWriter(s, codec, block_size=512)
+        for key, value, expiry in records:
+            writer.add(key, value, expiry)
+        writer.finish()
+    return writer
+
+def flip_byte(path, offset):
+    with open(path, 'r+b') as s:
+        s.seek(offset)
+        byte = s.read(1)
+        s.seek(offset)
+        s.write(bytes((byte[0] ^ 1,)))
+
+@pytest.mark.parametrize('codec', sorted(CODECS))
+def test_round_trip(tmp_path, codec):
+    path = str(tmp_path / 'seg')
+    writer = write_segment(path, RECORDS, codec)
+    assert verify_segment(path) == writer.offset
+    reader = SegmentReader(path)
+    assert len(reader.offsets) > 1
+    assert list(reader) == [(key, expiry, value) for key, value, expiry in RECORDS]
+    assert reader.keys() == [key for key, _, _ in RECORDS]
+    for key, value, expiry in RECORDS[::37]:
+        assert reader.get(key) == (value, expiry)
+    assert reader.get('key99999') is None
+    assert reader.get('a') is None
+
+def test_reopen_with_cache(tmp_path):
+    path = str(tmp_path / 'seg')
+    write_segment(path, RECORDS, 'zlib')
+    cache = BlockCache()
+    for _ in range(2):
+        reader = SegmentReader(path, cache)
+        assert reader.get_many(key for key, _, _ in RECORDS[:100]) == {
+            key: (value, expiry) for key, value, expiry in RECORDS[:100]}
+        view, expiry = reader.get_view(RECORDS[1][0])
+        assert bytes(view) == RECORDS[1][1] and expiry == RECORDS[1][2]
+    assert cache.stats()['hits'] > 0
+
+def test_scans_read_one_block_at_a_time(tmp_path, monkeypatch):
+    path = str(tmp_path / 'seg')
+    write_segment(path, RECORDS)
+    reader = SegmentReader(path)
+    reads = []
+    class File:
+        def __init__(self, *args):
+            self.file = open(*args)
+        def __enter__(self):
+            return self
+        def __exit__(self, *exc):
+            self.file.close()
+        def seek(self, offset):
+            self.file.seek(offset)
+        def read(self, size):
+            reads.append(size)
+            return self.file.read(size)
+    monkeypatch.setattr(tools.sstable, 'open', File, raising=False)
+    assert len(reader.keys()) == len(RECORDS)
+    assert len(list(reader.records())) == len(RECORDS)
+    assert reads == reader.sizes * 2
+
+def test_ranges(tmp_path):
+    path = str(tmp_path / 'seg')
+    write_segment(path, RECORDS)
+    keys = [key for key, _, _, _, _ in SegmentReader(path).records('key01000', 'key01100')]
+    assert keys == ['key%05d' % i for i in range(1000, 1100)]
+
+def test_bytes_keys(tmp_path):
+    path = str(tmp_path / 'seg')
+    records = [(b'\x00a', b'\x00', None), (b'\xff', 'text', None)]
+    write_segment(path, records)
+    reader = SegmentReader(path)
+    assert reader.get(b'\x00a') == (b'\x00', None)
+    assert reader.get(b'\xff') == ('text', None)
+
+def test_value_pointers(tmp_path):
+    path = str(tmp_path / 'seg')
+    records = [('a', ValuePointer(1, 2, 3), None), ('b', 'text', None), ('c', ValuePointer(7, 0, 9), 5.5)]
+    write_segment(path, records)
+    reader = SegmentReader(path)
+    assert reader.get('a') == (ValuePointer(1, 2, 3), None)
+    assert reader.get_view('c') == (ValuePointer(7, 0, 9), 5.5)
+    assert list(reader) == [(key, expiry, value) for key, value, expiry in records]
+
+def test_empty_segment(tmp_path):
+    path = str(tmp_path / 'seg')
+    write_segment(path, [])
+    assert list(SegmentReader(path)) == []
+    assert SegmentReader(path).get('key') is None
+
+def test_corrupt_block(tmp_path):
+    path = str(tmp_path / 'seg')
+    write_segment(path, RECORDS)
+    reader = SegmentReader(path)
+    flip_byte(path, reader.offsets[2] + 5)
+    with pytest.raises(CorruptSegmentError):
+        verify_segment(path)
+    with pytest.raises(CorruptSegmentError):
+        list(SegmentReader(path))
+    # Blocks other than the corrupt one are still read
+    assert SegmentReader(path).get(RECORDS[0][0]) == (RECORDS[0][1], RECORDS[0][2])
+
+def test_corrupt_index(tmp_path):
+    path = str(tmp_path / 'seg')
+    writer = write_segment(path, RECORDS)
+    flip_byte(path, writer.offset + 3)
+    with pytest.raises(CorruptSegmentError):
+        SegmentReader(path)
+
+@pytest.mark.parametrize('length', [0, 10, -3])
+def test_unfinished_segment(tmp_path, length):
+    path = str(tmp_path / 'seg')
+    write_segment(path, RECORDS)
+    with open(path, 'rb') as s:
+        data = s.read()
+    with open(path, 'wb') as s:
+        s.write(data[:length])
+    with pytest.raises(RecordFormatError):
+        SegmentReader(path)
+
+def test_log_torn_tail(tmp_path):
+    path = str(tmp_path / 'wal')
+    records = [encode_record('key%d' % i, 'val%d' % i, None if i % 2 else 5.0) for i in range(10)]
+    with open(path, 'wb') as s:
+        s.write(b''.join(records) + records[0][:4])
+    assert list(read_log(path)) == [('key%d' % i, None if i % 2 else 5.0, 'val%d' % i) for i in range(10)]
+    assert os.path.getsize(path) == len(b''.join(records)) + 4
+    assert len(list(read_log(path, repair=True))) == 10
+    assert os.path.getsize(path) == len(b''.join(records))
@@ -0,0 +1,76 @@
+import random
+import time
+
+from tools.sstable import SegmentReader
+
+def small_tree(make_tree, size_threshold=100):
+    lsm = make_tree()
+    lsm.set_size_threshold(size_threshold)
+    lsm.set_time_threshold(0)
+    lsm.set_levels_threshold(0.01, 0.05)
+    return lsm
+
+def test_expired_keys_read_as_missing(make_tree):
+    lsm = small_tree(make_tree)
+    lsm.db_set('short', 'value', ttl=0.2)
+    lsm.db_set('long', 'value', ttl=3600)
+    lsm.db_set('gone', 'value', ttl=-1)
+    assert lsm.db_get('short') == 'value' and lsm.db_get('gone') is None
+    # Flushed records keep their expiry
+    for i in range(300):
+        lsm.db_set('key%05d' % i, 'val')
+    assert lsm.meta_dict
+    assert lsm.db_get_many(['gone', 'long']) == {'gone': None, 'long': 'value'}
+    time.sleep(0.25)
+    assert lsm.db_get('short') is None
+    assert lsm.db_get('long') == 'value'
+    assert [key for key, _ in lsm.db_range('l', 'm')] == ['long']
+
+def test_merges_drop_expired_records(make_tree):
+    lsm = make_tree()
+    lsm.set_size_threshold(100)
+    lsm.set_time_threshold(10**6)
+    # A single level merged on every flush, with no older segments to shadow
+    lsm.set_compaction_triggers(max_level_files=1, tombstone_ratio=1, max_read_amp=100)
+    rnd, live = random.Random(4), {}
+    for i in range(3000):
+        key = 'key%05d' % rnd.randrange(10**5)
+        if i % 2:
+            lsm.db_set(key, 'val%d' % i, ttl=-1)
+            live.pop(key, None)
+        else:
+            lsm.db_set(key, 'val%d' % i)
+            live[key] = 'val%d' % i
+    assert len(lsm.first_level) <= 2 and not lsm.second_level
+    merged = lsm.catalog.oldest(lsm.first_level, 1)[0]
+    reader = SegmentReader(lsm._segment_path(merged))
+    assert not [key for key, expiry, _, _, _ in reader.records() if expiry is not None]
+    # Deleting the fingerprints of expired keys never removed those of live keys
+    assert all(lsm.db_get(key) == value for key, value in live.items())
+
+def test_expired_record_keeps_shadowing_older_value(make_tree):
+    lsm = small_tree(make_tree, 300)
+    lsm.db_set('shadowed', 'old')
+    for i in range(5000):
+        lsm.db_set('a%05d' % i, 'val')
+    assert lsm.second_level or lsm.third_level
+    lsm.db_set('shadowed', 'new', ttl=-1)
+    for i in range(3000):
+        lsm.db_set('b%05d' % i, 'val')
+        if i % 100 == 0:
+            assert lsm.db_get('shadowed') is None
+    assert lsm.db_get('shadowed') is None
+
+def test_expired_records_trigger_merges(make_tree):
+    lsm = make_tree()
+    lsm.set_size_threshold(100)
+    # Only the share of expired records can trigger a merge
+    lsm.set_time_threshold(10**6)
+    lsm.set_compaction_triggers(max_level_files=100, tombstone_ratio=0.5, max_read_amp=100)
+    for i in range(404):
+        lsm.db_set('key%05d' % i, 'val', ttl=-1 if i < 202 else None)
+    # The first two segments only hold expired records and were merged away
+    assert lsm.catalog.tombstone_ratio(lsm.first_level) < 0.5
+    assert sum(lsm.catalog[seg].key_count for seg in lsm.first_level) < 404 - 101
+    assert all(lsm.db_get('key%05d' % i) is None for i in range(202))
+    assert all(lsm.db_get('key%05d' % i) == 'val' for i in range(202, 404))
@@ -0,0 +1,73 @@
+from tools.value_log import ValueLog
+
+def open_log(tmp_path, max_file_size=1000):
+    return ValueLog(str(tmp_path) + '/', max_file_size=max_file_size)
+
+def test_append_read_and_reopen(tmp_path):
+    vlog = open_log(tmp_path)
+    pointers = {'key%d' % i: vlog.append('key%d' % i, 'value%d' % i * 20) for i in range(100)}
+    assert vlog.sealed_files()
+    assert all(vlog.read(pointer) == key.replace('key', 'value') * 20 for key, pointer in pointers.items())
+    assert bytes(vlog.read(pointers['key7'], view=True)) == b'value7' * 20
+
+    reopened = open_log(tmp_path)
+    assert reopened.sealed_files() == vlog.sealed_files()
+    assert all(reopened.read(pointer) == key.replace('key', 'value') * 20 for key, pointer in pointers.items())
+    # Appends go on at the end of the head file
+    pointer = reopened.append('new', 'value')
+    assert pointer.file >= vlog._files[-1]
+    assert reopened.read(pointer) == 'value'
+    assert reopened.total_bytes() == vlog.total_bytes() + pointer.length
+
+def test_bytes_values(tmp_path):
+    vlog = open_log(tmp_path)
+    pointer = vlog.append(b'key', b'\x00\xff' * 300)
+    assert vlog.read(pointer) == b'\x00\xff' * 300
+
+def test_collect_relocates_live_records(tmp_path):
+    vlog = open_log(tmp_path)
+    live = {}
+    for i in range(100):
+        live['key%d' % (i % 10)] = vlog.append('key%d' % (i % 10), 'value%d' % i * 10)
+    oldest = vlog.sealed_files()[0]
+    old_pointers = {key: pointer for key, pointer in live.items() if pointer.file == oldest}
+
+    def relocate(key, value, pointer):
+        if live.get(key) != pointer:
+            return False
+        live[key] = vlog.append(key, value)
+        return True
+
+    before = vlog.total_bytes()
+    live_bytes, dead_bytes = vlog.collect(oldest, relocate)
+    assert oldest not in vlog.sealed_files() + vlog._files
+    assert live_bytes == sum(pointer.length for pointer in old_pointers.values())
+    assert dead_bytes > 0
+    assert vlog.total_bytes() == before - dead_bytes
+    # Records of the removed file read as dead, the relocated ones as before
+    assert all(vlog.read(pointer) is None for pointer in old_pointers.values())
+    assert all(vlog.read(live['key%d' % k]) == 'value%d' % (90 + k) * 10 for k in range(10))
+    assert vlog.stats()['collected_bytes'] == dead_bytes
+
+def test_tree_values_in_log(make_tree):
+    lsm = make_tree()
+    lsm.set_size_threshold(100)
+    lsm.set_time_threshold(0)
+    lsm.set_value_log(threshold=100, max_file_size=20000)
+    truth = {}
+    for round in range(3):
+        for i in range(300):
+            key = 'key%04d' % i
+            truth[key] = ('big%d-%d' % (round, i)) * 30 if i % 2 else 'small%d' % round
+            lsm.db_set(key, truth[key])
+    stats = lsm.value_log_stats()
+    # Only big values went to the log, and overwrites left dead ones behind
+    assert 0 < stats['appended_bytes'] < sum(len(value) for value in truth.values()) * 3
+    assert all(lsm.db_get(key) == value for key, value in truth.items())
+    assert bytes(lsm.db_get_view('key0001')) == truth['key0001'].encode()
+
+    sealed = lsm.value_log.sealed_files()
+    moved, reclaimed = lsm.collect_value_log(max_files=len(sealed))
+    assert reclaimed > 0 and lsm.value_log_stats()['collected_bytes'] == reclaimed
+    assert not set(lsm.value_log.sealed_files()) & set(sealed)
+    assert all(lsm.db_get(key) == value for key, value in truth.items())
@@ -0,0 +1,27 @@
+import pytest
+
+from PDS.xor_filter import XorFilter, XorBuildError
+
+KEYS = ['key%d' % i for i in range(20000)]
+MISSES = ['miss%d' % i for i in range(20000)]
+
+@pytest.mark.parametrize('fpp', [0.2, 0.01, 0.0001])
+def test_no_false_negatives(fpp):
+    xf = XorFilter(KEYS + KEYS[:100], fpp)
+    assert xf.size == len(KEYS)
+    assert all(xf.check_many(KEYS))
+    assert xf.check_many(MISSES) == [xf.check(item) for item in MISSES]
+    assert sum(xf.check_many(MISSES)) / len(MISSES) < 2 ** -xf.fingerprint_size * 1.3
+
+@pytest.mark.parametrize('fpp, cell_bits', [(0.2, 8), (0.01, 8), (1/256, 8), (0.0001, 16)])
+def test_cells_are_whole_bytes(fpp, cell_bits):
+    xf = XorFilter(KEYS, fpp)
+    assert xf.table.itemsize * 8 == cell_bits
+    # 1.23 cells per key whatever the fingerprint width
+    assert XorFilter.memory_bits(len(KEYS), fpp) == xf.capacity * cell_bits
+    assert xf.capacity / len(KEYS) == pytest.approx(1.23, abs=0.01)
+
+def test_build_failure():
+    with pytest.raises(XorBuildError) as error:
+        XorFilter(KEYS[:10], 0.01, max_attempts=0)
+    assert error.value.attempts == 0
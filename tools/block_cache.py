@@ -0,0 +1,94 @@
+"""
+Cache of decompressed segment blocks, so that lookups and range scans hitting
+the same blocks don't read and decompress them again. Blocks are kept by
+(segment path, block offset) within a byte budget, the least recently used
+going first.
+
+The parsed block index of every segment read through the cache is kept as
+well, whatever the capacity, so that a lookup doesn't read and parse the
+footer and index of its segment again.
+"""
+from collections import OrderedDict
+
+class BlockCache:
+    def __init__(self, capacity=8*1024*1024):
+        ''' (self, int) -> BlockCache
+        Initialize a cache holding at most capacity bytes of blocks. A capacity
+        of 0 disables the cache.
+        '''
+        self.capacity = capacity
+        self._blocks = OrderedDict()  # Least recently used first
+        self._bytes = 0
+        self._indexes = dict()
+
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        ''' (self, (str, int)) -> bytes
+        Returns the block stored under key, or None.
+        '''
+        block = self._blocks.get(key)
+        if block is None:
+            self.misses += 1
+            return None
+        self._blocks.move_to_end(key)
+        self.hits += 1
+        return block
+
+    def put(self, key, block):
+        ''' (self, (str, int), bytes) -> None
+        Stores block under key, evicting the least recently used blocks.
+        '''
+        if len(block) > self.capacity:
+            return
+        previous = self._blocks.pop(key, None)
+        if previous is not None:
+            self._bytes -= len(previous)
+        self._blocks[key] = block
+        self._bytes += len(block)
+        self._evict()
+
+    def get_index(self, path):
+        ''' (self, str) -> tuple
+        Returns the block index of the segment at path, or None.
+        '''
+        return self._indexes.get(path)
+
+    def put_index(self, path, index):
+        ''' (self, str, tuple) -> None
+        Stores index, the parsed block index of the segment at path.
+        '''
+        self._indexes[path] = index
+
+    def discard(self, path):
+        ''' (self, str) -> None
+        Forgets every block and the index of the segment at path, which was
+        rewritten or removed.
+        '''
+        for key in [key for key in self._blocks if key[0] == path]:
+            self._bytes -= len(self._blocks.pop(key))
+        self._indexes.pop(path, None)
+
+    def set_capacity(self, capacity):
+        ''' (self, int) -> None
+        Sets the bytes of blocks kept, evicting blocks if needed.
+        '''
+        self.capacity = capacity
+        self._evict()
+
+    def stats(self):
+        ''' (self) -> dict
+        Returns the bytes, blocks and indexes cached, and the hits and misses.
+        '''
+        return {'cached_bytes': self._bytes,
+                'cached_blocks': len(self._blocks),
+                'cached_indexes': len(self._indexes),
+                'hits': self.hits,
+                'misses': self.misses}
+
+    def _evict(self):
+        while self._bytes > self.capacity:
+            _, block = self._blocks.popitem(last=False)
+            self._bytes -= len(block)
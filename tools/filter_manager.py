@@ -0,0 +1,172 @@
+"""
+Keeps the filters of an LSM tree within a memory budget. Filters are stored by
+name like in a dict, the least recently probed ones are paged out to their
+files in the filter directory once the budget is exceeded, and are mapped back
+from there the next time they are probed.
+"""
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from os import remove as remove_file
+from pathlib import Path
+
+from PDS.filter_io import save_filter, load_filter
+
+def filter_nbytes(flt):
+    ''' (object) -> int
+    Returns the bytes taken by the tables of flt.
+    '''
+    if hasattr(flt, 'filters'):
+        tables = [ckf.table for ckf in flt.filters]
+    elif hasattr(flt, 'table'):
+        tables = [flt.table]
+    else:
+        tables = [flt.bit_array]
+    if hasattr(flt, 'selectors'):
+        tables.append(flt.selectors)
+    if getattr(flt, 'owners', None) is not None:
+        tables.append(flt.owners)
+    return sum(memoryview(table).nbytes for table in tables)
+
+class FilterManager(MutableMapping):
+    def __init__(self, directory, budget=None, save=save_filter, load=load_filter):
+        ''' (self, str, int, callable, callable) -> FilterManager
+        Initialize a filter manager paging filters to directory, keeping at
+        most budget bytes of filters resident. A budget of None keeps every
+        filter resident. save(filter, path) and load(path) persist a filter.
+
+        A filter changed in place after being stored must be marked dirty, so
+        that it is saved before it is paged out.
+        '''
+        self.directory = directory
+        self.budget = budget
+        self._save = save
+        self._load = load
+        self._resident = OrderedDict()  # Least recently used first
+        self._sizes = dict()
+        self._dirty = set()
+
+        # Metrics
+        self.page_ins = 0
+        self.page_outs = 0
+
+    def __getitem__(self, name):
+        if name in self._resident:
+            self._resident.move_to_end(name)
+            return self._resident[name]
+        if name not in self._sizes:
+            raise KeyError(name)
+        flt = self._load(self._path(name))
+        self.page_ins += 1
+        self._resident[name] = flt
+        self._evict()
+        return flt
+
+    def __setitem__(self, name, flt):
+        self._resident[name] = flt
+        self._resident.move_to_end(name)
+        self._sizes[name] = filter_nbytes(flt)
+        self._dirty.add(name)
+        self._evict()
+
+    def __delitem__(self, name):
+        if name not in self._sizes:
+            raise KeyError(name)
+        self._resident.pop(name, None)
+        self._sizes.pop(name)
+        self._dirty.discard(name)
+        if Path(self._path(name)).exists():
+            remove_file(self._path(name))
+
+    def __iter__(self):
+        return iter(self._sizes)
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def __contains__(self, name):
+        return name in self._sizes
+
+    def pop(self, name, *default):
+        ''' (self, str) -> object
+        Forgets the filter name and removes its file, returning the filter if
+        it was resident. Paged out filters are not loaded just to be dropped.
+        '''
+        if name not in self._sizes:
+            if default:
+                return default[0]
+            raise KeyError(name)
+        flt = self._resident.get(name)
+        del self[name]
+        return flt
+
+    def register(self, name):
+        ''' (self, str) -> None
+        Adds the filter name, persisted in the directory, without loading it.
+        '''
+        self._sizes[name] = Path(self._path(name)).stat().st_size
+
+    def mark_dirty(self, name):
+        ''' (self, str) -> None
+        Records that the resident filter name changed since it was last saved.
+        '''
+        if name in self._resident:
+            self._dirty.add(name)
+            self._sizes[name] = filter_nbytes(self._resident[name])
+
+    def flush(self):
+        ''' (self) -> None
+        Saves every dirty filter.
+        '''
+        for name in list(self._dirty):
+            self._save(self._resident[name], self._path(name))
+        self._dirty.clear()
+
+    def set_budget(self, budget):
+        ''' (self, int) -> None
+        Sets the bytes of filters kept resident, paging filters out if needed.
+        '''
+        self.budget = budget
+        self._evict()
+
+    def nbytes(self, name):
+        ''' (self, str) -> int
+        Returns the bytes of the filter name, resident or not.
+        '''
+        return self._sizes[name]
+
+    def resident_bytes(self):
+        return sum(self._sizes[name] for name in self._resident)
+
+    def total_bytes(self):
+        return sum(self._sizes.values())
+
+    def stats(self):
+        ''' (self) -> dict
+        Returns the resident and total bytes of the filters, and how many times
+        filters were paged in and out.
+        '''
+        return {'resident_bytes': self.resident_bytes(),
+                'total_bytes': self.total_bytes(),
+                'resident_filters': len(self._resident),
+                'total_filters': len(self._sizes),
+                'page_ins': self.page_ins,
+                'page_outs': self.page_outs}
+
+    def _evict(self):
+        ''' (self) -> None
+        Pages out the least recently used filters until the resident ones fit
+        in the budget. The most recently used filter always stays.
+        '''
+        if self.budget is None:
+            return
+        resident_bytes = self.resident_bytes()
+        while resident_bytes > self.budget and len(self._resident) > 1:
+            name, flt = self._resident.popitem(last=False)
+            if name in self._dirty:
+                self._save(flt, self._path(name))
+                self._dirty.discard(name)
+            resident_bytes -= self._sizes[name]
+            self.page_outs += 1
+
+    def _path(self, name):
+        return self.directory + name
@@ -0,0 +1,91 @@
+"""
+Monkey-style allocation of false positive probabilities across the levels of
+an LSM tree.
+
+A lookup for a missing key probes the filter of every segment, so the I/O it
+costs is the sum of the false positive probabilities of those filters. For a
+fixed filter memory budget, that sum is smallest when every filter's false
+positive probability is proportional to the number of keys it holds
+(Dayan et al., Monkey: Optimal Navigable Key-Value Store). Small, frequently
+rewritten upper levels then get tight filters and the large last level loose
+ones.
+"""
+from math import exp, log
+
+from PDS.cuckoo_filter import CuckooFilter, AdaptiveCuckooFilter
+from PDS.xor_filter import XorFilter
+
+# Bits per key a filter of keys keys needs for a false positive probability p.
+# Cuckoo and xor filters are priced from the tables they allocate, so the power
+# of two rounding of cuckoo tables and the fixed width cells a fingerprint is
+# stored in are paid for.
+def bloom_bits_per_key(p, keys=None):
+    return -log(p) / log(2)**2
+
+def cuckoo_bits_per_key(p, keys):
+    return CuckooFilter.memory_bits(max(keys, 1), p) / max(keys, 1)
+
+def adaptive_cuckoo_bits_per_key(p, keys):
+    return AdaptiveCuckooFilter.memory_bits(max(keys, 1), p) / max(keys, 1)
+
+def xor_bits_per_key(p, keys):
+    return XorFilter.memory_bits(max(keys, 1), p) / max(keys, 1)
+
+class LevelTuning:
+    def __init__(self, fpps, expected_io, memory_bits):
+        ''' (self, [float], float, float) -> LevelTuning
+        The outcome of an allocation:
+
+        - fpps: the false positive probability of the filters of each level
+        - expected_io: the segments a lookup for a missing key is expected to read
+        - memory_bits: the filter memory the allocation takes
+        '''
+        self.fpps = fpps
+        self.expected_io = expected_io
+        self.memory_bits = memory_bits
+
+    def __repr__(self):
+        return 'fpps {} expected I/O {:.4f} memory {:.0f} bits'.format(
+            ['{:.4g}'.format(p) for p in self.fpps], self.expected_io, self.memory_bits)
+
+def allocate_fpps(levels, memory_bits, bits_per_key=cuckoo_bits_per_key, max_fpp=1.0, min_fpp=1e-12,
+                  iterations=100):
+    ''' ([(int, int)], float, callable, float, float, int) -> LevelTuning
+    Splits memory_bits of filter memory across levels, a list of (segments,
+    keys per segment) pairs, one per level. Each level's filters get a false
+    positive probability proportional to their size, p = min(max(lam * keys,
+    min_fpp), max_fpp), and take bits_per_key(p, keys) bits per key.
+    bits_per_key may also be a list giving the filter model of each level. The
+    factor lam that spends the whole budget is found by bisection on its
+    logarithm, memory shrinking as lam grows.
+
+    Levels without segments get max_fpp, as no filter of theirs is probed. If
+    the budget can't hold the filters even at max_fpp, every level gets
+    max_fpp and the tuning reports the memory they take.
+    '''
+    def allocation(lam):
+        return [min(max(lam * keys, min_fpp), max_fpp) if segments and keys else max_fpp
+                for segments, keys in levels]
+
+    models = bits_per_key if isinstance(bits_per_key, (list, tuple)) else [bits_per_key] * len(levels)
+
+    def memory(fpps):
+        return sum(segments * keys * model(p, keys)
+                   for (segments, keys), model, p in zip(levels, models, fpps) if p < 1)
+
+    sizes = [keys for segments, keys in levels if segments and keys]
+    if not sizes:
+        return LevelTuning(allocation(0), 0, 0)
+
+    # Between these bounds every filter goes from min_fpp to max_fpp
+    low, high = log(min_fpp / max(sizes)), log(max_fpp / min(sizes))
+    for _ in range(iterations):
+        middle = (low + high) / 2
+        if memory(allocation(exp(middle))) > memory_bits:
+            low = middle
+        else:
+            high = middle
+
+    fpps = allocation(exp(high))
+    expected_io = sum(segments * p for (segments, _), p in zip(levels, fpps))
+    return LevelTuning(fpps, expected_io, memory(fpps))
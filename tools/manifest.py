@@ -0,0 +1,116 @@
+"""
+Manifest of an LSM tree: an append only log of version edits, each holding
+what changed in the metadata of the tree since the previous edit, so that
+saving metadata costs the size of the change rather than of the whole tree.
+
+Every manifest file starts with a checkpoint of the whole metadata. After
+max_edits edits, a new file is started with a fresh checkpoint and CURRENT,
+which names the live file, is atomically replaced to point to it. Recovery
+reads the checkpoint of the file CURRENT names and replays its edits; an edit
+torn by a crash while it was appended ends the file.
+
+Records are the length and CRC32 of a pickled payload, followed by it.
+"""
+import os
+import pickle
+import struct
+import zlib
+from pathlib import Path
+
+RECORD = struct.Struct('<II')                   # payload length, payload CRC32
+
+class Manifest:
+    def __init__(self, directory, basename='MANIFEST', max_edits=1000):
+        ''' (self, str, str, int) -> Manifest
+        Initialize a manifest writing files named basename-<number> in
+        directory, checkpointed every max_edits edits.
+        '''
+        self.directory = directory
+        self.basename = basename
+        self.max_edits = max_edits
+        self._number = None
+        # Edits appended since the checkpoint of the live file
+        self.edits = 0
+
+        # Metrics
+        self.bytes_written = 0
+        self.checkpoints = 0
+
+    def exists(self):
+        return Path(self._current_path()).exists()
+
+    def recover(self):
+        ''' (self) -> (dict, list)
+        Returns the checkpoint of the live file and the edits appended after
+        it, in order.
+        '''
+        with open(self._current_path()) as s:
+            name = s.read().strip()
+        self._number = int(name.split('-')[-1])
+        with open(self.directory + name, 'rb') as s:
+            data = s.read()
+
+        records, offset = [], 0
+        while offset + RECORD.size <= len(data):
+            length, checksum = RECORD.unpack_from(data, offset)
+            payload = data[offset + RECORD.size:offset + RECORD.size + length]
+            if len(payload) != length or zlib.crc32(payload) != checksum:
+                break
+            records.append(pickle.loads(payload))
+            offset += RECORD.size + length
+        self.edits = len(records) - 1
+        return records[0], records[1:]
+
+    def log(self, edit):
+        ''' (self, dict) -> None
+        Appends edit to the live file, which must have a checkpoint.
+        '''
+        self._append(self._path(self._number), 'ab', edit)
+        self.edits += 1
+
+    def needs_checkpoint(self):
+        return self._number is None or self.edits >= self.max_edits
+
+    def checkpoint(self, snapshot):
+        ''' (self, dict) -> None
+        Starts a new file holding snapshot, the whole metadata, points CURRENT
+        to it and removes the previous file.
+        '''
+        previous = self._number
+        self._number = 1 if previous is None else previous + 1
+        self._append(self._path(self._number), 'wb', snapshot)
+
+        temp_path = self._current_path() + '_temp'
+        with open(temp_path, 'w') as s:
+            s.write(self.basename + '-' + str(self._number) + '\n')
+            s.flush()
+            os.fsync(s.fileno())
+        os.replace(temp_path, self._current_path())
+
+        if previous is not None and Path(self._path(previous)).exists():
+            os.remove(self._path(previous))
+        self.edits = 0
+        self.checkpoints += 1
+
+    def stats(self):
+        ''' (self) -> dict
+        Returns the bytes written to the manifest, the checkpoints taken and
+        the edits appended since the last one.
+        '''
+        return {'bytes_written': self.bytes_written,
+                'checkpoints': self.checkpoints,
+                'edits': self.edits}
+
+    def _append(self, path, mode, payload):
+        payload = pickle.dumps(payload)
+        with open(path, mode) as s:
+            s.write(RECORD.pack(len(payload), zlib.crc32(payload)) + payload)
+            s.flush()
+            os.fsync(s.fileno())
+        self.bytes_written += RECORD.size + len(payload)
+
+    def _path(self, number):
+        return self.directory + self.basename + '-' + str(number)
+
+    def _current_path(self):
+        return self.directory + 'CURRENT'
@@ -0,0 +1,87 @@
+"""
+Bounded cache of keys recently confirmed missing from an LSM tree. A lookup
+for a cached key returns at once instead of probing the filter of every
+segment and reading those whose filter gives a false positive. Writing a key
+must discard it, as only writes bring keys into the tree.
+"""
+from collections import OrderedDict
+
+class NegativeCache:
+    def __init__(self, capacity=10000):
+        ''' (self, int) -> NegativeCache
+        Initialize a cache holding at most capacity keys, dropping the least
+        recently used ones first. A capacity of 0 disables the cache.
+        '''
+        self.capacity = capacity
+        # The filter probes and segment reads the lookup confirming each key took,
+        # least recently used first
+        self._keys = OrderedDict()
+
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.saved_probes = 0
+        self.saved_reads = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._keys)
+
+    def lookup(self, key):
+        ''' (self, str) -> bool
+        Returns True if key is known to be missing. A hit counts the filter
+        probes and segment reads it saved.
+        '''
+        cost = self._keys.get(key)
+        if cost is None:
+            self.misses += 1
+            return False
+        self._keys.move_to_end(key)
+        self.hits += 1
+        self.saved_probes += cost[0]
+        self.saved_reads += cost[1]
+        return True
+
+    def add(self, key, probes=0, reads=0):
+        ''' (self, str, int, int) -> None
+        Records that key is missing, a lookup for it having taken probes filter
+        probes and reads segment reads.
+        '''
+        if self.capacity <= 0:
+            return
+        self._keys[key] = (probes, reads)
+        self._keys.move_to_end(key)
+        self._trim()
+
+    def discard(self, key):
+        ''' (self, str) -> None
+        Forgets key, which may not be missing anymore.
+        '''
+        if self._keys.pop(key, None) is not None:
+            self.invalidations += 1
+
+    def clear(self):
+        self._keys.clear()
+
+    def set_capacity(self, capacity):
+        ''' (self, int) -> None
+        Sets the number of keys kept, dropping the least recently used ones.
+        '''
+        self.capacity = capacity
+        self._trim()
+
+    def stats(self):
+        ''' (self) -> dict
+        Returns the size of the cache, its hits and misses, the filter probes
+        and segment reads its hits saved, and the keys writes discarded.
+        '''
+        return {'cached_keys': len(self._keys),
+                'hits': self.hits,
+                'misses': self.misses,
+                'saved_probes': self.saved_probes,
+                'saved_reads': self.saved_reads,
+                'invalidations': self.invalidations}
+
+    def _trim(self):
+        while len(self._keys) > max(self.capacity, 0):
+            self._keys.popitem(last=False)
@@ -0,0 +1,108 @@
+"""
+Token bucket rate limiter shared by the background writers of the LSM tree
+(memtable flushes, merges and filter rebuilds), so that they don't starve
+foreground reads of disk bandwidth.
+"""
+import time
+
+# Request priorities
+IO_HIGH = 'HIGH'  # memtable flushes, which block writes until they finish
+IO_LOW = 'LOW'    # merges, segment rewrites and filter rebuilds
+
+class RateLimiter:
+    def __init__(self, bytes_per_sec=None, refill_period=0.1):
+        ''' (self, int, float) -> RateLimiter
+        Initialize a token bucket refilled with bytes_per_sec bytes per second.
+        The bucket holds at most refill_period seconds worth of bytes.
+        A bytes_per_sec of None never throttles, but still keeps metrics.
+        '''
+        self.bytes_per_sec = bytes_per_sec
+        self.refill_period = refill_period
+        self._burst = 0 if bytes_per_sec is None else max(int(bytes_per_sec * refill_period), 1)
+        self._available = self._burst
+        self._last_refill = time.monotonic()
+
+        # Metrics
+        self.total_bytes = {IO_HIGH: 0, IO_LOW: 0}
+        self.throttled_time = {IO_HIGH: 0.0, IO_LOW: 0.0}
+
+    def request(self, num_bytes, priority=IO_LOW):
+        ''' (self, int, str) -> None
+        Blocks until num_bytes can go through the limiter.
+
+        High priority requests may overdraw the bucket by up to one burst, so a
+        flush only waits once the bucket is already in debt, while low priority
+        requests wait for the tokens and then pay back whatever flushes borrowed.
+        '''
+        self.total_bytes[priority] += num_bytes
+        if self.bytes_per_sec is None:
+            return
+
+        floor = -self._burst if priority == IO_HIGH else 0
+        needed = min(num_bytes, self._burst)
+        self._refill()
+        if self._available - needed < floor:
+            started = time.monotonic()
+            while self._available - needed < floor:
+                time.sleep((floor + needed - self._available) / self.bytes_per_sec)
+                self._refill()
+            self.throttled_time[priority] += time.monotonic() - started
+        self._available -= num_bytes
+
+    def record(self, num_bytes, throttled_time, priority=IO_LOW):
+        ''' (self, int, float, str) -> None
+        Adds to the metrics the traffic of a limiter used elsewhere, such as
+        the one of a subcompaction worker process.
+        '''
+        self.total_bytes[priority] += num_bytes
+        self.throttled_time[priority] += throttled_time
+
+    def stats(self):
+        ''' (self) -> dict
+        Returns the bytes requested and the seconds spent throttled per priority.
+        '''
+        return {priority: {'bytes': self.total_bytes[priority],
+                           'throttled_time': self.throttled_time[priority]}
+                for priority in (IO_HIGH, IO_LOW)}
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.bytes_per_sec is not None:
+            refill = (now - self._last_refill) * self.bytes_per_sec
+            self._available = min(self._available + refill, self._burst)
+        self._last_refill = now
+
+class ThrottledWriter:
+    '''
+    Wraps a writable stream so that everything written to it goes through a
+    rate limiter. Requests are batched every chunk_size bytes to keep the
+    per-write overhead low.
+    '''
+    def __init__(self, stream, limiter, priority=IO_LOW, chunk_size=64*1024):
+        self.stream = stream
+        self.limiter = limiter
+        self.priority = priority
+        self.chunk_size = chunk_size
+        self._pending = 0
+
+    def write(self, data):
+        written = self.stream.write(data)
+        self._pending += len(data)
+        if self._pending >= self.chunk_size:
+            self.limiter.request(self._pending, self.priority)
+            self._pending = 0
+        return written
+
+    def flush(self):
+        ''' (self) -> None
+        Charges the limiter for the bytes written since the last request.
+        '''
+        if self._pending:
+            self.limiter.request(self._pending, self.priority)
+            self._pending = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
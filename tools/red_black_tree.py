@@ -10,11 +10,12 @@ RED = 'RED'
 NIL = 'NIL'
 
 class Node:
-    def __init__(self, key, color, parent, left=None, right=None, value=None, offset=None, segment=None):
+    def __init__(self, key, color, parent, left=None, right=None, value=None, offset=None, segment=None, expiry=None):
         self.key = key
         self.value = value
         self.offset = offset
         self.segment = segment
+        self.expiry = expiry
         self.color = color
         self.parent = parent
         self.left = left
@@ -89,7 +90,7 @@ class RedBlackTree:
             return list()
         yield from self.root.__iter__()
 
-    def add(self, key, value=None, offset=None, segment=None):
+    def add(self, key, value=None, offset=None, segment=None, expiry=None):
         # add the node
         if not self.root:
             self.root = Node(
@@ -100,13 +101,17 @@ class RedBlackTree:
                 right=self.NIL_LEAF,
                 value=value,
                 offset=offset,
-                segment=segment
+                segment=segment,
+                expiry=expiry
                 )
             self.count += 1
             return
         parent, node_dir = self._find_parent(key)
         if node_dir is None:
             parent.value = value
+            parent.offset = offset
+            parent.segment = segment
+            parent.expiry = expiry
             return  # key is in the tree
 
         new_node = Node(
@@ -117,7 +122,8 @@ class RedBlackTree:
             right=self.NIL_LEAF, 
             value=value, 
             offset=offset, 
-            segment=segment)
+            segment=segment,
+            expiry=expiry)
 
         if node_dir == 'L':
             parent.left = new_node
@@ -139,7 +145,7 @@ class RedBlackTree:
             # find the in-order successor and replace its key.
             # then, remove the successor
             successor = self._find_in_order_successor(node_to_remove)
-            node_to_remove.key = successor.key  # switch the key
+            self._copy_record(successor, node_to_remove)  # switch the key and its record
             node_to_remove = successor
 
         # has 0 or 1 children!
@@ -239,13 +245,22 @@ class RedBlackTree:
                 Swap the keys with the red child and remove it  (basically un-link it)
                 Since we're a node with one child only, we can be sure that there are no nodes below the red child.
                 """
-                node.key = not_nil_child.key
+                self._copy_record(not_nil_child, node)
                 node.left = not_nil_child.left
                 node.right = not_nil_child.right
             else:  # BLACK child
                 # 6 cases :o
                 self._remove_black_node(node)
 
+    @staticmethod
+    def _copy_record(source, target):
+        """ Copies the key and the record stored with it (value, offset, segment, expiry) """
+        target.key = source.key
+        target.value = source.value
+        target.offset = source.offset
+        target.segment = source.segment
+        target.expiry = source.expiry
+
     def _remove_leaf(self, leaf):
         """ Simply removes a leaf node by making it's parent point to a NIL LEAF"""
         if leaf.key >= leaf.parent.key:
@@ -0,0 +1,95 @@
+"""
+Background scrubber of the segments of an LSM tree. It walks every level at
+a throttled rate, checking each block against its checksum, so that a
+corrupted segment is reported before a lookup or a merge runs into it.
+"""
+import threading
+
+from tools.rate_limiter import RateLimiter
+from tools.sstable import RecordFormatError, verify_segment
+
+class Scrubber:
+    def __init__(self, list_segments, bytes_per_sec=None, interval=3600, on_corruption=None):
+        ''' (self, callable, int, float, callable) -> Scrubber
+        Initialize a scrubber of the segments list_segments() returns as
+        (segment name, path) pairs, reading at most bytes_per_sec bytes per
+        second. Once started, a pass begins every interval seconds.
+        on_corruption(segment name, error) is called for every bad segment found.
+        '''
+        self._list_segments = list_segments
+        self.rate_limiter = RateLimiter(bytes_per_sec)
+        self.interval = interval
+        self._on_corruption = on_corruption
+        self._thread = None
+        self._stopping = threading.Event()
+        # Segments found corrupt, with the error found
+        self.bad_segments = dict()
+
+        # Metrics
+        self.passes = 0
+        self.scrubbed_segments = 0
+        self.scrubbed_bytes = 0
+
+    def scrub(self):
+        ''' (self) -> dict
+        Checks every segment once, returning the bad segments found with their
+        error. Segments removed by a merge meanwhile are skipped, and forgotten
+        if they were bad.
+        '''
+        found, listed = dict(), set()
+        for name, path in self._list_segments():
+            if self._stopping.is_set():
+                break
+            listed.add(name)
+            try:
+                self.scrubbed_bytes += verify_segment(path, self.rate_limiter)
+            except FileNotFoundError:
+                continue
+            except RecordFormatError as error:
+                found[name] = str(error)
+                if self._on_corruption is not None:
+                    self._on_corruption(name, error)
+            self.scrubbed_segments += 1
+        else:
+            self.bad_segments = {name: error for name, error in self.bad_segments.items() if name in listed}
+            self.passes += 1
+        for name in listed - set(found):
+            self.bad_segments.pop(name, None)
+        self.bad_segments.update(found)
+        return found
+
+    def start(self):
+        ''' (self) -> None
+        Starts scrubbing in a background thread, unless it is running already.
+        '''
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='scrubber', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        ''' (self) -> None
+        Stops the background thread, waiting for the block it reads.
+        '''
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+        self._stopping.clear()
+
+    def stats(self):
+        ''' (self) -> dict
+        Returns the passes completed, the segments and bytes checked and the
+        bad segments found.
+        '''
+        return {'passes': self.passes,
+                'scrubbed_segments': self.scrubbed_segments,
+                'scrubbed_bytes': self.scrubbed_bytes,
+                'bad_segments': dict(self.bad_segments)}
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self.scrub()
+            self._stopping.wait(self.interval)
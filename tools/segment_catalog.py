@@ -0,0 +1,189 @@
+"""
+In-memory catalog of the segments (SSTables) of an LSM tree. Every segment is
+recorded when it is written, so compaction decisions can be taken without
+stat calls on the segment files.
+
+The expiry timestamps of a segment's records carrying a ttl are summed up by
+at most EXPIRY_SAMPLES of them, each standing for an equal share of those
+records, so the records already expired can be counted at any time.
+"""
+from bisect import bisect_right
+from datetime import datetime
+
+EXPIRY_SAMPLES = 32
+
+def sample_expiries(expiries, count=EXPIRY_SAMPLES):
+    ''' ([float], int) -> [float]
+    Returns at most count timestamps summing up the sorted expiry timestamps
+    expiries: the last one of each of count runs of about equal length. A
+    sample only passes once its whole run expired, so the share of samples
+    passed never overstates the share of records expired.
+    '''
+    if len(expiries) <= count:
+        return list(expiries)
+    return [expiries[((i + 1) * len(expiries) - 1) // count] for i in range(count)]
+
+def merge_expiry_samples(summaries, count=EXPIRY_SAMPLES):
+    ''' ([(int, [float])], int) -> [float]
+    Returns the samples summing up the records of several summaries, given as
+    (records carrying a ttl, samples) pairs, like sample_expiries does for the
+    timestamps of all their records.
+    '''
+    weighted = sorted((expiry, records / len(samples))
+                      for records, samples in summaries if samples for expiry in samples)
+    total = sum(records for records, samples in summaries if samples)
+    if total <= count:
+        return [expiry for expiry, _ in weighted]
+    merged, seen, position = [], 0, 0
+    for i in range(count):
+        target = (i + 1) * total / count
+        while position < len(weighted) - 1 and seen + weighted[position][1] < target - 1e-9:
+            seen += weighted[position][1]
+            position += 1
+        merged.append(weighted[position][0])
+    return merged
+
+class SegmentInfo:
+    def __init__(self, name, size, key_count, min_key, max_key, tombstones=0,
+                 expiries=(), created=None, seq=0):
+        ''' (self, str, int, int, str, str, int, [float], float, int) -> SegmentInfo
+        Describes a segment:
+
+        - size: bytes written to the segment
+        - key_count: records in the segment
+        - min_key, max_key: the key range of the segment
+        - tombstones: records carrying a ttl, which compactions will drop
+        - expiries: the expiry samples of those records, sorted
+        - created: timestamp at which the segment was written
+        - seq: the recency of the newest record in the segment
+        '''
+        self.name = name
+        self.size = size
+        self.key_count = key_count
+        self.min_key = min_key
+        self.max_key = max_key
+        self.tombstones = tombstones
+        self.expiries = list(expiries)
+        self.created = datetime.now().timestamp() if created is None else created
+        self.seq = seq
+
+    def __repr__(self):
+        return '{name} {size}B {count} keys [{min_key}, {max_key}] seq {seq}'.format(
+            name=self.name,
+            size=self.size,
+            count=self.key_count,
+            min_key=self.min_key,
+            max_key=self.max_key,
+            seq=self.seq
+            )
+
+    def expired(self, now):
+        ''' (self, float) -> float
+        Returns the estimated number of records whose ttl expired by the
+        timestamp now.
+        '''
+        if not self.expiries:
+            return 0
+        return self.tombstones * bisect_right(self.expiries, now) / len(self.expiries)
+
+    def overlaps(self, other):
+        ''' (self, SegmentInfo) -> bool
+        Returns True if the key ranges of both segments intersect.
+        '''
+        if self.key_count == 0 or other.key_count == 0:
+            return False
+        return self.min_key <= other.max_key and other.min_key <= self.max_key
+
+class SegmentCatalog:
+    def __init__(self):
+        self._segments = dict()
+        self._seq = 0
+
+    def __contains__(self, name):
+        return name in self._segments
+
+    def __getitem__(self, name):
+        return self._segments[name]
+
+    def __len__(self):
+        return len(self._segments)
+
+    def next_seq(self):
+        ''' (self) -> int
+        Returns a new sequence number, larger than any given before.
+        '''
+        self._seq += 1
+        return self._seq
+
+    def add(self, name, size, key_count, min_key, max_key, tombstones=0, expiries=(), seq=None):
+        ''' (self, str, int, int, str, str, int, [float], int) -> SegmentInfo
+        Records a newly written segment. Without seq, the segment is the most
+        recent one.
+        '''
+        seq = self.next_seq() if seq is None else seq
+        info = SegmentInfo(name, size, key_count, min_key, max_key, tombstones, expiries, seq=seq)
+        self._segments[name] = info
+        return info
+
+    def put(self, info):
+        ''' (self, SegmentInfo) -> None
+        Records a segment described elsewhere, such as in a manifest, keeping
+        its sequence number.
+        '''
+        self._segments[info.name] = info
+        self._seq = max(self._seq, info.seq)
+
+    def remove(self, name):
+        ''' (self, str) -> SegmentInfo
+        Forgets a segment that was merged away.
+        '''
+        return self._segments.pop(name, None)
+
+    def oldest(self, segments, count=2):
+        ''' (self, [str], int) -> [str]
+        Returns the count segments holding the oldest records, oldest first.
+        '''
+        return sorted(segments, key=lambda name: self._segments[name].seq)[:count]
+
+    def newest_first(self, segments):
+        ''' (self, [str]) -> [str]
+        Returns segments ordered from the one with the newest records to the oldest.
+        '''
+        return sorted(segments, key=lambda name: self._segments[name].seq, reverse=True)
+
+    def total_size(self, segments):
+        ''' (self, [str]) -> int
+        Returns the bytes taken by segments.
+        '''
+        return sum(self._segments[name].size for name in segments)
+
+    def tombstone_ratio(self, segments):
+        ''' (self, [str]) -> float
+        Returns the share of records of segments whose ttl already expired,
+        which a compaction would reclaim. Records whose expiry is still ahead
+        don't count.
+        '''
+        now = datetime.now().timestamp()
+        infos = [self._segments[name] for name in segments]
+        key_count = sum(info.key_count for info in infos)
+        return sum(info.expired(now) for info in infos) / key_count if key_count else 0
+
+    def read_amplification(self, segments):
+        ''' (self, [str]) -> int
+        Estimates the read amplification of segments as the largest number of
+        their key ranges that overlap at a single key, i.e. the most segments a
+        point lookup may have to open.
+        '''
+        events = []
+        for name in segments:
+            info = self._segments[name]
+            if info.key_count:
+                events.append((info.min_key, 0))
+                events.append((info.max_key, 1))
+        # Ranges are inclusive, so a range opening at a key counts before one closing there
+        events.sort()
+        overlapping, worst = 0, 0
+        for _, closing in events:
+            overlapping += -1 if closing else 1
+            worst = max(worst, overlapping)
+        return worst
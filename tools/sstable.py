@@ -0,0 +1,620 @@
+"""
+Binary record format of the segments (SSTables) and of the write ahead log.
+
+A record is the varint length of its key, a flags byte, the key, the expiry
+timestamp as a little endian double when it has one, the varint length of its
+value and the value. Lengths make any byte a valid part of a key or value, and
+readers skip over values without decoding them.
+
+Keys and values may be str or bytes. str is stored UTF-8 encoded and the flags
+remember which type each was given as, so both come back as written. UTF-8
+keeps the order of str keys, so records sorted by key are also sorted by their
+encoded keys, which readers compare without decoding. A value moved to a value
+log is replaced by a ValuePointer, stored as its file number, offset and length.
+
+A segment is a run of blocks of about BLOCK_SIZE bytes of records, each
+compressed on its own with the segment's codec, followed by the block index
+and a footer. The index gives the offset, compressed size, CRC32 and first key
+of every block, so a lookup binary searches it and then reads, verifies and
+decompresses a single block. The footer holds the CRC32 of the index.
+
+Within a block, a record only stores the part of its key not shared with the
+previous key: the varint length of the shared prefix replaces the key length
+and is followed by the varint length of the rest of the key. Every
+RESTART_INTERVAL records the full key is stored again, at a restart point.
+The block ends with the offsets of its restart points and their count, so a
+lookup binary searches the restart points and decodes at most
+RESTART_INTERVAL records.
+"""
+import bz2
+import lzma
+import os
+import struct
+import zlib
+
+# Record flags
+HAS_EXPIRY = 1
+BYTES_KEY = 2
+BYTES_VALUE = 4
+VALUE_POINTER = 8
+
+EXPIRY = struct.Struct('<d')
+POINTER = struct.Struct('<IQI')                 # value log file number, offset, length
+
+BLOCK_SIZE = 4096
+RESTART_INTERVAL = 16
+MAGIC = b'LSMC'
+RESTART = struct.Struct('<I')                   # restart point offset, or their count at the end of a block
+INDEX_ENTRY = struct.Struct('<QII')             # block offset, compressed size, CRC32, followed by the first key
+FOOTER = struct.Struct('<QIIB4s')               # index offset, number of blocks, index CRC32, codec, magic
+
+# Block codecs, stored in the footer by id. The level is the codec's own
+# compression level, None picking its default.
+CODECS = {'none': 0, 'zlib': 1, 'bz2': 2, 'lzma': 3}
+
+class RecordFormatError(Exception):
+    pass
+
+class CorruptSegmentError(RecordFormatError):
+    pass
+
+class ValuePointer:
+    def __init__(self, file, offset, length):
+        ''' (self, int, int, int) -> ValuePointer
+        Locates a value stored in a value log, as the number of its file and
+        the offset and length of its record there.
+        '''
+        self.file = file
+        self.offset = offset
+        self.length = length
+
+    def __eq__(self, other):
+        return (isinstance(other, ValuePointer)
+                and (self.file, self.offset, self.length) == (other.file, other.offset, other.length))
+
+    def __hash__(self):
+        return hash((self.file, self.offset, self.length))
+
+    def __repr__(self):
+        return 'ValuePointer({}, {}, {})'.format(self.file, self.offset, self.length)
+
+def compress(codec, level, data):
+    ''' (str, int, bytes) -> bytes
+    Returns data compressed with codec at level.
+    '''
+    if codec == 'none':
+        return data
+    if codec == 'zlib':
+        return zlib.compress(data, -1 if level is None else level)
+    if codec == 'bz2':
+        return bz2.compress(data, 9 if level is None else level)
+    if codec == 'lzma':
+        return lzma.compress(data, preset=level)
+    raise ValueError('Unknown codec {}'.format(codec))
+
+def decompress(codec_id, data):
+    ''' (int, bytes) -> bytes
+    Returns data decompressed with the codec of id codec_id.
+    '''
+    if codec_id == CODECS['none']:
+        return data
+    if codec_id == CODECS['zlib']:
+        return zlib.decompress(data)
+    if codec_id == CODECS['bz2']:
+        return bz2.decompress(data)
+    if codec_id == CODECS['lzma']:
+        return lzma.decompress(data)
+    raise RecordFormatError('Unknown codec id {}'.format(codec_id))
+
+def encode_varint(num):
+    ''' (int) -> bytes
+    Returns num in LEB128: seven bits per byte, low bits first, the high bit
+    set on every byte but the last.
+    '''
+    out = bytearray()
+    while num >= 0x80:
+        out.append(num & 0x7f | 0x80)
+        num >>= 7
+    out.append(num)
+    return bytes(out)
+
+def decode_varint(buffer, offset):
+    ''' (buffer, int) -> (int, int)
+    Returns the varint at offset in buffer and the offset following it.
+    '''
+    byte = buffer[offset]
+    if byte < 0x80:
+        return byte, offset + 1
+    result, shift = 0, 0
+    while byte >= 0x80:
+        result |= (byte & 0x7f) << shift
+        shift += 7
+        offset += 1
+        byte = buffer[offset]
+    return result | byte << shift, offset + 1
+
+def encode_key(key):
+    ''' (str or bytes) -> bytes
+    Returns key as stored in a record.
+    '''
+    return key if isinstance(key, bytes) else key.encode()
+
+def encode_record(key, value, expiry=None):
+    ''' (str or bytes, str or bytes, float) -> bytes
+    Returns the record of key and value, expiring at the expiry timestamp if
+    one is given.
+    '''
+    flags = 0
+    if isinstance(key, bytes):
+        flags |= BYTES_KEY
+    else:
+        key = key.encode()
+    if isinstance(value, ValuePointer):
+        flags |= VALUE_POINTER
+        value = POINTER.pack(value.file, value.offset, value.length)
+    elif isinstance(value, bytes):
+        flags |= BYTES_VALUE
+    else:
+        value = value.encode()
+    parts = [encode_varint(len(key)), bytes((flags | (HAS_EXPIRY if expiry is not None else 0),)), key]
+    if expiry is not None:
+        parts.append(EXPIRY.pack(expiry))
+    parts += [encode_varint(len(value)), value]
+    return b''.join(parts)
+
+def decode_record(buffer, offset=0):
+    ''' (buffer, int) -> (str or bytes, float, str or bytes, int)
+    Returns the key, expiry timestamp and value of the record at offset in
+    buffer, and the offset of the next record. Raises RecordFormatError if
+    the record runs past the end of buffer.
+    '''
+    try:
+        key_length, position = decode_varint(buffer, offset)
+        flags = buffer[position]
+        key = bytes(buffer[position + 1:position + 1 + key_length])
+        position += 1 + key_length
+        expiry = None
+        if flags & HAS_EXPIRY:
+            expiry, = EXPIRY.unpack_from(buffer, position)
+            position += EXPIRY.size
+        value_length, position = decode_varint(buffer, position)
+    except (IndexError, struct.error):
+        raise RecordFormatError('Truncated record at offset {}'.format(offset))
+    end = position + value_length
+    if end > len(buffer) or len(key) != key_length:
+        raise RecordFormatError('Truncated record at offset {}'.format(offset))
+    value = _value_of(flags, bytes(buffer[position:end]))
+    return key if flags & BYTES_KEY else key.decode(), expiry, value, end
+
+def _value_of(flags, value):
+    ''' (int, bytes) -> str or bytes or ValuePointer
+    Returns the value stored as value in a record with flags.
+    '''
+    if flags & VALUE_POINTER:
+        return ValuePointer(*POINTER.unpack(value))
+    return value if flags & BYTES_VALUE else value.decode()
+
+def _shared_prefix(key1, key2):
+    ''' (bytes, bytes) -> int
+    Returns the length of the longest common prefix of key1 and key2.
+    '''
+    length = min(len(key1), len(key2))
+    shared = 0
+    while shared < length and key1[shared] == key2[shared]:
+        shared += 1
+    return shared
+
+def _decode_entry(block, offset, previous_key):
+    ''' (bytes, int, bytes) -> (bytes, int, int, int)
+    Returns the encoded key and flags of the record at offset in block,
+    previous_key being the key of the record before it, along with the offset
+    of its expiry timestamp or value length and the offset of the next record.
+    '''
+    shared, position = decode_varint(block, offset)
+    unshared, position = decode_varint(block, position)
+    flags = block[position]
+    key = previous_key[:shared] + block[position + 1:position + 1 + unshared]
+    position += 1 + unshared
+    rest = position
+    if flags & HAS_EXPIRY:
+        position += EXPIRY.size
+    value_length, position = decode_varint(block, position)
+    return key, flags, rest, position + value_length
+
+def _decode_value(block, flags, rest, end):
+    ''' (bytes, int, int, int) -> (float, str or bytes)
+    Returns the expiry timestamp and value of the record whose expiry
+    timestamp or value length is at offset rest in block and which ends at end.
+    '''
+    expiry, start = _value_start(block, flags, rest)
+    return expiry, _value_of(flags, block[start:end])
+
+def _value_start(block, flags, rest):
+    ''' (bytes, int, int) -> (float, int)
+    Returns the expiry timestamp of the record whose expiry timestamp or value
+    length is at offset rest in block, and the offset of its value.
+    '''
+    expiry = None
+    if flags & HAS_EXPIRY:
+        expiry, = EXPIRY.unpack_from(block, rest)
+        rest += EXPIRY.size
+    return expiry, decode_varint(block, rest)[1]
+
+def value_view(record):
+    ''' (bytes) -> memoryview
+    Returns a read-only view of the value of the encoded record, UTF-8
+    encoded for str values, without copying it.
+    '''
+    key_length, position = decode_varint(record, 0)
+    _, start = _value_start(record, record[position], position + 1 + key_length)
+    return memoryview(record)[start:]
+
+class SegmentWriter:
+    def __init__(self, stream, codec='none', level=None, block_size=BLOCK_SIZE,
+                 restart_interval=RESTART_INTERVAL):
+        ''' (self, file, str, int, int, int) -> SegmentWriter
+        Initialize a writer appending records to the binary stream, in blocks
+        of about block_size bytes compressed with codec at level, storing a
+        full key every restart_interval records.
+        '''
+        if codec not in CODECS:
+            raise ValueError('Unknown codec {}'.format(codec))
+        self.stream = stream
+        self.codec = codec
+        self.level = level
+        self.block_size = block_size
+        self.restart_interval = restart_interval
+        # Bytes of blocks written so far
+        self.offset = 0
+        self._block = bytearray()
+        self._restarts = []
+        self._count = 0
+        self._first_key = None
+        self._last_key = b''
+        self._index = []
+
+    def add(self, key, value, expiry=None):
+        ''' (self, str or bytes, str or bytes, float) -> int
+        Writes a record, returning the offset of its block. Records must come
+        in key order.
+        '''
+        return self.add_record(encode_record(key, value, expiry))
+
+    def add_record(self, record):
+        ''' (self, bytes) -> int
+        Writes an encoded record, returning the offset of its block. Its key
+        is stored as the part not shared with the previous key, and its
+        expiry timestamp and value are copied as they are.
+        '''
+        key_length, position = decode_varint(record, 0)
+        flags = record[position]
+        key = bytes(record[position + 1:position + 1 + key_length])
+        if self._count % self.restart_interval == 0:
+            self._restarts.append(len(self._block))
+            shared = 0
+        else:
+            shared = _shared_prefix(self._last_key, key)
+        if not self._count:
+            self._first_key = key
+        self._block += encode_varint(shared) + encode_varint(key_length - shared) + bytes((flags,))
+        self._block += key[shared:]
+        self._block += record[position + 1 + key_length:]
+        self._last_key = key
+        self._count += 1
+
+        offset = self.offset
+        if len(self._block) + RESTART.size * (len(self._restarts) + 1) >= self.block_size:
+            self._write_block()
+        return offset
+
+    @property
+    def blocks(self):
+        return list(self._index)
+
+    def add_blocks(self, source, blocks):
+        ''' (self, file, list) -> None
+        Copies blocks, the (offset, size, checksum, first key) index entries of
+        a segment compressed with the same codec, from the binary stream source
+        positioned at its first block. Their keys must all follow the ones
+        written so far. Blocks are copied one at a time, as they are.
+        '''
+        if self._count:
+            self._write_block()
+        for _, size, checksum, first_key in blocks:
+            self.stream.write(source.read(size))
+            self._index.append((self.offset, size, checksum, first_key))
+            self.offset += size
+
+    def finish(self):
+        ''' (self) -> None
+        Writes the last block, the block index and the footer closing the
+        segment.
+        '''
+        if self._count:
+            self._write_block()
+        index = bytearray()
+        for offset, size, checksum, first_key in self._index:
+            index += INDEX_ENTRY.pack(offset, size, checksum) + encode_varint(len(first_key)) + first_key
+        self.stream.write(bytes(index))
+        self.stream.write(FOOTER.pack(self.offset, len(self._index), zlib.crc32(index),
+                                      CODECS[self.codec], MAGIC))
+
+    def _write_block(self):
+        for restart in self._restarts:
+            self._block += RESTART.pack(restart)
+        self._block += RESTART.pack(len(self._restarts))
+        payload = compress(self.codec, self.level, bytes(self._block))
+        self.stream.write(payload)
+        self._index.append((self.offset, len(payload), zlib.crc32(payload), self._first_key))
+        self.offset += len(payload)
+        self._block = bytearray()
+        self._restarts = []
+        self._count = 0
+        self._last_key = b''
+
+class SegmentReader:
+    def __init__(self, path, cache=None, verify=True):
+        ''' (self, str, BlockCache, bool) -> SegmentReader
+        Initialize a reader of the segment stored at path, reading its block
+        index. Blocks read for lookups and ranges go through cache, if given,
+        and so does the index, which is read once per segment. Unless verify is
+        False, every block read from disk is checked against its CRC32, raising
+        CorruptSegmentError on a mismatch. The index is always checked.
+        '''
+        self.path = path
+        self.cache = cache
+        self.verify = verify
+        index = cache.get_index(path) if cache is not None else None
+        if index is None:
+            with open(path, 'rb') as s:
+                index = _read_index(s, path)
+            if cache is not None:
+                cache.put_index(path, index)
+        self.end, self.codec_id, self.offsets, self.sizes, self.checksums, self.first_keys = index
+
+    def __iter__(self):
+        ''' (self) -> generator
+        Yields the (key, expiry, value) of every record in order.
+        '''
+        for key, expiry, value, _, _ in self.records():
+            yield key, expiry, value
+
+    def records(self, lower=None, upper=None):
+        ''' (self, str, str) -> generator
+        Yields the (key, expiry, value, record, block offset) of the records
+        with lower <= key < upper, record being the encoded record. Without
+        bounds the blocks are read in order straight from the file, bypassing
+        the cache.
+        '''
+        lower = None if lower is None else encode_key(lower)
+        upper = None if upper is None else encode_key(upper)
+        if lower is None and upper is None:
+            blocks = self._all_blocks()
+        else:
+            first = max(self._find_block(lower), 0) if lower is not None else 0
+            blocks = ((number, self.block(number)) for number in range(first, len(self.offsets)))
+
+        for number, block in blocks:
+            for key, flags, rest, end in self._entries(block, lower):
+                if lower is not None and key < lower:
+                    continue
+                if upper is not None and key >= upper:
+                    return
+                expiry, value = _decode_value(block, flags, rest, end)
+                record = encode_varint(len(key)) + bytes((flags,)) + key + block[rest:end]
+                yield (key if flags & BYTES_KEY else key.decode()), expiry, value, record, self.offsets[number]
+
+    def keys(self):
+        ''' (self) -> list
+        Returns the keys of the records in order, without decoding values.
+        '''
+        keys = []
+        for _, block in self._all_blocks():
+            for key, flags, _, _ in self._entries(block):
+                keys.append(key if flags & BYTES_KEY else key.decode())
+        return keys
+
+    def get(self, key):
+        ''' (self, str or bytes) -> (str or bytes, float)
+        Returns the value and expiry timestamp of key, or None if the segment
+        doesn't hold it.
+        '''
+        target = encode_key(key)
+        number = self._find_block(target)
+        if number < 0:
+            return None
+        return self._find(self.block(number), target)
+
+    def get_view(self, key):
+        ''' (self, str or bytes) -> (memoryview, float)
+        Like get, but returns the value as a read-only view of the block holding
+        it, UTF-8 encoded for str values, without copying it. The view keeps the
+        block alive, so it stays valid once the block leaves the cache or the
+        segment is merged away. A ValuePointer is returned as is.
+        '''
+        target = encode_key(key)
+        number = self._find_block(target)
+        if number < 0:
+            return None
+        block = self.block(number)
+        for stored, flags, rest, end in self._entries(block, target):
+            if stored == target:
+                expiry, start = _value_start(block, flags, rest)
+                if flags & VALUE_POINTER:
+                    return _value_of(flags, block[start:end]), expiry
+                return memoryview(block)[start:end], expiry
+            if stored > target:
+                return None
+        return None
+
+    def get_many(self, keys):
+        ''' (self, iterable) -> dict
+        Returns the (value, expiry timestamp) of every key of keys the segment
+        holds, reading each block at most once.
+        '''
+        found, number, block = dict(), -1, None
+        for target, key in sorted((encode_key(key), key) for key in keys):
+            block_number = self._find_block(target)
+            if block_number < 0:
+                continue
+            if block_number != number:
+                number, block = block_number, self.block(block_number)
+            record = self._find(block, target)
+            if record is not None:
+                found[key] = record
+        return found
+
+    def block(self, number):
+        ''' (self, int) -> bytes
+        Returns the decompressed block number, from the cache if it holds it.
+        '''
+        cache_key = (self.path, self.offsets[number])
+        if self.cache is not None:
+            block = self.cache.get(cache_key)
+            if block is not None:
+                return block
+        with open(self.path, 'rb') as s:
+            s.seek(self.offsets[number])
+            block = self._decompress(number, s.read(self.sizes[number]))
+        if self.cache is not None:
+            self.cache.put(cache_key, block)
+        return block
+
+    def _all_blocks(self):
+        ''' (self) -> generator
+        Yields the (number, decompressed block) of every block, reading them
+        one at a time from a single open file, so that only the block being
+        yielded is held in memory.
+        '''
+        with open(self.path, 'rb') as s:
+            for number, (offset, size) in enumerate(zip(self.offsets, self.sizes)):
+                s.seek(offset)
+                yield number, self._decompress(number, s.read(size))
+
+    def _decompress(self, number, payload):
+        if self.verify and zlib.crc32(payload) != self.checksums[number]:
+            raise CorruptSegmentError('Bad checksum of block {} at offset {} of {}'.format(
+                number, self.offsets[number], self.path))
+        return decompress(self.codec_id, payload)
+
+    def _find_block(self, target):
+        ''' (self, bytes) -> int
+        Returns the number of the last block whose first key is not above the
+        encoded key target, or -1 if target comes before every block.
+        '''
+        low, high = 0, len(self.first_keys)
+        while low < high:
+            middle = (low + high) // 2
+            if self.first_keys[middle] <= target:
+                low = middle + 1
+            else:
+                high = middle
+        return low - 1
+
+    @staticmethod
+    def _entries(block, lower=None):
+        ''' (bytes, bytes) -> generator
+        Yields the (encoded key, flags, offset of the expiry timestamp or value
+        length, offset of the next record) of the records of block in order.
+        Given lower, starts from the last restart point whose key is not above
+        it, so the records before lower are mostly skipped.
+        '''
+        count, = RESTART.unpack_from(block, len(block) - RESTART.size)
+        data_end = len(block) - RESTART.size * (count + 1)
+        position = 0
+        if lower is not None and count > 1:
+            restarts = struct.unpack_from('<{}I'.format(count), block, data_end)
+            low, high = 1, count
+            while low < high:
+                middle = (low + high) // 2
+                if _decode_entry(block, restarts[middle], b'')[0] <= lower:
+                    low = middle + 1
+                else:
+                    high = middle
+            position = restarts[low - 1]
+
+        key = b''
+        while position < data_end:
+            key, flags, rest, position = _decode_entry(block, position, key)
+            yield key, flags, rest, position
+
+    @staticmethod
+    def _find(block, target):
+        ''' (bytes, bytes) -> (str or bytes, float)
+        Returns the value and expiry timestamp of the encoded key target in
+        block, or None.
+        '''
+        for key, flags, rest, end in SegmentReader._entries(block, target):
+            if key == target:
+                expiry, value = _decode_value(block, flags, rest, end)
+                return value, expiry
+            if key > target:
+                return None
+        return None
+
+def _read_index(stream, path):
+    ''' (file, str) -> (int, int, list, list, list, list)
+    Returns the offset of the index, the codec id, and the offsets, sizes,
+    checksums and first keys of the blocks of the segment open in stream.
+    '''
+    size = stream.seek(0, 2)
+    if size < FOOTER.size:
+        raise RecordFormatError('{} is not a finished segment'.format(path))
+    stream.seek(size - FOOTER.size)
+    end, count, index_checksum, codec_id, magic = FOOTER.unpack(stream.read(FOOTER.size))
+    if magic != MAGIC:
+        raise RecordFormatError('{} is not a finished segment'.format(path))
+    stream.seek(end)
+    index = stream.read(size - FOOTER.size - end)
+    if zlib.crc32(index) != index_checksum:
+        raise CorruptSegmentError('Bad checksum of the block index of {}'.format(path))
+
+    offsets, sizes, checksums, first_keys = [], [], [], []
+    position = 0
+    for _ in range(count):
+        offset, block_size, checksum = INDEX_ENTRY.unpack_from(index, position)
+        key_length, position = decode_varint(index, position + INDEX_ENTRY.size)
+        offsets.append(offset)
+        sizes.append(block_size)
+        checksums.append(checksum)
+        first_keys.append(index[position:position + key_length])
+        position += key_length
+    return end, codec_id, offsets, sizes, checksums, first_keys
+
+def verify_segment(path, rate_limiter=None):
+    ''' (str, RateLimiter) -> int
+    Checks every block of the segment at path against its CRC32, reading it
+    through rate_limiter if given, and returns the bytes checked. Raises
+    CorruptSegmentError at the first bad block. The segment is read through a
+    single open file, so a segment replaced meanwhile is checked as it was.
+    '''
+    with open(path, 'rb') as s:
+        end, _, offsets, sizes, checksums, _ = _read_index(s, path)
+        s.seek(0)
+        for number, (offset, size, checksum) in enumerate(zip(offsets, sizes, checksums)):
+            if rate_limiter is not None:
+                rate_limiter.request(size)
+            if zlib.crc32(s.read(size)) != checksum:
+                raise CorruptSegmentError('Bad checksum of block {} at offset {} of {}'.format(
+                    number, offset, path))
+    return end
+
+def read_log(path, repair=False):
+    ''' (str, bool) -> generator
+    Yields the (key, expiry, value) of the records of the write ahead log at
+    path. A record torn by a crash while it was appended ends the log; with
+    repair, it is cut off the file, so that records appended afterwards
+    follow the last whole one.
+    '''
+    with open(path, 'rb') as s:
+        data = s.read()
+    offset = 0
+    while offset < len(data):
+        try:
+            key, expiry, value, end = decode_record(data, offset)
+        except RecordFormatError:
+            if repair:
+                os.truncate(path, offset)
+            return
+        offset = end
+        yield key, expiry, value
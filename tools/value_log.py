@@ -0,0 +1,112 @@
+"""
+Value log separating large values from the keys of an LSM tree, after WiscKey.
+Values are appended, along with their key, to numbered log files of at most
+max_file_size bytes, and segments store a ValuePointer in their place, so
+that merges only rewrite keys and pointers.
+
+Values overwritten, deleted or expired leave dead records behind. Garbage
+collection goes through the oldest file, hands the records still live back
+to the tree to be appended again, and removes the file.
+"""
+from os import remove as remove_file
+from pathlib import Path
+
+from tools.sstable import ValuePointer, encode_record, decode_record, value_view
+
+class ValueLog:
+    def __init__(self, directory, basename='vlog', max_file_size=64*1024*1024):
+        ''' (self, str, str, int) -> ValueLog
+        Initialize a value log writing files named basename-<number> in
+        directory, starting a new file once one reaches max_file_size bytes.
+        Files left by a previous run are picked up.
+        '''
+        self.directory = directory
+        self.basename = basename
+        self.max_file_size = max_file_size
+        numbers = [int(path.name.split('-')[-1]) for path in Path(directory).glob(basename + '-*')
+                   if path.name.split('-')[-1].isdigit()]
+        self._files = sorted(numbers) or [0]
+        self._head_size = Path(self._path(self._files[-1])).stat().st_size \
+            if Path(self._path(self._files[-1])).exists() else 0
+
+        # Metrics
+        self.appended_bytes = 0
+        self.collected_bytes = 0
+        self.relocated_bytes = 0
+
+    def append(self, key, value):
+        ''' (self, str or bytes, str or bytes) -> ValuePointer
+        Appends value, stored with key, returning where it went.
+        '''
+        if self._head_size >= self.max_file_size:
+            self._files.append(self._files[-1] + 1)
+            self._head_size = 0
+        record = encode_record(key, value)
+        number = self._files[-1]
+        with open(self._path(number), 'ab') as s:
+            s.write(record)
+        pointer = ValuePointer(number, self._head_size, len(record))
+        self._head_size += len(record)
+        self.appended_bytes += len(record)
+        return pointer
+
+    def read(self, pointer, view=False):
+        ''' (self, ValuePointer, bool) -> str or bytes
+        Returns the value pointer locates, or None if its file was collected,
+        a collected record being dead. With view, the value is returned as a
+        read-only memoryview of the record read, without copying it.
+        '''
+        try:
+            with open(self._path(pointer.file), 'rb') as s:
+                s.seek(pointer.offset)
+                record = s.read(pointer.length)
+        except FileNotFoundError:
+            return None
+        return value_view(record) if view else decode_record(record)[2]
+
+    def sealed_files(self):
+        ''' (self) -> list
+        Returns the numbers of the files no longer appended to, oldest first.
+        '''
+        return self._files[:-1]
+
+    def collect(self, number, relocate):
+        ''' (self, int, callable) -> (int, int)
+        Garbage collects the file number. relocate(key, value, pointer) is
+        called for every record, and must append the value again if the tree
+        still points to it, returning whether it did. The file is then removed.
+        Returns the bytes of live and dead records.
+        '''
+        with open(self._path(number), 'rb') as s:
+            data = s.read()
+        live = dead = offset = 0
+        while offset < len(data):
+            key, _, value, end = decode_record(data, offset)
+            if relocate(key, value, ValuePointer(number, offset, end - offset)):
+                live += end - offset
+            else:
+                dead += end - offset
+            offset = end
+        remove_file(self._path(number))
+        self._files.remove(number)
+        self.collected_bytes += dead
+        self.relocated_bytes += live
+        return live, dead
+
+    def total_bytes(self):
+        return sum(Path(self._path(number)).stat().st_size for number in self._files
+                   if Path(self._path(number)).exists())
+
+    def stats(self):
+        ''' (self) -> dict
+        Returns the bytes and files of the log, the bytes appended, the dead
+        bytes garbage collection reclaimed and the live bytes it moved.
+        '''
+        return {'total_bytes': self.total_bytes(),
+                'files': len(self._files),
+                'appended_bytes': self.appended_bytes,
+                'collected_bytes': self.collected_bytes,
+                'relocated_bytes': self.relocated_bytes}
+
+    def _path(self, number):
+        return self.directory + self.basename + '-' + str(number)
@@ -18,12 +18,13 @@ class Singleton:
 @Singleton
 class AppendLog:
     def __init__(self, filename):
+        # Binary, so entries may be encoded records; str entries are written UTF-8 encoded
         self.filename = filename
-        self.stream = open(filename, 'a')
+        self.stream = open(filename, 'ab')
 
     def write(self, val):
         try:
-            self.stream.write(val)
+            self.stream.write(val.encode() if isinstance(val, str) else val)
             self.stream.flush()
         except IOError:
             print("The file stream isn't currently open")
@@ -31,5 +32,5 @@ class AppendLog:
     def clear(self):
         self.stream.close()
         # Clearing the stream should clear the current file contents
-        self.stream = open(self.filename, 'w')
+        self.stream = open(self.filename, 'wb')
 